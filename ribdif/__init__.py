@@ -12,4 +12,9 @@ __version__ = (2, 0, 0)
 # Try on python v3.5
 import sys as _sys
 if _sys.version_info[:2] < (3, 7):
-    raise ImportError('Python version must be >= 3.7')
\ No newline at end of file
+    raise ImportError('Python version must be >= 3.7')
+
+# Python API, imported on first use so the command line does not pay for it (see ribdif/api.py)
+def run(config):
+    from ribdif.api import run as api_run
+    return api_run(config)
@@ -19,7 +19,7 @@ from itertools import repeat
 
 
 import ribdif
-from ribdif import ngd_download, barrnap_run, pcr_run, pyani_run, utils, msa_run, summary_files, vsearch_run, logging_config
+from ribdif import ngd_download, barrnap_run, pcr_run, pyani_run, utils, msa_run, summary_files, vsearch_run, logging_config, resources, journal, store, dereplicate, incidence, id_sweep, primer_combinations, seed_index, window_scan, binding_sites
 from ribdif.custom_exceptions import EmptyFileError, IncompatiablityError, StopError, IncorrectFormatError
 
 # =============================================================================
@@ -61,14 +61,53 @@ def parse_args():
                         help = "Ignore genomes with unspecified species (i.e. their species is 'sp.')",
                         action = "store_true")
     
+    parser.add_argument("--max-genomes-per-species", dest = "max_per_species",
+                        help = "Download at most this many genomes of each species, chosen from the NCBI assembly metadata (reference and representative genomes first, then the most complete and newest). Unnamed species ('sp.') are not capped. With --dereplicate all genomes are downloaded and this caps the representatives kept per species instead",
+                        default = None,
+                        type = int)
+    
+    parser.add_argument("--dereplicate", dest = "dereplicate",
+                        help = "Cluster near identical genomes of the same species after download using MinHash sketches and only analyse one representative per cluster. Give the maximum Mash distance within a cluster, e.g. 0.001. Overlap reports are weighted by cluster size",
+                        default = None,
+                        type = float)
+    
+    parser.add_argument("--assembly-level", dest = "assembly_levels",
+                        help = "Comma separated assembly levels to download, any of complete, chromosome, scaffold and contig. Overrides -f/--frag",
+                        default = None)
+    
     parser.add_argument("-o", "--outdir", dest = "outdir",
                         help = "Output directory path. Default is current directory",
                         default = "False")
     
+    parser.add_argument("--ncbi-uri", dest = "ncbi_uri",
+                        help = "Base URL of the NCBI genomes server (or a mirror of it) to download from",
+                        default = ngd_download.NCBI_URI,
+                        metavar = '')
+    
+    parser.add_argument("--genome-store", dest = "genome_store",
+                        help = "Directory of a genome store shared between runs. Genomes are downloaded (or copied if using --user) into it once and linked into the output directory, along with their processed fasta and rRNA files. Can also be set with the RIBDIF_GENOME_STORE environment variable",
+                        default = None)
+    
     group1.add_argument("-r", "--rerun", dest = "rerun",
                         help = "Re-run on same or different primers. Avoids having to redownload the same genomes or recopy to a new direcotry (if using --user). Mutually exclusive with --clobber",
                         action = "store_true") # Action store true will default to false when argument is not present
     
+    group1.add_argument("--resume", dest = "resume",
+                        help = "Resume an interrupted run in the output directory, skipping every stage and genome recorded as complete in its journal whose inputs and outputs are unchanged. Mutually exclusive with --clobber and --rerun",
+                        action = "store_true")
+    
+    group1.add_argument("--report-only", dest = "report_only",
+                        help = "Only recompute the overlap reports and confusion matrices of a finished run from its saved allele incidence, e.g. with a different --ignore-sp, --exclude-genomes or --only-species. Nothing is downloaded and no external tool is run. Mutually exclusive with --clobber, --rerun and --resume",
+                        action = "store_true")
+    
+    parser.add_argument("--exclude-genomes", dest = "exclude_genomes",
+                        help = "File of genome accessions (or user genome names), one per line, to leave out of the reports. Requires --report-only",
+                        default = None)
+    
+    parser.add_argument("--only-species", dest = "only_species",
+                        help = "Comma separated species names (as in the reports, e.g. aureus,epidermidis) to restrict the reports to. Requires --report-only",
+                        default = None)
+    
     group1.add_argument("-c", "--clobber", dest = "clobber",
                         help="Delete previous run if present in output directory. Mutually exclusive with --rerun", 
                         action = "store_true") 
@@ -93,14 +132,69 @@ def parse_args():
                         help = "Identity to cluster amplicons at if not using the default 1.0. e.g. .99. Does not cluster at the genome level, so beware.",
                         default = 1)
     
+    parser.add_argument("--id-sweep", dest = "id_sweep",
+                        help = "Comma separated identities to also cluster amplicons at, e.g. 1,0.995,0.99,0.97. Amplicons are compared once and every identity gets its own reports as <primer name>-id<identity>",
+                        default = None)
+    
+    parser.add_argument("--sweep-linkage", dest = "sweep_linkage",
+                        help = "How clusters are made from the allele pairs in --id-sweep. centroid (default) follows vsearch's clustering, single joins any alleles linked by a chain of pairs",
+                        choices = ["centroid", "single"],
+                        default = "centroid")
+    
+    parser.add_argument("--window-scan", dest = "window_scan",
+                        help = "Range of window lengths, e.g. 100-500, to score every window of across the alignment of all 16S genes for the species and alleles it resolves. Needs -m/--msa",
+                        default = None)
+    
+    parser.add_argument("--window-stride", dest = "window_stride",
+                        help = "Step in alignment columns between the starts and lengths of the windows of --window-scan. Default is 10",
+                        default = 10,
+                        type = int)
+    
+    parser.add_argument("--binding-report", dest = "binding_report",
+                        help = "Search every genome for the best binding sites of each primer (including genomes that did not amplify) and add them, with where the mismatches sit relative to the 3' end, to the amplicon summaries",
+                        action = "store_true")
+    
+    parser.add_argument("--binding-mismatches", dest = "binding_mismatches",
+                        help = "Most mismatches a binding site of --binding-report can have. Default is 3",
+                        default = 3,
+                        type = int)
+    
+    parser.add_argument("--primer-combinations", dest = "primer_combinations",
+                        help = "Rank every combination of up to this many primers (e.g. 3) by how many species and genomes they tell apart together, as when sequencing several amplicons from one sample",
+                        default = None,
+                        type = int)
+    
     parser.add_argument("-t", "--threads", dest = "threads",
                         help = "Number of threads to use. Default is all available",
                         default = os.cpu_count(),
                         type = int)
     
+    parser.add_argument("--memory", dest = "memory",
+                        help = "Memory budget in GB shared by all concurrently running tasks. Tasks are only started while their estimated memory fits. Default is 90%% of the currently available memory",
+                        default = None,
+                        type = float)
+    
+    parser.add_argument("--defer-figures", dest = "defer_figures",
+                        help = "Skip drawing the heatmaps and graphs, only saving the allele incidence they are drawn from. Draw them later with ribdif-figures -o <outdir>",
+                        action = "store_true")
+    
     group2.add_argument("-w", "--whole-genome", dest = "whole", 
                         help = "Indicate the primers given are to be run on the whole genome so no barrnap or ani (Required if your primers are non 16S). Mutually exclusive with --ani",
                         action = "store_true")
+    
+    parser.add_argument("--seed-index", dest = "seed_index",
+                        help = "In whole genome mode keep a k-mer index of the genomes (in <outdir>/seed_index) and find primer binding sites through it (with the one mismatch or indel of the default PCR), so reruns with new primers only run the PCR around them. Rebuilt automatically when the genomes change",
+                        action = "store_true")
+    
+    parser.add_argument("--shards", dest = "shards",
+                        help = "Split the run's genomes into this many shards and only download, extract and amplify the genomes of one of them (see --shard-index). Join the finished shards with ribdif merge <outdir>/<genus>",
+                        default = None,
+                        type = int)
+    
+    parser.add_argument("--shard-index", dest = "shard_index",
+                        help = "Which shard to run, from 0 to --shards - 1. Defaults to the SLURM_ARRAY_TASK_ID of an array job",
+                        default = None,
+                        type = int)
     return parser.parse_args()
 
 def arg_handling(args, workingDir, logger):
@@ -121,6 +215,64 @@ def arg_handling(args, workingDir, logger):
     else: # If no genus if given (and thus args.user was) set genus to parent directory
         genus = Path(args.user).name
         
+    # Checking the requested assembly levels are ones NCBI uses
+    if args.assembly_levels:
+        levels = ["complete", "chromosome", "scaffold", "contig"]
+        if not all(level in levels for level in args.assembly_levels.split(",")):
+            logger.error(f"--assembly-level must be a comma separated list of {', '.join(levels)}")
+            return 1
+        
+    # Checking the sweep identities are fractions
+    if args.id_sweep:
+        try:
+            if not all(0 < float(t) <= 1 for t in args.id_sweep.split(",")):
+                raise ValueError()
+        except ValueError:
+            logger.error("--id-sweep must be a comma separated list of identities between 0 and 1, e.g. 1,0.995,0.99,0.97")
+            return 1
+    
+    # Checking the window scan has an alignment of the 16S genes to scan
+    if args.window_scan:
+        try:
+            min_window, max_window = (int(length) for length in args.window_scan.split("-"))
+            if not 0 < min_window <= max_window or args.window_stride < 1:
+                raise ValueError()
+        except ValueError:
+            logger.error("--window-scan must be a range of window lengths, e.g. 100-500, and --window-stride a positive number of columns")
+            return 1
+        if args.whole or not args.msa:
+            logger.error("--window-scan scans the alignment of the 16S genes so needs -m/--msa and can't be used with --whole-genome")
+            return 1
+    
+    # Checking the binding site search has a sensible mismatch limit
+    if args.binding_report and not 0 <= args.binding_mismatches <= 15:
+        logger.error("--binding-mismatches must be between 0 and 15")
+        return 1
+    
+    # The seed index holds whole genomes
+    if args.seed_index and not args.whole:
+        logger.error("--seed-index can only be used with --whole-genome (-w)")
+        return 1
+    
+    # Checking the report filters are only used to recompute reports
+    if (args.exclude_genomes or args.only_species) and not args.report_only:
+        logger.error("--exclude-genomes and --only-species can only be used with --report-only")
+        return 1
+    if args.exclude_genomes and not Path(args.exclude_genomes).is_file():
+        logger.error(f"{args.exclude_genomes} does not exist")
+        return 1
+        
+    # Checking a sharded run knows its shard and stops before anything that needs every genome
+    if args.shards is not None:
+        from ribdif import shards # only a sharded run needs it
+        args.shard_index = shards.shard_index(args.shard_index)
+        if args.shards < 1 or args.shard_index is None or not 0 <= args.shard_index < args.shards:
+            logger.error(f"--shards needs a --shard-index (or {shards.SHARD_ENV}) from 0 to {args.shards - 1 if args.shards > 0 else 0}")
+            return 1
+        if args.report_only or args.dereplicate is not None or args.window_scan or args.id_sweep:
+            logger.error("--shards cannot be used with --report-only, --dereplicate, --window-scan or --id-sweep as they need every genome of the run")
+            return 1
+    
     # Checking user provided directory exists   
     if args.user and not Path(args.user).is_dir():
         logger.info(f"{args.user} is not a valid directory. Please check the path and try again")
@@ -131,22 +283,35 @@ def arg_handling(args, workingDir, logger):
         outdir = Path(f"{Path.cwd()}/results/{genus}")
     else:
         outdir = Path(f"{args.outdir}/{genus}")
+    if args.shards is not None:
+        outdir = shards.shard_dir(outdir, args.shard_index)
+    
+    if args.report_only and not Path(f"{outdir}").is_dir():
+        logger.error(f"{outdir} does not exist. --report-only needs a finished run to recompute the reports of")
+        return 1
 
     # Resolving clobber argument
     try:
         if args.clobber:
             shutil.rmtree(Path(f"{outdir}")) # Remove genus and all subdirectories
             logger.info(f"Removing old run of {genus}")  
-        elif Path(f"{outdir}").is_dir() and args.rerun == False: # catch if genus output already exists and rerun was not specified and clobber was not used
+        elif Path(f"{outdir}").is_dir() and args.rerun == False and args.resume == False and args.report_only == False: # catch if genus output already exists and rerun or resume was not specified and clobber was not used
             raise FileExistsError()
     except FileNotFoundError: # catch if directory not found
         logger.info(f"{genus} folder does not exist, ignoring clobber request\n")
         pass
     except FileExistsError as err:
         logger.error(str(err), exc_info = True)
-        logger.error(f"{outdir} folder already exists. Run again with -c/--clobber, -r/--rerun or set another output directory")
+        logger.error(f"{outdir} folder already exists. Run again with -c/--clobber, -r/--rerun, --resume or set another output directory")
         return 1
     
+    # A previous run's 16S alignment lets windows longer than it be caught before anything runs
+    if args.window_scan and not args.clobber and Path(f"{outdir}/full/{genus}.16sAln").is_file():
+        width = window_scan.alignment_width(f"{outdir}/full/{genus}.16sAln")
+        if min_window > width:
+            logger.error(f"--window-scan windows of {args.window_scan} columns are all longer than the {width} column alignment of the {genus} 16S genes")
+            return 1
+    
     # Make the outdir
     Path.mkdir(Path(outdir), parents = True, exist_ok = True)
     
@@ -215,6 +380,24 @@ def arg_handling(args, workingDir, logger):
 def main():
     workingDir = Path(os.path.realpath(os.path.dirname(__file__))) # getting the path the script is running from
     
+    # ribdif screen has its own arguments, its module is only imported when it is run
+    if len(sys.argv) > 1 and sys.argv[1] == "screen":
+        from ribdif import screen
+        screen.main(sys.argv[2:])
+        return
+    
+    # as does ribdif serve
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        from ribdif import service
+        service.main(sys.argv[2:])
+        return
+    
+    # and ribdif merge
+    if len(sys.argv) > 1 and sys.argv[1] == "merge":
+        from ribdif import shards
+        shards.main(sys.argv[2:])
+        return
+    
     args = parse_args()
     
     # Initialise the logging
@@ -224,6 +407,18 @@ def main():
     input_arg[0] = input_arg[0].split("/")[-1]
     logger.info("Input command:")
     logger.info(" ".join(input_arg))
+    
+    # A file of genera (or species) is run as a batch in this one process
+    if args.genus and Path(args.genus).is_file():
+        from ribdif import batch
+        batch.run_batch(args, workingDir, logger, run_pipeline)
+        return
+    
+    run_pipeline(args, workingDir, logger)
+
+
+# Run the pipeline on one genus (or the user's genomes)
+def run_pipeline(args, workingDir, logger):
     if args.genus:
         genus_line = f"#== RibDif2 is running on: {args.genus} in the {args.domain} domain ==#"
     elif args.user:
@@ -240,47 +435,53 @@ def main():
     log_dir = Path(outdir) / "ribdif_logs"
     Path(log_dir).mkdir(exist_ok = True, parents = True)
     
+    # Core and memory budget shared out between the stages
+    budget = resources.make_budget(args.threads, args.memory)
+    logger.info(f"Running with {budget['cores']} cores and a {round(budget['memory']/resources.GB, 2)}GB memory budget\n\n")
+    
+
+    genome_dir = Path(f"{outdir}/refseq/{args.domain}/")
+    
+    # Recompute the reports from the saved allele incidence and stop
+    if args.report_only:
+        report_only(args, outdir, genus, genome_dir, logger)
+        return
+    
+    # Journal of completed stages and per genome tasks. Always written so a later --resume can pick up from it, only consulted when resuming
+    if args.resume:
+        state = journal.load(outdir)
+        removed = journal.clean_partials(outdir)
+        logger.info(f"Resuming from {len(state)} checkpointed tasks. Removed {removed} partially written files\n\n")
+    else:
+        state = {}
+    genome_store = store.store_path(args.genome_store)
+    keep = None
+    if args.shards is not None:
+        from ribdif import shards # only a sharded run needs it
+        keep = shards.shard_filter(args.shards, args.shard_index)
+        Path(f"{outdir}/{shards.MANIFEST_NAME}").unlink(missing_ok = True) # only a shard that finishes again is merged
+        logger.info(f"Running shard {args.shard_index} of {args.shards}\n\n")
 
     # If rerun is false, download and handle genomes from NCBI
     if rerun == False:
         
         if args.genus:
-            # Download genomes from NCBI
-            status = ngd_download.genome_download(genus, outdir, args.threads, args.frag, args.sp_ignore, args.domain, logger)
-            # Catching is any critical errors occured from downloading genomes
-            if status == 1:
-                sys.exit(status)
-        
-            # Un gziping fasta files
-            with multiprocessing.Pool(args.threads) as pool: # Create a multiprocessing pool with #threads workers
-                all_gz = [str(i) for i in list(Path(f"{outdir}/refseq/{args.domain}/").glob('**/*.gz'))]# Recursively search the directory for .gz files and convert path to string sotring in a list
-                pool.map(utils.decompress, all_gz)
-            
-                
-            # Remove unwanted characters from anywhere is file (should only be in fasta headers)
-            logger.info("Modifying fasta headers.\n\n")
-            with multiprocessing.Pool(args.threads) as pool:
-                all_fna = [str(i) for i in list(Path(f"{outdir}/refseq/{args.domain}/").glob('*/*.fna'))]
-                all_species = pool.map(utils.modify2, all_fna)
-                genome_count = len(all_species)
+            all_species, species_map = download_genomes(args, outdir, genus, genome_dir, budget, state, genome_store, keep, logger)
+            genome_count = len(all_species)
                 
         # Else if user defined  are given
         elif args.user:
-            new_dir_path, genome_count = utils.own_genomes_copy(args.user, outdir, args.domain, logger) # copy to new location
-            utils.own_genomes_gzip(new_dir_path) # decompress if needed
-            utils.own_genomes_rename(new_dir_path, logger) # Rename fasta headers
-            logger.info(f"{genome_count} user defined genomes were found\n\n")
+            genome_count = user_genomes(args, outdir, genome_dir, state, genome_store, keep, logger)
     
     # Else get genome count of exising genomes      
     else:
-        all_fna = [str(i) for i in list(Path(f"{outdir}/refseq/{args.domain}/").glob('*/*.fna'))]
-        with multiprocessing.Pool(args.threads) as pool:
-            all_species = pool.map(utils.sp_check, all_fna)
+        all_species, species_map = existing_genomes(args, outdir, genus, genome_dir, logger)
         genome_count = len(all_species)
-        if args.genus:
-            logger.info(f"{genome_count} previously downloaded genomes of {genus} were found\n\n")
-        elif args.user:
-            logger.info(f"{genome_count} previously user defined genomes were found\n\n")
+    
+    # A shard whose slice of the genomes is empty still finishes, so ribdif merge sees every shard
+    if keep and not any(genome_dir.glob('*/*.fna*')):
+        shards.finish_shard(outdir, genus, args.shard_index, args.shards, [], {}, args.user, args.whole, logger)
+        return
     
     if args.genus:
         # getting unique species for later use in the overlap reports and removing "sp."
@@ -289,62 +490,298 @@ def main():
     elif args.user:
         unique_species = set()
         all_species = ["sp."] * genome_count
+        species_map = {}
+    
+    # Dereplicate near identical genomes. Only representatives carry on but the reports are weighted by the cluster sizes
+    derep_inputs = [args.dereplicate, args.max_per_species]
+    if args.dereplicate is not None and rerun == False and not journal.is_done(state, "dereplicate", derep_inputs, [f"{outdir}/{dereplicate.DEREP_NAME}"]):
+        genome_species = species_map or {Path(fna).parent.name: utils.sp_check(fna) for fna in genome_dir.glob('*/*.fna')}
+        dereplicate.dereplicate(outdir, args.domain, genome_species, args.dereplicate, args.threads, logger, args.max_per_species)
+        journal.record(outdir, state, "dereplicate", derep_inputs, [f"{outdir}/{dereplicate.DEREP_NAME}"])
+        if args.genus: # the download is still complete, just with fewer genomes left in place
+            journal.record(outdir, state, "download", download_inputs(args, genus), sorted(genome_dir.glob('*/*.fna.gz')))
+    weights, derep_species = dereplicate.derep_weights(outdir)
+    if weights:
+        # Every downloaded genome still counts towards the totals in the reports
+        all_species = derep_species
+        genome_count = len(all_species)
+        if args.genus:
+            unique_species = set(all_species)
+            unique_species.discard("sp.")
 
             
     # If not using whole-genome mode assume the primers being used are 16S (which they are if default)
     if not args.whole:
-        logger.info("#= Running barrnap on downloaded sequences =#\n\n")
-        barrnap_run.barnap_call(outdir, threads = args.threads)
-        
-        # Processing barrnap output > fishing out 16S sequences
-        with multiprocessing.Pool(args.threads) as pool:
-            all_RNA = [str(i) for i in list(Path(f"{outdir}/refseq/{args.domain}/").glob('*/*.rRNA'))]
-            #gene_num = [*range(len(all_RNA))] # adding gene num count here (in congruence with v1. Could also just use in silico pcr amp count)
-            pool.map(barrnap_run.barrnap_process, all_RNA) # removed zip(gene_num) and was originally starmap
+        extract_16S(args, outdir, genus, genome_dir, budget, state, genome_store, species_map, logger)
+            
+    names = run_pcr(args, outdir, genus, primer_file, genome_dir, budget, state, workingDir, logger)
         
-        # Concatinate all 16S to one file
-        barrnap_run.barrnap_conc(genus, outdir)
+    # Best binding sites of every primer in every genome, kept even when a primer amplified nothing
+    if args.binding_report:
+        primers = binding_sites.read_primers(primer_file)
+        binding_inputs = [primer_file, args.binding_mismatches] + sorted(genome_dir.glob('*/*.fna' if args.whole else '*/*.16S'))
+        binding_outputs = [binding_sites.binding_path(outdir, genus, name) for name, _, _ in primers]
+        journal.run_unit(outdir, state, "binding", binding_inputs, binding_outputs,
+                         lambda: binding_sites.binding_report(outdir, genus, primers, [str(i) for i in binding_inputs[2:]], args.binding_mismatches, budget, logger),
+                         logger, "Skipping the binding site search as it completed in the previous run\n\n")
+    
+    # Catching if all amplification failed (empty lists evaluate to false), a shard's genomes may just not amplify
+    if not keep and not list(Path(f"{outdir}/amplicons/").rglob(f"{genus}-*.amplicons")):
+        sys.exit("No amplification for any of the given primers was successfull. Try again with different primers")
+    
+    # Make summary file for whole genome mode (has to be after utils.amp_replace so cant have in main args.whole section)
+    #if args.whole:
+    for name in names:
+        amplicon_summary(args, outdir, genus, name, state, logger)
+    
+    # A shard stops here, clustering and the reports are made once over every shard by ribdif merge
+    if keep:
+        genome_species = {fna.parent.name: "sp." if args.user else species_map.get(fna.parent.name) or utils.sp_check(fna) for fna in genome_dir.glob('*/*.fna')}
+        shards.finish_shard(outdir, genus, args.shard_index, args.shards, names, genome_species, args.user, args.whole, logger)
+        return
         
-        #If ANI is true calculate
-        if args.ANI:
-            # First need to split whole 16S sequences into seperate files
-            with multiprocessing.Pool(args.threads) as pool:
-                all_16S = [str(i) for i in list(Path(f"{outdir}/refseq/{args.domain}/").glob('*/*.16S'))]
-                pool.map(barrnap_run.barrnap_split, all_16S)
-               
-            # Call pyani
-            logger.info("Calculating intra-genomic mismatches and ANI for each genome.\n\n")
-            pyani_run.pyani_call(outdir, args.threads, args.domain)
+
+    
+    report_source = cluster_amplicons(args, outdir, genus, names, species_map, log_dir, budget, state, logger)
+    
+    
+    # Generating the figures #
+    Path.mkdir(Path(f"{outdir}/figures"), exist_ok = True)
+    logger.info("Making reports and figures\n\n")
+    if args.msa:
+        logger.info("Aligning all amplicons for diversity calculation.\n")
+        logger.info(f"Tree tip information can be found at: {outdir}/amplicons/{genus}-<name>-meta.tsv.\n\n")
+    else:
+        logger.info("Skipping total amplicon alignment and diversity calculation\n")
+    
+    # Reports only depend on the clusters and run options so skip any primer whose report is still valid
+    report_inputs = {name: [f"{outdir}/amplicons/{name}/{genus}-{name}.uc", args.msa, args.sp_ignore, genome_count, args.defer_figures] for name in report_source}
+    report_names = [name for name in report_source if not journal.is_done(state, f"reports:{name}", report_inputs[name], [f"{outdir}/{genus}_{name}_overlap_report.txt"])]
+    
+    # Each primers reports may run mafft and fasttree and hold genome x genome matrices so only admit as many as the memory budget allows
+    report_costs = [resources.reports_memory(f"{outdir}/amplicons/{report_source[name]}/{genus}-{report_source[name]}.amplicons", args.msa and name in names) for name in report_names]
+    report_threads = resources.tool_threads(budget, min(len(report_names), budget["cores"]))
+    
+    def checkpoint(i, result):
+        journal.record(outdir, state, f"reports:{report_names[i]}", report_inputs[report_names[i]], [f"{outdir}/{genus}_{report_names[i]}_overlap_report.txt"])
+    resources.budget_starmap(utils.make_reports, zip(report_names, [args.msa and name in names for name in report_names], repeat(outdir), repeat(genus), repeat(logger), repeat(args.user), repeat(unique_species), repeat(all_species), repeat(genome_count), repeat(report_threads), repeat(species_map), repeat(weights), repeat(args.defer_figures)), report_costs, budget, logger, checkpoint)
+    
+    # Rank how well the primers resolve genomes when sequenced together
+    if args.primer_combinations:
+        if len(names) > 1:
+            primer_combinations.rank_combinations(outdir, genus, names, args.primer_combinations, logger, weights)
         else:
-            logger.info("Skipping detailed intra-genomic analysis and ANI (if needed, use -a/--ANI).\n\n")
+            logger.info("Skipping primer combinations as only one primer amplified\n")
+
+    logger.info(f"You can find a saved version of the above at {outdir}/ribdif_log_file.log")
+
+
+# Recompute the reports of a finished run from its saved allele incidence, with the report filters applied
+def report_only(args, outdir, genus, genome_dir, logger):
+    names = incidence.saved_primers(outdir, genus)
+    if not names:
+        logger.error(f"No saved allele incidence found in {outdir}/amplicons. Rerun the full pipeline with -r/--rerun first")
+        sys.exit(1)
+    exclude = utils.read_accessions(args.exclude_genomes) if args.exclude_genomes else set()
+    only_species = set(args.only_species.split(",")) if args.only_species else set()
+    
+    # Every genome of the run (including any set aside by dereplication) counts towards the totals if it passes the filters
+    members = dereplicate.derep_members(outdir)
+    if members:
+        genome_species = {gcf: species for gcf, (_, species) in members.items()}
+    elif args.user:
+        genome_species = {fna.parent.name: "sp." for fna in genome_dir.glob('*/*.fna')}
+    else:
+        all_fna = [str(i) for i in genome_dir.glob('*/*.fna')]
+        with multiprocessing.Pool(args.threads) as pool:
+            header_species = pool.map(utils.sp_check, all_fna)
+        species_map = ngd_download.metadata_species(outdir)
+        genome_species = {Path(fna).parent.name: species_map.get(Path(fna).parent.name, sp) for fna, sp in zip(all_fna, header_species)}
+    kept = [gcf for gcf, keep in zip(genome_species, incidence.genome_mask(list(genome_species), list(genome_species.values()), args.sp_ignore, exclude, only_species)) if keep]
+    all_species = [genome_species[gcf] for gcf in kept]
+    unique_species = set() if args.user else set(all_species) - {"sp."}
+    weights = {}
+    for gcf in kept:
+        if gcf in members:
+            weights[members[gcf][0]] = weights.get(members[gcf][0], 0) + 1
+    logger.info(f"Recomputing reports for {', '.join(names)} from {len(kept)} of {len(genome_species)} genomes passing the report filters\n\n")
+    for name in names:
+        utils.recompute_reports(name, outdir, genus, logger, args.user, unique_species, all_species, len(all_species), weights, args.sp_ignore, exclude, only_species)
+    if args.primer_combinations and len(id_sweep.primer_names(names)) > 1:
+        primer_combinations.rank_combinations(outdir, genus, id_sweep.primer_names(names), args.primer_combinations, logger, weights, args.sp_ignore, exclude, only_species)
+    logger.info(f"You can find a saved version of the above at {outdir}/ribdif_log_file.log")
+    return
+
+
+# Options the download of a genus depends on, a resumed run only skips the download if none of them changed
+def download_inputs(args, genus):
+    return [genus, args.domain, args.frag, args.sp_ignore, args.max_per_species, args.assembly_levels]
+
+
+# Download a genus' genomes from NCBI and prepare them, returning the species of every genome and the species of the assembly metadata
+def download_genomes(args, outdir, genus, genome_dir, budget, state, genome_store, keep, logger):
+    # Download genomes from NCBI, each genome is decompressed, has its headers fixed and (if using 16S) goes through barrnap as soon as its download checks out
+    def download():
+        with multiprocessing.Pool(resources.pool_size(budget, resources.typical_genome_memory("barrnap"))) as stream_pool:
+            streamed = []
+            on_ready = lambda gz: streamed.append((gz, stream_pool.apply_async(utils.process_genome, (gz, not args.whole))))
+            status = ngd_download.genome_download(genus, outdir, resources.download_parallel(budget), args.frag, args.sp_ignore, args.domain, logger, genome_store, on_ready, args.ncbi_uri, None if args.dereplicate is not None else args.max_per_species, args.assembly_levels.split(",") if args.assembly_levels else None, keep)
+            for gz, job in streamed:
+                try:
+                    job.get() # genomes pruned after download are simply left behind by the later stages
+                except Exception:
+                    logger.error(f"Preparing {Path(gz).parent.name} as it downloaded failed, it will be tried again when the genomes are prepared\n", exc_info = True)
+        # Catching is any critical errors occured from downloading genomes
+        if status == 1:
+            sys.exit(status)
+    downloaded = lambda: sorted(genome_dir.glob('*/*.fna.gz'))
+    journal.run_unit(outdir, state, "download", download_inputs(args, genus), downloaded, download, logger,
+                     f"Skipping download of {genus} genomes as it completed in the previous run\n\n")
+    
+    # Un gziping fasta files and removing unwanted characters from anywhere is file (should only be in fasta headers) in one pass
+    logger.info("Decompressing genomes and modifying fasta headers.\n\n")
+    all_gz = [str(i) for i in genome_dir.glob('*/*.fna.gz')] # Search the directory for .gz files and convert path to string sotring in a list
+    # Genomes already prepared while downloading, or by another run and linked from the genome store, are skipped
+    unzipped = lambda gz: gz[:-3]
+    pending_gz = [gz for gz in journal.pending_genomes(state, "prepare", all_gz, unzipped) if not store.is_fresh(gz[:-3], gz)]
+    gz_species = {}
+    with multiprocessing.Pool(args.threads) as pool:
+        for gz, species in pool.imap_unordered(utils.prepare_genome, pending_gz):
+            gz_species[gz] = species
+            journal.record_genome(outdir, state, "prepare", gz, unzipped)
+        # Species of genomes prepared in a previous run are read back from their headers
+        done_gz = [gz for gz in all_gz if gz not in gz_species]
+        gz_species.update(zip(done_gz, pool.map(utils.sp_check, [gz[:-3] for gz in done_gz])))
+    # Species labels come from the assembly metadata rather than their position in the fasta headers
+    species_map = ngd_download.metadata_species(outdir)
+    all_species = [species_map.get(Path(gz).parent.name, gz_species[gz]) for gz in all_gz]
+    if genome_store:
+        store.publish(genome_store, args.domain, outdir, ".fna", args.threads)
+    return all_species, species_map
+
 
-        # ALignment of full 16S genes recoverd from barrnap
+# Copy in the user's own genomes, returning how many there are
+def user_genomes(args, outdir, genome_dir, state, genome_store, keep, logger):
+    # Clear any partial copy and decompress if needed and rename fasta headers in one pass
+    def ingest():
+        shutil.rmtree(genome_dir, ignore_errors = True)
+        utils.own_genomes_ingest(args.user, outdir, args.domain, args.threads, logger, genome_store, keep)
+    journal.run_unit(outdir, state, "user_genomes", [args.user, args.domain], lambda: sorted(genome_dir.glob('*/*.fna')), ingest, logger,
+                     "Skipping copying of user defined genomes as it completed in the previous run\n\n")
+    genome_count = len(list(genome_dir.glob('*/*.fna')))
+    logger.info(f"{genome_count} user defined genomes were found\n\n")
+    return genome_count
+
+
+# Species of the genomes of a previous run, for -r/--rerun
+def existing_genomes(args, outdir, genus, genome_dir, logger):
+    all_fna = [str(i) for i in list(genome_dir.glob('*/*.fna'))]
+    with multiprocessing.Pool(args.threads) as pool:
+        all_species = pool.map(utils.sp_check, all_fna)
+    species_map = ngd_download.metadata_species(outdir) # Empty for user genomes or runs from before the metadata was kept
+    all_species = [species_map.get(Path(fna).parent.name, sp) for fna, sp in zip(all_fna, all_species)]
+    if args.genus:
+        logger.info(f"{len(all_species)} previously downloaded genomes of {genus} were found\n\n")
+    elif args.user:
+        logger.info(f"{len(all_species)} previously user defined genomes were found\n\n")
+    return all_species, species_map
+
+
+# Find the 16S genes of every genome with barrnap, then the ANI, alignments and 16S summary the options ask for
+def extract_16S(args, outdir, genus, genome_dir, budget, state, genome_store, species_map, logger):
+    logger.info("#= Running barrnap on downloaded sequences =#\n\n")
+    barrnap_run.barnap_call(outdir, budget, logger, state, reuse = bool(args.genus))
+    
+    # Processing barrnap output > fishing out 16S sequences
+    with multiprocessing.Pool(args.threads) as pool:
+        all_RNA = [str(i) for i in list(genome_dir.glob('*/*.rRNA'))]
+        out_16S = lambda rna: f"{rna}.16S"
+        pending_RNA = journal.pending_genomes(state, "16S", all_RNA, out_16S)
+        if args.genus: # extracted while downloading or linked from the genome store
+            pending_RNA = [rna for rna in pending_RNA if not store.is_fresh(f"{rna}.16S", rna)]
+        #gene_num = [*range(len(all_RNA))] # adding gene num count here (in congruence with v1. Could also just use in silico pcr amp count)
+        for rna in pool.imap_unordered(barrnap_run.barrnap_process, pending_RNA): # removed zip(gene_num) and was originally starmap
+            journal.record_genome(outdir, state, "16S", rna, out_16S)
+    
+    # Share the rRNA files with later runs
+    if genome_store and args.genus:
+        from ribdif import atlas # only runs sharing a genome store add to its atlas
+        for suffix in [".fna.rRNA", ".fna.rRNA.16S"]:
+            store.publish(genome_store, args.domain, outdir, suffix)
+        # and add their 16S genes to the store's atlas, where primers can be screened against any genus without its genomes
+        atlas.add_genomes(genome_store, args.domain, genus, sorted(str(i) for i in genome_dir.glob('*/*.16S')), species_map, logger)
+    
+    # Concatinate all 16S to one file
+    barrnap_run.barrnap_conc(genus, outdir)
+    all_16S = sorted(str(i) for i in genome_dir.glob('*/*.16S'))
+    
+    #If ANI is true calculate
+    if args.ANI:
+        # First need to split whole 16S sequences into seperate files
+        with multiprocessing.Pool(args.threads) as pool:
+            pool.map(barrnap_run.barrnap_split, all_16S)
+           
+        # Call pyani
+        logger.info("Calculating intra-genomic mismatches and ANI for each genome.\n\n")
+        pyani_run.pyani_call(outdir, args.threads, args.domain, state)
+    else:
+        logger.info("Skipping detailed intra-genomic analysis and ANI (if needed, use -a/--ANI).\n\n")
+
+    # ALignment of full 16S genes recoverd from barrnap
+    all_16sAln = [f"{Path(i).parent / Path(i).stem}.16sAln" for i in all_16S]
+    def align_within():
         logger.info("Alligning full-length 16S genes within genomes with muscle.\n\n")
-        msa_run.muscle_call_multi(outdir, args.threads, args.domain)
-        
-        summary_type = "16S"
-        in_fna = f"{outdir}/full/{genus}.16S"
-        summary_files.make_summary(in_fna, outdir, genus, args.whole, args.ANI, args.threads, summary_type, args.domain, args.user)
-        
-        # Running msa on concatinated 16S sequences
-        if args.msa == True:
+        msa_run.muscle_call_multi(outdir, budget, args.domain)
+    journal.run_unit(outdir, state, "msa_multi", all_16S, all_16sAln, align_within, logger,
+                     "Skipping alignment of full-length 16S genes within genomes as it completed in the previous run.\n\n")
+    
+    summary_type = "16S"
+    in_fna = f"{outdir}/full/{genus}.16S"
+    journal.run_unit(outdir, state, "summary:16S", [in_fna, args.ANI] + all_16sAln, [f"{outdir}/{genus}_{summary_type}_summary.tsv"],
+                     lambda: summary_files.make_summary(in_fna, outdir, genus, args.whole, args.ANI, args.threads, summary_type, args.domain, args.user), logger)
+    
+    # Running msa on concatinated 16S sequences
+    if args.msa == True:
+        infile , outAln, outTree = f"{outdir}/full/{genus}.16S", f"{outdir}/full/{genus}.16sAln", f"{outdir}/full/{genus}.16sTree" # Asigning in and out files
+        def align_all():
             logger.info(f"Alligning all {genus} 16S rRNA genes with muscle and building tree with fasttree.\n")
-            infile , outAln, outTree = f"{outdir}/full/{genus}.16S", f"{outdir}/full/{genus}.16sAln", f"{outdir}/full/{genus}.16sTree" # Asigning in and out files
-            msa_run.muscle_call_single(infile, outAln, outTree)
-        else:
-            logger.info("Skipping alignments and tree generation for 16S rRNA genes (if needed, use -m/--msa).\n\n")
-            
-        # PCR for default primers
-        infile = f"{outdir}/full/{genus}.16S" # path to concatinated 16S barrnap output
-        names =  pcr_run.pcr_call(infile, outdir, genus, primer_file, workingDir, logger)
+            msa_run.muscle_call_single(infile, outAln, outTree, resources.tool_threads(budget))
+        journal.run_unit(outdir, state, "msa:16S", [infile], [outAln, outTree], align_all, logger,
+                         f"Skipping alignment of all {genus} 16S rRNA genes as it completed in the previous run.\n")
         
+        # Score every window of the alignment as though it were an amplicon
+        if args.window_scan:
+            min_window, max_window = (int(length) for length in args.window_scan.split("-"))
+            journal.run_unit(outdir, state, "window_scan", [outAln, args.window_scan, args.window_stride], [f"{outdir}/{genus}_{window_scan.SCAN_NAME}"],
+                             lambda: window_scan.window_scan(outdir, genus, min_window, max_window, args.window_stride, species_map, logger),
+                             logger, "Skipping the window scan as it completed in the previous run.\n")
+    else:
+        logger.info("Skipping alignments and tree generation for 16S rRNA genes (if needed, use -m/--msa).\n\n")
+    return
 
-        
 
-    # PCR for custom primers   
-    elif args.whole:
+# In silico PCR of every primer, returning the names of those that amplified
+# PCR is checkpointed as a whole (including the renaming of amplicon headers) as the primers are processed together
+def run_pcr(args, outdir, genus, primer_file, genome_dir, budget, state, workingDir, logger):
+    pcr_inputs = [primer_file, args.whole] + ([f"{outdir}/full/{genus}.16S"] if not args.whole else sorted(genome_dir.glob('*/*.fna'))) + (["seed_index"] if args.seed_index else [])
+    names = journal.unit_data(state, "pcr") or []
+    pcr_outputs = [f"{outdir}/amplicons/{name}/{genus}-{name}.amplicons" for name in names]
+    if names and journal.is_done(state, "pcr", pcr_inputs, pcr_outputs):
+        logger.info(f"Skipping PCR as it completed in the previous run for {', '.join(names)}\n\n")
+        return names
+    
+    # PCR for default primers
+    if not args.whole:
+        infile = f"{outdir}/full/{genus}.16S" # path to concatinated 16S barrnap output
+        names =  pcr_run.pcr_call(infile, outdir, genus, primer_file, workingDir, logger)
 
-        names = pcr_run.pcr_parallel_call(outdir, genus, primer_file, workingDir, args.threads, logger, args.domain)
+    # PCR for custom primers   
+    elif args.seed_index:
+        # Binding sites are looked up in the index, which is only rebuilt if the genomes changed
+        index = seed_index.ensure_index(outdir, sorted(str(i) for i in genome_dir.glob('*/*.fna')), logger)
+        names = pcr_run.pcr_indexed(outdir, genus, primer_file, index, workingDir, logger)
+    else:
+        names = pcr_run.pcr_parallel_call(outdir, genus, primer_file, workingDir, budget, logger, args.domain)
         
         # book keeping for parallel PCR
         for name in names:
@@ -352,43 +789,48 @@ def main():
             pcr_run.amplicon_cat(outdir, genus, name)
             pcr_run.sum_dict_write(outdir, genus, name, total_sum_dict)
 
-        
-    
     # Rename amplicon fasta headers to origin contig and removing any primers that did not amplify
     names = utils.amp_replace(outdir, genus, names, logger)
-        
-    # Catching if all amplification failed (empty lists evaluate to false)
-    if not list(Path(f"{outdir}/amplicons/").rglob(f"{genus}-*.amplicons")):
-        sys.exit("No amplification for any of the given primers was successfull. Try again with different primers")
-    
-    # Make summary file for whole genome mode (has to be after utils.amp_replace so cant have in main args.whole section)
-    #if args.whole:
-    for name in names:
-        summary_type = f"{name}-amp"
-        in_fna = f"{outdir}/amplicons/{name}/{genus}-{name}.amplicons"
+    journal.record(outdir, state, "pcr", pcr_inputs, [f"{outdir}/amplicons/{name}/{genus}-{name}.amplicons" for name in names], data = names)
+    return names
+
+
+# Summary of a primer's amplicons, with its binding sites when they were searched for
+def amplicon_summary(args, outdir, genus, name, state, logger):
+    summary_type = f"{name}-amp"
+    in_fna = f"{outdir}/amplicons/{name}/{genus}-{name}.amplicons"
+    summary_out = f"{outdir}/{genus}_{summary_type}_summary.tsv"
+    def summarise():
         summary_files.make_summary(in_fna, outdir, genus, args.whole, args.ANI, args.threads, summary_type, args.domain, args.user)
-        
+        if args.binding_report:
+            binding_sites.add_to_summary(summary_out, binding_sites.binding_path(outdir, genus, name), args.user)
+    summary_inputs = [in_fna, args.ANI] + ([binding_sites.binding_path(outdir, genus, name)] if args.binding_report else [])
+    journal.run_unit(outdir, state, f"summary:{name}", summary_inputs, [summary_out], summarise, logger)
+    return
 
-    
+
+# Cluster every primer's amplicons with vsearch (and at every identity of a sweep), returning the primer each set of clusters to report came from
+def cluster_amplicons(args, outdir, genus, names, species_map, log_dir, budget, state, logger):
     logger.info ("Making unique clusters with vsearch.\n\n")
     for name in names:
-        vsearch_run.vsearch_call(outdir, genus, name, args.id, log_dir, args.threads, logger)
-    
-    
-    
-    # Generating the figures #
-    Path.mkdir(Path(f"{outdir}/figures"), exist_ok = True)
-    logger.info("Making reports and figures\n\n")
-    if args.msa:
-        logger.info("Aligning all amplicons for diversity calculation.\n")
-        logger.info(f"Tree tip information can be found at: {outdir}/amplicons/{genus}-<name>-meta.tsv.\n\n")
-    else:
-        logger.info("Skipping total amplicon alignment and diversity calculation\n")
-    
-    with multiprocessing.Pool(args.threads) as pool: # Create a multiprocessing pool with #threads workersfor .gz files and convert path to string sotring in a list
-        pool.starmap(utils.make_reports, zip(names, repeat(args.msa), repeat(outdir), repeat(genus), repeat(logger), repeat(args.user), repeat(unique_species), repeat(all_species), repeat(genome_count)))
+        amplicons, uc = f"{outdir}/amplicons/{name}/{genus}-{name}.amplicons", f"{outdir}/amplicons/{name}/{genus}-{name}.uc"
+        journal.run_unit(outdir, state, f"vsearch:{name}", [amplicons, args.id], [uc],
+                         lambda: vsearch_run.vsearch_call(outdir, genus, name, args.id, log_dir, resources.tool_threads(budget), logger), logger)
+    
+    # Cluster at every identity of the sweep from one pairwise search per primer, each identity is then reported like a primer of its own
+    report_source = {name: name for name in names}
+    if args.id_sweep:
+        thresholds = [float(t) for t in args.id_sweep.split(",")]
+        for name in names:
+            amplicons = f"{outdir}/amplicons/{name}/{genus}-{name}.amplicons"
+            current = [id_sweep.sweep_name(name, t) for t in thresholds]
+            sweep_outputs = [f"{outdir}/amplicons/{n}/{genus}-{n}.uc" for n in current] + [f"{outdir}/{genus}_{name}_id_sweep.tsv"]
+            journal.run_unit(outdir, state, f"sweep:{name}", [amplicons, args.id_sweep, args.sweep_linkage], sweep_outputs,
+                             lambda: id_sweep.sweep(outdir, genus, name, thresholds, args.sweep_linkage, species_map, log_dir, resources.tool_threads(budget), logger),
+                             logger, f"Skipping the identity sweep of {name} as it completed in the previous run\n")
+            report_source.update({n: name for n in current})
+    return report_source
 
-    logger.info(f"You can find a saved version of the above at {outdir}/ribdif_log_file.log")
     
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
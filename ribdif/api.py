@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+import logging
+import os
+import tempfile
+from dataclasses import dataclass
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from ribdif import primer_match, incidence, atlas, store, journal, vsearch_run, utils, screen
+from ribdif.id_sweep import canonical
+from ribdif.custom_exceptions import EmptyFileError, IncorrectFormatError
+
+# Python API, ribdif.run(config) evaluates primers against genomes already on disk and returns the results as objects
+
+DEFAULTS = {"run": None, "user": None, "atlas": None, "genome_store": None, "genus": None, "primers": None, "whole": False,
+            "domain": "bacteria", "identity": 1.0, "mismatches": 1, "threads": os.cpu_count(), "outdir": None, "logger": None}
+AMPLICON_COLUMNS = ["GCF", "Species", "SequenceId", "Position", "Length", "Strand", "Allele", "Sequence"]
+
+
+# Result of one primer pair
+@dataclass
+class PrimerResult:
+    name: str
+    forward: str
+    reverse: str
+    amplicons: pd.DataFrame # one row per amplicon of every genome, in AMPLICON_COLUMNS
+    incidence: pd.DataFrame # genomes x alleles amplicon counts, the cluster matrix the reports and figures use
+    gcf_species: dict # species of every genome that amplified
+    overlap_groups: list # species sharing an allele, as listed in the overlap report
+    species_confusion: pd.DataFrame # see incidence.species_confusion
+    stats: dict # the numbers of the overlap report
+
+
+# Result of a run
+@dataclass
+class RunResult:
+    genus: str
+    genomes: pd.DataFrame # GCF and species of every genome evaluated
+    primers: dict # primer name to PrimerResult
+
+    # One row of stats per primer
+    def summary(self):
+        return pd.DataFrame([{"Name": name, **result.stats} for name, result in self.primers.items()])
+
+
+# Fill in the defaults and check there is exactly one genome source
+def resolve_config(config):
+    unknown = set(config) - set(DEFAULTS)
+    if unknown:
+        raise IncorrectFormatError(f"Unknown configuration keys: {', '.join(sorted(unknown))}")
+    config = {**DEFAULTS, **config}
+    if sum(config[source] is not None for source in ("run", "user", "atlas")) != 1:
+        raise IncorrectFormatError("Give exactly one of run, user or atlas as the genomes to evaluate")
+    if config["user"] and not config["whole"]:
+        raise IncorrectFormatError("User genomes have no 16S genes extracted without the command line, use whole = True")
+    if config["atlas"] and config["whole"]:
+        raise IncorrectFormatError("The atlas only holds 16S genes so can't be used with whole = True")
+    if config["logger"] is None:
+        config["logger"] = logging.getLogger(__name__)
+    return config
+
+
+# Primers from a primer file or a list, as (name, forward, reverse, amplicon length)
+def read_primers(primers):
+    if primers is None:
+        primers = Path(__file__).parent / "default.primers"
+    if isinstance(primers, (str, Path)):
+        with open(primers, "r", encoding = "utf-8-sig") as f_in:
+            primers = [line.strip().split("\t")[:4] for line in f_in if line.strip() and not line.startswith("#")]
+    if not primers or any(len(primer) != 4 for primer in primers):
+        raise IncorrectFormatError("Primers must be name, forward, reverse and expected amplicon length")
+    return [(str(name), fwd, rvs, float(length)) for name, fwd, rvs, length in primers]
+
+
+# The user's own genomes, one per fasta file and named after it like the command line does
+def user_sequences(user_dir, logger):
+    paths = [path for path in sorted(Path(user_dir).iterdir()) if path.is_file()]
+    genome_species = {utils.user_genome_name(path): "sp." for path in paths}
+    records = ((utils.user_genome_name(path), label, seq) for path in paths for label, seq in primer_match.read_fasta([path]))
+    return screen.packed_sequences(*screen.distinct_sequences(records), genome_species, logger)
+
+
+# Load the genomes of the configured source
+def load_genomes(config):
+    if config["run"]:
+        rundir = Path(config["run"]).resolve()
+        full = sorted(Path(f"{rundir}/full").glob("*.16S")) # the genus is the name the run's 16S genes were concatenated under
+        if not config["whole"] and not full:
+            raise EmptyFileError(f"No 16S genes found in {rundir}/full, evaluate a whole genome run with whole = True")
+        genus = config["genus"] or (full[0].stem if full else rundir.name)
+        loaded = screen.load_sequences(rundir, full[0].stem if full else genus, config["whole"], config["domain"], config["logger"])
+    elif config["user"]:
+        genus = config["genus"] or Path(config["user"]).resolve().name
+        loaded = user_sequences(config["user"], config["logger"])
+    else:
+        genome_store = store.store_path(config["genome_store"])
+        if not genome_store or not (atlas.atlas_dir(genome_store, config["domain"]) / "copies.tsv").is_file():
+            raise EmptyFileError("No 16S atlas found, give the genome store with genome_store or RIBDIF_GENOME_STORE")
+        genera = config["atlas"] if config["atlas"] == "all" else list(config["atlas"])
+        genus = config["genus"] or ("all" if genera == "all" else "-".join(genera))
+        loaded = screen.load_atlas_sequences(genome_store, config["domain"], None if genera == "all" else genera, config["logger"])
+    if not loaded["n_genomes"]:
+        raise EmptyFileError("No genomes were found to evaluate the primers against")
+    return genus, loaded["genome_species"], loaded
+
+
+# Allele of every distinct amplicon: exact sequences on either strand, or vsearch clusters below an identity of 1
+def cluster_alleles(amp_seqs, identity, threads, logger):
+    uniques, unique_of = np.unique(np.array([canonical(seq) for seq in amp_seqs], dtype = object), return_inverse = True)
+    if float(identity) >= 1 or len(uniques) < 2:
+        return unique_of.ravel()
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(f"{tmp}/uniques.fasta", "w") as f_out:
+            f_out.write("".join(f">{i}\n{seq}\n" for i, seq in enumerate(uniques)))
+        vsearch_run.vsearch_cluster(f"{tmp}/uniques.fasta", f"{tmp}/uniques.uc", identity, threads, tmp, logger)
+        uc_df = pd.read_csv(f"{tmp}/uniques.uc", sep = "\t", header = None)
+    uc_df = uc_df[uc_df[0] != "C"]
+    cluster_of = np.empty(len(uniques), dtype = np.int64)
+    cluster_of[uc_df[8].astype(np.int64).to_numpy()] = uc_df[1].astype(np.int64).to_numpy()
+    return cluster_of[unique_of.ravel()]
+
+
+# Match one primer pair and turn its amplicons into alleles, the incidence and the numbers of the overlap report
+def evaluate_primer(loaded, genomes, name, fwd, rvs, length, config):
+    gcfs, species = list(genomes), list(genomes.values())
+    max_length = int(length + length * 0.5) # the same maximum length as the command line's PCR
+    starts, lengths, forward = primer_match.amplify(loaded["codes"], loaded["offsets"], fwd, rvs, max_length, config["mismatches"])
+    seq_of = primer_match.sequence_of(starts, loaded["offsets"])
+    amp_seqs = [primer_match.amplicon_sequence(loaded["text"], start, amp_len, fwd_strand) for start, amp_len, fwd_strand in zip(starts, lengths, forward)]
+    allele_of = cluster_alleles(amp_seqs, config["identity"], config["threads"], config["logger"]) if amp_seqs else np.zeros(0, dtype = np.int64)
+
+    # Every amplicon of a distinct sequence is an amplicon of each occurrence of that sequence
+    repeats = loaded["seq_count"][seq_of]
+    amp_index = np.repeat(np.arange(len(starts)), repeats)
+    within = np.arange(len(amp_index)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    occurrence = loaded["occ_order"][loaded["seq_first"][seq_of[amp_index]] + within]
+    genome_of = loaded["occ_genome"][occurrence]
+    amplicons = pd.DataFrame({"GCF": [gcfs[g] for g in genome_of], "Species": [species[g] for g in genome_of],
+                              "SequenceId": loaded["occ_label"][occurrence], "Position": (starts - loaded["offsets"][seq_of] + 1)[amp_index],
+                              "Length": lengths[amp_index], "Strand": np.where(forward[amp_index], "+", "-"),
+                              "Allele": allele_of[amp_index], "Sequence": [amp_seqs[i] for i in amp_index]}, columns = AMPLICON_COLUMNS)
+
+    # Genomes x alleles counts ordered like the reports, by species with unnamed genomes last
+    counts = pd.crosstab(amplicons["GCF"], amplicons["Allele"]) if len(amplicons) else pd.DataFrame()
+    gcf_species = {gcf: genomes[gcf] for gcf in counts.index}
+    order = sorted(counts.index, key = lambda gcf: (gcf_species[gcf] == "sp.", gcf_species[gcf], gcf))
+    cluster_df = counts.loc[order]
+    cluster_df.index.name, cluster_df.columns.name = None, None
+    overlap_groups = incidence.species_overlap(cluster_df, gcf_species) if len(cluster_df) else []
+    confusion = incidence.species_confusion(cluster_df, gcf_species) if len(cluster_df) else pd.DataFrame()
+
+    stats = incidence.report_stats(cluster_df, gcf_species, genomes, overlap_groups)
+    return PrimerResult(name, fwd, rvs, amplicons, cluster_df, gcf_species, overlap_groups, confusion, stats)
+
+
+# Write a primer's results in the command line's layout so the reports and ribdif-figures can be run on them
+def write_primer(result, outdir, genus):
+    amp_dir = Path(f"{outdir}/amplicons/{result.name}")
+    amp_dir.mkdir(parents = True, exist_ok = True)
+    stem = incidence.incidence_stem(outdir, genus, result.name)
+    with journal.atomic_write(f"{stem}.amplicons") as f_out:
+        for i, row in enumerate(result.amplicons.itertuples(index = False), 1):
+            f_out.write(f">{row.SequenceId}_{i}\n{row.Sequence}\n")
+    with journal.atomic_write(f"{stem}_amplicons.tsv") as f_out:
+        result.amplicons.drop(columns = "Sequence").to_csv(f_out, sep = "\t", index = False)
+    if len(result.incidence):
+        incidence.save_incidence(result.incidence, result.gcf_species, outdir, genus, result.name)
+        with journal.atomic_write(f"{stem}_species_confusion.csv") as f_out:
+            result.species_confusion.to_csv(f_out, sep = ",", index = True)
+    return
+
+
+# Evaluate primers against genomes on disk and return the results in memory, its configuration keys are listed in the README
+def run(config):
+    config = resolve_config(config)
+    logger = config["logger"]
+    primers = read_primers(config["primers"])
+    genus, genomes, loaded = load_genomes(config)
+    logger.info(f"Evaluating {len(primers)} primers against {len(genomes)} {genus} genomes\n")
+    with ThreadPool(max(1, min(config["threads"], len(primers)))) as pool:
+        results = pool.starmap(evaluate_primer, [(loaded, genomes, name, fwd, rvs, length, config) for name, fwd, rvs, length in primers])
+    result = RunResult(genus, pd.DataFrame({"GCF": list(genomes), "Species": list(genomes.values())}), {r.name: r for r in results})
+
+    if config["outdir"]:
+        Path(config["outdir"]).mkdir(parents = True, exist_ok = True)
+        for primer_result in results:
+            write_primer(primer_result, config["outdir"], genus)
+        with journal.atomic_write(f"{config['outdir']}/{genus}_primer_stats.tsv") as f_out:
+            result.summary().to_csv(f_out, sep = "\t", index = False)
+    return result
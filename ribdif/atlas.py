@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+import fcntl
+import io
+import hashlib
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from ribdif import primer_match
+
+# 16S allele atlas of a genome store, every 16S copy a run extracts added once so genera can be screened without their genomes
+
+ATLAS_DIR = "atlas"
+COPY_COLUMNS = ["Accession", "Genus", "Species", "Copy", "Allele", "Label"]
+ALLELE_COLUMNS = ["Allele", "Length", "Digest"]
+
+
+# Directory a domain's atlas lives in
+def atlas_dir(store, domain):
+    return Path(f"{store}/{ATLAS_DIR}/{domain}")
+
+
+# Read one of the atlas tables, a line cut short by a killed run is ignored
+def read_table(path, columns):
+    if not Path(path).is_file():
+        return pd.DataFrame({column: pd.Series(dtype = str) for column in columns})
+    with open(path, "r") as f_in:
+        data = f_in.read()
+    return pd.read_csv(io.StringIO(data[:data.rfind("\n") + 1]), sep = "\t", header = None, names = columns, dtype = str, keep_default_na = False)
+
+
+# Start offset of every allele in alleles.u8 from their lengths
+def allele_offsets(alleles):
+    offsets = np.zeros(len(alleles) + 1, dtype = np.int64)
+    offsets[1:] = np.cumsum(alleles["Length"].astype(np.int64).to_numpy() + 1)
+    return offsets
+
+
+# Digest an allele is matched on
+def allele_digest(seq):
+    return hashlib.blake2b(seq, digest_size = 16).hexdigest()
+
+
+# Add the 16S copies of a run's genomes that are not yet in the atlas
+def add_genomes(store, domain, genus, files_16S, species_map, logger):
+    directory = atlas_dir(store, domain)
+    directory.mkdir(parents = True, exist_ok = True)
+    with open(directory / ".lock", "w") as f_lock:
+        fcntl.flock(f_lock, fcntl.LOCK_EX) # another run may be adding genomes to the same store
+        copies = read_table(directory / "copies.tsv", COPY_COLUMNS)
+        alleles = read_table(directory / "alleles.tsv", ALLELE_COLUMNS)
+        known = set(copies["Accession"])
+        files_16S = [f for f in files_16S if Path(f).parent.name not in known]
+        if not files_16S:
+            return 0
+
+        # Alleles are matched on their digests so the sequences already in the atlas are never read
+        offsets = allele_offsets(alleles)
+        with open(directory / "alleles.u8", "ab") as f_text:
+            f_text.truncate(offsets[-1]) # drop anything a killed run appended without recording it
+        allele_index = dict(zip(alleles["Digest"], range(len(alleles))))
+
+        new_alleles, new_copies = [], []
+        for file in files_16S:
+            accession = Path(file).parent.name
+            records = list(primer_match.read_fasta([file]))
+            if not records:
+                # Genomes barrnap found no 16S gene in are kept (as allele -1) so they still count as genomes of their genus
+                new_copies.append(f"{accession}\t{genus.split('_')[0]}\t{species_map.get(accession, 'sp.')}\t0\t-1\t\n")
+            for label, seq in records:
+                seq = primer_match.clean_sequence(seq).tobytes()
+                digest = allele_digest(seq)
+                if digest not in allele_index:
+                    allele_index[digest] = len(allele_index)
+                    new_alleles.append(seq)
+                fields = label.split("_")
+                species = species_map.get(accession, fields[5] if len(fields) > 5 else "sp.")
+                new_copies.append(f"{accession}\t{genus.split('_')[0]}\t{species}\t{fields[-1]}\t{allele_index[digest]}\t{label}\n")
+
+        # Sequences go in before the rows that point at them
+        with open(directory / "alleles.u8", "ab") as f_text:
+            for seq in new_alleles:
+                f_text.write(seq + bytes([primer_match.SEPARATOR]))
+        with open(directory / "alleles.tsv", "a") as f_out:
+            f_out.write("".join(f"{len(alleles) + i}\t{len(seq)}\t{allele_digest(seq)}\n" for i, seq in enumerate(new_alleles)))
+        with open(directory / "copies.tsv", "a") as f_out:
+            f_out.write("".join(new_copies))
+    logger.info(f"Added {len(new_copies)} 16S copies ({len(new_alleles)} new alleles) of {len(files_16S)} genomes to the 16S atlas of {store}\n\n")
+    return len(files_16S)
+
+
+# Read the atlas, the alleles are memory mapped
+def load_atlas(store, domain):
+    directory = atlas_dir(store, domain)
+    copies = read_table(directory / "copies.tsv", COPY_COLUMNS)
+    alleles = read_table(directory / "alleles.tsv", ALLELE_COLUMNS)
+    offsets = allele_offsets(alleles)
+    copies = copies[copies["Allele"].astype(np.int64) < len(alleles)]
+    text = np.memmap(directory / "alleles.u8", dtype = np.uint8, mode = "r", shape = (int(offsets[-1]),)) if offsets[-1] else np.zeros(0, dtype = np.uint8)
+    return {"text": text, "offsets": offsets, "copies": copies}
+
+
+# Copies of the given genera (all of them if none are given), optionally only of some species
+def atlas_slice(atlas, genera = None, species = None):
+    copies = atlas["copies"]
+    if genera:
+        copies = copies[copies["Genus"].isin(genera)]
+    if species:
+        copies = copies[copies["Species"].isin(species)]
+    return copies
+
+
+# Sequences of some alleles
+def allele_sequences(atlas, alleles):
+    text, offsets = atlas["text"], atlas["offsets"]
+    return [np.asarray(text[offsets[a]:offsets[a + 1] - 1]).tobytes() for a in alleles]
@@ -3,25 +3,40 @@
 To add:
     When a barrnap result file ends up empty(or just no 16S maybe?) take note and warn then user to check the barrnap logs and write to the logs which file had no 16S in it
 """
-import multiprocessing
 import subprocess
 from pathlib import Path
 import shlex
+import os
+from ribdif import resources, journal, store
 
 
 # Spawning the shell call
 def call_proc_barrnap(infile):
     # Building the command
-    command = f"barrnap --kingdom bac --quiet --threads 1 --reject 0.90 -outseq {infile}.rRNA {infile}"
+    command = f"barrnap --kingdom bac --quiet --threads 1 --reject 0.90 -outseq {infile}.rRNA.tmp-{os.getpid()} {infile}"
     # Passing the command to shell piping the stdout and stderr
     subprocess.run(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # Only move the output into place once barrnap has finished with it
+    if Path(f"{infile}.rRNA.tmp-{os.getpid()}").is_file():
+        os.replace(f"{infile}.rRNA.tmp-{os.getpid()}", f"{infile}.rRNA")
     return
 
-# Multithreading the barrnap calls
-def barnap_call(outdir, threads):
-    with multiprocessing.Pool(threads) as pool: # spawn the pool
-        all_fna = [str(i) for i in list(Path(f"{outdir}/refseq/bacteria/").glob('*/*.fna'))] # generate list of files ending in .rna
-        pool.map(call_proc_barrnap, all_fna)
+# Multithreading the barrnap calls within the core and memory budget
+# Genomes already checkpointed in the journal state are skipped when resuming, and with reuse genomes whose rRNA is newer than the genome (made while downloading or linked from the genome store)
+def barnap_call(outdir, budget, logger = None, state = None, reuse = False):
+    all_fna = [str(i) for i in list(Path(f"{outdir}/refseq/bacteria/").glob('*/*.fna'))] # generate list of files ending in .rna
+    rRNA_out = lambda fna: f"{fna}.rRNA"
+    if state is not None:
+        all_fna = journal.pending_genomes(state, "barrnap", all_fna, rRNA_out)
+    if reuse:
+        all_fna = [fna for fna in all_fna if not store.is_fresh(f"{fna}.rRNA", fna)]
+    costs = [resources.genome_memory(fna, "barrnap") for fna in all_fna] # estimate memory of each call from genome size
+    
+    # Checkpoint each genome as it finishes
+    def checkpoint(i, result):
+        if state is not None:
+            journal.record_genome(outdir, state, "barrnap", all_fna[i], rRNA_out)
+    resources.budget_starmap(call_proc_barrnap, zip(all_fna), costs, budget, logger, checkpoint)
     return
         
 
@@ -29,13 +44,13 @@ def barnap_call(outdir, threads):
 def barrnap_process(in_RNA):
     count = 0 # genome wide count: we are not going to use this
     #GCF = str(Path(in_RNA).parent).split(r"/")[-1]
-    with open(in_RNA, "r") as f_in, open(f"{in_RNA}.16S", "w") as f_out: 
+    with open(in_RNA, "r") as f_in, journal.atomic_write(f"{in_RNA}.16S") as f_out: 
         for line in f_in:
             if line.startswith(">16S_rRNA"):
                 f_out.write(">" + line.strip().strip(">16S_rRNA::").split(":")[0] + f"_{count}\n") # write the fasta header to file removing >16S_rRNA:: and adding a counter
                 f_out.write(next(f_in)) # write next line also
                 count += 1 # incriment count by one
-    return
+    return in_RNA
 
 # Splits barrnap output sequences from barrnap_process output
 def barrnap_split(in_16S):
@@ -55,7 +70,7 @@ def barrnap_conc(genus, outdir):
     all_16S = [str(i) for i in list(Path(f"{outdir}/refseq/bacteria/").glob('*/*.16S'))]
     full_path = Path(f"{outdir}/full")
     full_path.mkdir(parents = True, exist_ok = True)
-    with open(f"{full_path}/{genus}.16S", "w") as f_out:
+    with journal.atomic_write(f"{full_path}/{genus}.16S") as f_out:
         for file in all_16S:
             with open(file, "r") as f_in:
                 f_out.write(f_in.read())
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+import copy
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+from ribdif import incidence, journal, logging_config, ngd_download, resources, store, utils
+
+# Batch runs over a file of genera, prefetching the next genus' genomes into the genome store while the current one runs
+
+SUMMARY_NAME = "batch_summary.tsv"
+SUMMARY_COLUMNS = ["Genus", "Status", "Primer", "genomes", "named_genomes", "species", "amplified", "amplification_rate", "amplicons",
+                   "alleles", "multi_allele_genomes", "amplified_species", "overlapping_species", "resolved_species"]
+
+
+# Genera of the batch file, skipping blank and commented lines and repeats
+def read_genera(path):
+    genera = []
+    with open(path, "r") as f_in:
+        for line in f_in:
+            line = " ".join(line.split("#")[0].split())
+            if line and line not in genera:
+                genera.append(line)
+    return genera
+
+
+# Fetch a genus' genomes into the store, ahead of its run. Failures are left for the run's own download to report
+def prefetch(genus, args, genome_store, parallel, logger):
+    try:
+        return ngd_download.prefetch(genus, genome_store, parallel, args.frag, args.domain, logger, args.ncbi_uri, args.sp_ignore,
+                                     None if args.dereplicate is not None else args.max_per_species,
+                                     args.assembly_levels.split(",") if args.assembly_levels else None)
+    except Exception:
+        logger.warning(f"Could not prefetch the {genus} genomes, they will be downloaded by its run\n", exc_info = True)
+        return 0
+
+
+# Summary rows of a finished genus: the overlap report numbers of each of its primers
+def genus_rows(genus, outdir, domain, status):
+    name = genus.replace(" ", "_")
+    primers = incidence.saved_primers(outdir, name) if status == "done" else []
+    if not primers:
+        return [{"Genus": genus, "Status": status if status != "done" else "no amplification", "Primer": "-"}]
+    species_map = ngd_download.metadata_species(outdir)
+    genome_species = {fna.parent.name: species_map.get(fna.parent.name) or utils.sp_check(fna) for fna in Path(f"{outdir}/refseq/{domain}").glob("*/*.fna")}
+    rows = []
+    for primer in primers:
+        counts, gcfs, species = incidence.load_incidence(outdir, name, primer)
+        cluster_df, gcf_species = incidence.filtered_clusters(counts, gcfs, species, incidence.genome_mask(gcfs, species))
+        rows.append({"Genus": genus, "Status": status, "Primer": primer, **incidence.report_stats(cluster_df, gcf_species, {**dict(zip(gcfs, species)), **genome_species})})
+    return rows
+
+
+def write_summary(path, rows):
+    with journal.atomic_write(path) as f_out:
+        f_out.write("\t".join(SUMMARY_COLUMNS) + "\n")
+        for row in rows:
+            f_out.write("\t".join(str(row.get(column, "NA")) for column in SUMMARY_COLUMNS) + "\n")
+
+
+# Run every genus of the batch file through run_pipeline, prefetching the next genus' genomes while the current one runs
+def run_batch(args, workingDir, logger, run_pipeline):
+    genera = read_genera(args.genus)
+    if not genera:
+        logger.error(f"{args.genus} lists no genera to run")
+        raise SystemExit(1)
+    base = Path(f"{Path.cwd()}/results") if args.outdir == "False" else Path(args.outdir)
+    base.mkdir(parents = True, exist_ok = True)
+    genome_store = store.store_path(args.genome_store or str(base / "genome_store"))
+    args.genome_store = str(genome_store)
+    fetch = not args.rerun and not args.report_only
+    parallel = resources.download_parallel(resources.make_budget(args.threads, args.memory))
+    logger.info(f"Running {len(genera)} genera as a batch: {', '.join(genera)}. Genomes are downloaded into {genome_store}\n\n")
+
+    rows = []
+    with ThreadPool(1) as prefetch_pool:
+        prefetched = None
+        for i, genus in enumerate(genera):
+            if prefetched is not None:
+                prefetched.wait() # the run must not download the genomes the prefetch is still fetching
+            prefetched = prefetch_pool.apply_async(prefetch, (genera[i + 1], args, genome_store, parallel, logger)) if fetch and i + 1 < len(genera) else None
+            if i > 0:
+                logging_config.reset_log_file(workingDir, logger)
+            genus_args = copy.copy(args)
+            genus_args.genus = genus
+            try:
+                run_pipeline(genus_args, workingDir, logger)
+                status = "done"
+            except SystemExit as error:
+                status = f"failed ({error.code})" if error.code not in (None, 0) else "done"
+            except Exception:
+                logger.error(f"{genus} failed, moving on to the next genus\n", exc_info = True)
+                status = "failed"
+            rows.extend(genus_rows(genus, base / genus.replace(" ", "_"), args.domain, status))
+            write_summary(base / SUMMARY_NAME, rows)
+            logger.info(f"\n{genus} {status} ({i + 1}/{len(genera)} genera). The batch summary is at {base / SUMMARY_NAME}\n\n")
+    failed = len({row["Genus"] for row in rows if row["Status"].startswith("failed")})
+    if failed:
+        logger.warning(f"{failed} of {len(genera)} genera failed, see their log files\n")
+    return
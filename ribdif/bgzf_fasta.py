@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+import os
+import struct
+import zlib
+from bisect import bisect_right
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+
+# Block gzipped (BGZF) fasta files with samtools style .fai and .gzi indexes
+
+BLOCK_SIZE = 0xff00 # uncompressed bytes per block, as bgzip uses
+BATCH = 256 # blocks handed to the threads at a time, bounding the memory of large genomes
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+HEADER = struct.Struct("<4BI2BH2BHH") # gzip header with the BGZF extra field holding the block size
+
+
+def fai_path(path):
+    return f"{path}.fai"
+
+
+def gzi_path(path):
+    return f"{path}.gzi"
+
+
+# One BGZF member holding a chunk of the file
+def compress_block(data, level = 6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord("B"), ord("C"), 2, HEADER.size + len(deflated) + 8 - 1)
+    return header + deflated + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+def inflate_block(block):
+    return zlib.decompress(block[HEADER.size:-8], -15)
+
+
+# Split a plain fasta into block sized chunks, collecting the .fai rows of its records on the way.
+# A record whose lines are not all the same length (bar its last) cannot be indexed and marks the whole file as such
+def fasta_chunks(fna, fai):
+    buffer, offset, record = bytearray(), 0, None
+    with open(fna, "rb") as f_in:
+        for line in f_in:
+            if line.startswith(b">"):
+                if record:
+                    fai.append(record)
+                record = [line[1:].split()[0].decode(), 0, offset + len(line), None, None, False, False] # name, length, offset, line bases, line width, irregular, short line seen
+            elif record is not None:
+                bases = len(line.rstrip(b"\r\n"))
+                if record[3] is None:
+                    record[3], record[4] = bases, len(line)
+                elif record[6]: # only the last line may be short
+                    record[5] = True
+                elif bases != record[3] or len(line) != record[4]:
+                    record[5], record[6] = record[5] or bases > record[3], True
+                record[1] += bases
+            offset += len(line)
+            buffer += line
+            while len(buffer) >= BLOCK_SIZE:
+                yield bytes(buffer[:BLOCK_SIZE])
+                del buffer[:BLOCK_SIZE]
+    if record:
+        fai.append(record)
+    if buffer:
+        yield bytes(buffer)
+
+
+# Compress a plain fasta to BGZF with its .fai and .gzi, moving each file into place only once it is complete
+def pack(fna, bgz, threads = 1):
+    fai, offsets = [], []
+    tmp = f"{bgz}.tmp-{os.getpid()}"
+    with open(tmp, "wb") as f_out, ThreadPool(max(1, threads)) as pool:
+        compressed = uncompressed = 0
+        for chunk, block in pool.imap(lambda chunk: (len(chunk), compress_block(chunk)), fasta_chunks(fna, fai), chunksize = 4):
+            offsets.append((compressed, uncompressed))
+            f_out.write(block)
+            compressed += len(block)
+            uncompressed += chunk
+        f_out.write(EOF_BLOCK)
+    with open(f"{tmp}.gzi", "wb") as f_out:
+        f_out.write(struct.pack("<Q", max(len(offsets) - 1, 0))) # the first block, at 0 0, is implied
+        for pair in offsets[1:]:
+            f_out.write(struct.pack("<QQ", *pair))
+    os.replace(f"{tmp}.gzi", gzi_path(bgz))
+    if fai and not any(record[5] for record in fai):
+        with open(f"{tmp}.fai", "w") as f_out:
+            for name, length, start, linebases, linewidth, _, _ in fai:
+                f_out.write(f"{name}\t{length}\t{start}\t{linebases or 0}\t{linewidth or 0}\n")
+        os.replace(f"{tmp}.fai", fai_path(bgz))
+    else:
+        Path(fai_path(bgz)).unlink(missing_ok = True)
+    os.replace(tmp, bgz)
+    return bgz
+
+
+# Compressed and uncompressed start of every block, from the .gzi or, without one, by walking the block headers
+def block_offsets(bgz):
+    if os.path.getsize(bgz) <= len(EOF_BLOCK):
+        return []
+    if Path(gzi_path(bgz)).is_file():
+        with open(gzi_path(bgz), "rb") as f_in:
+            count = struct.unpack("<Q", f_in.read(8))[0]
+            offsets = [(0, 0)] + [struct.unpack("<QQ", f_in.read(16)) for _ in range(count)]
+        return offsets
+    offsets, compressed, uncompressed = [], 0, 0
+    with open(bgz, "rb") as f_in:
+        while True:
+            header = f_in.read(HEADER.size)
+            if len(header) < HEADER.size:
+                break
+            block_size = HEADER.unpack(header)[-1] + 1
+            f_in.seek(compressed + block_size - 4)
+            size = struct.unpack("<I", f_in.read(4))[0]
+            if size:
+                offsets.append((compressed, uncompressed))
+            compressed += block_size
+            uncompressed += size
+            f_in.seek(compressed)
+    return offsets
+
+
+# Read the blocks from first up to (not including) last, inflating them on the threads
+def read_blocks(f_in, offsets, first, last, end, pool):
+    start = offsets[first][0]
+    stop = offsets[last][0] if last < len(offsets) else end
+    f_in.seek(start)
+    data = f_in.read(stop - start)
+    bounds = [offsets[i][0] - start for i in range(first, last)] + [stop - start]
+    blocks = [data[bounds[i]:bounds[i + 1]] for i in range(len(bounds) - 1)]
+    return pool.map(inflate_block, blocks) if pool else [inflate_block(block) for block in blocks]
+
+
+# Decompress a BGZF file back to plain text, its blocks inflated in parallel
+def unpack(bgz, fna, threads = 1):
+    offsets = block_offsets(bgz)
+    end = os.path.getsize(bgz) - len(EOF_BLOCK)
+    tmp = f"{fna}.tmp-{os.getpid()}"
+    with open(bgz, "rb") as f_in, open(tmp, "wb") as f_out, ThreadPool(max(1, threads)) as pool:
+        for first in range(0, len(offsets), BATCH):
+            for data in read_blocks(f_in, offsets, first, min(first + BATCH, len(offsets)), end, pool):
+                f_out.write(data)
+    os.replace(tmp, fna)
+    return fna
+
+
+# The .fai of a BGZF fasta as name -> (length, offset, line bases, line width), and its block offsets
+def load_index(bgz):
+    if not Path(fai_path(bgz)).is_file():
+        raise ValueError(f"{bgz} has no .fai, its records do not have regular line lengths")
+    fai = {}
+    with open(fai_path(bgz), "r") as f_in:
+        for line in f_in:
+            name, length, offset, linebases, linewidth = line.split("\t")
+            fai[name] = (int(length), int(offset), int(linebases), int(linewidth))
+    offsets = block_offsets(bgz)
+    return {"fai": fai, "offsets": offsets, "starts": [u for _, u in offsets], "end": os.path.getsize(bgz) - len(EOF_BLOCK)}
+
+
+# Sequence of a contig from start to end (0 based, end exclusive) inflating only the blocks it is in
+def fetch(bgz, contig, start, end, index = None):
+    index = index or load_index(bgz)
+    length, offset, linebases, linewidth = index["fai"][contig]
+    start, end = max(0, start), min(end, length)
+    if start >= end:
+        return ""
+    first_byte = offset + start // linebases * linewidth + start % linebases
+    last_byte = offset + (end - 1) // linebases * linewidth + (end - 1) % linebases + 1
+    starts = index["starts"]
+    first, last = bisect_right(starts, first_byte) - 1, bisect_right(starts, last_byte - 1)
+    with open(bgz, "rb") as f_in:
+        data = b"".join(read_blocks(f_in, index["offsets"], first, last, index["end"], None))
+    region = data[first_byte - starts[first]:last_byte - starts[first]]
+    return region.replace(b"\n", b"").replace(b"\r", b"").decode()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+from itertools import repeat
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from ribdif import primer_match, resources, journal
+from ribdif.utils import detect_encode
+
+# Best binding site of each primer in every genome, bit parallel over the genome, so a failed amplification can be explained
+
+BINDING_SUFFIX = "_binding.tsv"
+BINDING_COLUMNS = ["FwdMismatches", "FwdSites", "FwdSite", "Fwd3Mismatches", "RvsMismatches", "RvsSites", "RvsSite", "Rvs3Mismatches"]
+WORD = 64
+
+
+# Pack a boolean array into little endian 64 bit words, with spare words so shifted reads never run off the end
+def pack_bits(bits, spare):
+    packed = np.packbits(bits, bitorder = "little")
+    words = np.zeros(-(-len(bits) // WORD) + spare, dtype = np.uint64)
+    words.view(np.uint8)[:len(packed)] = packed
+    return words
+
+
+# Bit j of the result is bit j + shift of the plane
+def shifted(plane, shift, n_words):
+    q, r = divmod(shift, WORD)
+    if r == 0:
+        return plane[q:q + n_words]
+    return (plane[q:q + n_words] >> np.uint64(r)) | (plane[q + 1:q + 1 + n_words] << np.uint64(WORD - r))
+
+
+# Base planes of a genome's concatenated sequences, separators and the padding at the end count as a plane of their own
+def genome_planes(codes, max_length):
+    spare = -(-max_length // WORD) + 1
+    bits = np.zeros(len(codes) + max_length, dtype = np.uint8)
+    planes = {}
+    for base in (1, 2, 4, 8):
+        bits[:len(codes)] = (codes & base) != 0
+        planes[base] = pack_bits(bits, spare)
+    bits[:len(codes)] = codes == 0
+    bits[len(codes):] = 1
+    planes[0] = pack_bits(bits, spare)
+    return planes, -(-len(codes) // WORD)
+
+
+# Start positions of the windows set in a word mask
+def mask_positions(mask):
+    words = np.flatnonzero(mask)
+    bits = np.unpackbits(mask[words].view(np.uint8), bitorder = "little").reshape(-1, WORD)
+    rows, cols = np.nonzero(bits)
+    return words[rows] * WORD + cols
+
+
+# Best sites of an oligo: the fewest mismatches (None if more than the limit) and the windows with that many
+def best_sites(planes, n_words, oligo, max_mismatches):
+    primer_codes = primer_match.PRIMER_CODES[np.frombuffer(oligo.encode(), dtype = np.uint8)]
+    n_bits = (max_mismatches + 1).bit_length()
+    counter = [np.zeros(n_words, dtype = np.uint64) for _ in range(n_bits)]
+    overflow = np.zeros(n_words, dtype = np.uint64)
+    invalid = np.zeros(n_words, dtype = np.uint64)
+    for i, code in enumerate(primer_codes):
+        invalid |= shifted(planes[0], i, n_words) # windows over a separator or off the end
+        if code & 16: # N matches any base
+            continue
+        match = np.zeros(n_words, dtype = np.uint64)
+        for base in (1, 2, 4, 8):
+            if code & base:
+                match |= shifted(planes[base], i, n_words)
+        # Add the mismatches into the bit sliced counter, anything carried out of the top sticks in overflow
+        carry = ~match
+        for j in range(n_bits):
+            counter[j], carry = counter[j] ^ carry, counter[j] & carry
+        overflow |= carry
+    usable = ~(invalid | overflow)
+    for mismatches in range(max_mismatches + 1):
+        mask = usable.copy()
+        for j in range(n_bits):
+            mask &= counter[j] if mismatches >> j & 1 else ~counter[j]
+        if mask.any():
+            return mismatches, mask_positions(mask)
+    return None, np.zeros(0, dtype = np.int64)
+
+
+# Best sites of a primer on either strand, with the mismatches of the first of them counted from the primer's 3' end
+def primer_binding(planes, n_words, codes, offsets, labels, primer, max_mismatches):
+    primer = primer_match.clean_primer(primer)
+    results = []
+    for strand, oligo in (("+", primer), ("-", primer_match.revcomp(primer))):
+        mismatches, positions = best_sites(planes, n_words, oligo, max_mismatches)
+        if mismatches is not None:
+            results.append((mismatches, strand, oligo, positions))
+    if not results:
+        return [f">{max_mismatches}", "0", "-", "-"]
+    best = min(result[0] for result in results)
+    hits = [result for result in results if result[0] == best]
+    mismatches, strand, oligo, positions = hits[0]
+    site = int(positions[0])
+    oligo_codes = primer_match.PRIMER_CODES[np.frombuffer(oligo.encode(), dtype = np.uint8)]
+    missed = np.flatnonzero((codes[site:site + len(oligo)] & oligo_codes) == 0)
+    # On the plus strand the primer's 3' end is the right end of the site, on the minus strand the left
+    three_prime = sorted((len(oligo) - missed) if strand == "+" else (missed + 1))
+    sequence = primer_match.sequence_of(site, offsets)
+    return [str(best), str(sum(len(hit[3]) for hit in hits)), f"{labels[sequence]}:{site - offsets[sequence] + 1}({strand})",
+            ",".join(str(p) for p in three_prime) or "-"]
+
+
+# Binding report rows of one genome for every primer, named from its headers as the summaries name it
+def genome_binding(genome_file, primers, max_mismatches):
+    records = list(primer_match.read_fasta([genome_file]))
+    fields = records[0][0].split("_") if records else []
+    gcf = "_".join(fields[:2]) if len(fields) > 5 else Path(genome_file).parent.name
+    genus, species = (fields[4], fields[5]) if len(fields) > 5 else ("-", "sp.")
+    _, codes, offsets = primer_match.encode_sequences([seq for _, seq in records])
+    labels = [label for label, _ in records]
+    max_length = max(len(primer_match.clean_primer(p)) for _, fwd, rvs in primers for p in (fwd, rvs))
+    planes, n_words = genome_planes(codes, max_length)
+    rows = {}
+    for name, fwd, rvs in primers:
+        rows[name] = primer_binding(planes, n_words, codes, offsets, labels, fwd, max_mismatches) + \
+                     primer_binding(planes, n_words, codes, offsets, labels, rvs, max_mismatches)
+    return gcf, genus, species, rows
+
+
+# Name, forward and reverse primer of every line of a primer file
+def read_primers(primer_file):
+    with open(primer_file, "r", encoding = detect_encode(primer_file)) as f_primer:
+        return [tuple(line.strip().split("\t")[:3]) for line in f_primer if line.strip()]
+
+
+# Path of a primer's binding table
+def binding_path(outdir, genus, name):
+    return f"{outdir}/{genus}_{name}{BINDING_SUFFIX}"
+
+
+# Search every genome for every primer within the budget and write each primer's binding table
+def binding_report(outdir, genus, primers, genome_files, max_mismatches, budget, logger):
+    logger.info(f"Searching {len(genome_files)} genomes for primer binding sites with up to {max_mismatches} mismatches\n\n")
+    costs = [resources.genome_memory(path, "pcr") for path in genome_files]
+    results = resources.budget_starmap(genome_binding, zip(genome_files, repeat(primers), repeat(max_mismatches)), costs, budget, logger)
+    tables = {}
+    for name, _, _ in primers:
+        rows = [[gcf, genus, species] + genome_rows[name] for gcf, genus, species, genome_rows in results]
+        tables[name] = pd.DataFrame(rows, columns = ["GCF", "Genus", "Species"] + BINDING_COLUMNS).sort_values("GCF")
+        with journal.atomic_write(binding_path(outdir, genus, name)) as f_out:
+            tables[name].to_csv(f_out, sep = "\t", index = False)
+    return tables
+
+
+# Add the binding sites to a primer's amplicon summary, genomes that did not amplify get a row of their own
+def add_to_summary(summary_path, binding_file, user):
+    summary = pd.read_csv(summary_path, sep = "\t", dtype = str, keep_default_na = False)
+    binding = pd.read_csv(binding_file, sep = "\t", dtype = str, keep_default_na = False)
+    if user: # the summary names user genomes without the GCF_ prefix
+        binding["GCF"] = binding["GCF"].str.replace("GCF_", "")
+    failed = binding.loc[~binding["GCF"].isin(summary["GCF"]), ["GCF", "Genus", "Species"]].assign(**{"#amp": "0"})
+    summary = pd.concat([summary, failed], ignore_index = True).fillna("-")
+    summary = summary.merge(binding.drop(columns = ["Genus", "Species"]), on = "GCF", how = "left").fillna("-")
+    with journal.atomic_write(summary_path) as f_out:
+        summary.to_csv(f_out, sep = "\t", index = False)
+    return
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+import multiprocessing
+import shutil
+from pathlib import Path
+import numpy as np
+from ribdif import journal
+
+# MinHash dereplication of near identical genomes within a species, keeping one representative per cluster
+
+KMER = 21
+SKETCH_SIZE = 1000
+DEREP_NAME = "dereplication.tsv"
+
+# 2 bit encoding of nucleotides, anything else (N, IUPAC codes) is 4 and breaks the k-mer
+ENCODE = np.full(256, 4, dtype = np.uint8)
+for i, base in enumerate(b"ACGT"):
+    ENCODE[base] = i
+    ENCODE[ord(chr(base).lower())] = i
+
+
+# splitmix64 finalizer to spread the k-mer integers evenly over the hash space
+def mix64(values):
+    values = values.copy()
+    values ^= values >> np.uint64(30)
+    values *= np.uint64(0xbf58476d1ce4e5b9)
+    values ^= values >> np.uint64(27)
+    values *= np.uint64(0x94d049bb133111eb)
+    values ^= values >> np.uint64(31)
+    return values
+
+
+# Hash every canonical k-mer of a contig that contains only ACGT and keep the smallest hashes
+def sketch_contig(seq, k = KMER, size = SKETCH_SIZE):
+    codes = ENCODE[np.frombuffer(seq, dtype = np.uint8)]
+    n_kmers = len(codes) - k + 1
+    if n_kmers <= 0:
+        return np.empty(0, dtype = np.uint64)
+    # A k-mer is valid if no ambiguous base falls within it
+    ambiguous = np.concatenate([[0], np.cumsum(codes == 4)])
+    valid = (ambiguous[k:] - ambiguous[:-k]) == 0
+    bases = (codes & 3).astype(np.uint64)
+    forward = np.zeros(n_kmers, dtype = np.uint64)
+    reverse = np.zeros(n_kmers, dtype = np.uint64)
+    for j in range(k):
+        forward = (forward << np.uint64(2)) | bases[j:j + n_kmers]
+        reverse |= (np.uint64(3) - bases[j:j + n_kmers]) << np.uint64(2 * j) # complement, read backwards
+    hashes = mix64(np.minimum(forward, reverse)[valid])
+    return bottom(hashes, size)
+
+
+# Smallest unique hashes, partitioning first so only a few candidates need sorting rather than the whole genome
+def bottom(hashes, size):
+    if len(hashes) > size * 4:
+        candidates = np.unique(np.partition(hashes, size * 4)[:size * 4])
+        if len(candidates) >= size: # repeats (e.g. rRNA operons) could leave us short, then fall back to the full set
+            return candidates[:size]
+    return np.unique(hashes)[:size] # np.unique sorts
+
+
+# Sketch a whole genome, returning its sketch, contig count and length so representatives can favour complete genomes
+def sketch_genome(fna, k = KMER, size = SKETCH_SIZE):
+    sketches, contigs, length, seq = [], 0, 0, []
+    with open(fna, "rb") as f_in:
+        for line in f_in:
+            if line.startswith(b">"):
+                if seq:
+                    sketches.append(sketch_contig(b"".join(seq), k, size))
+                contigs += 1
+                seq = []
+            else:
+                seq.append(line.strip())
+                length += len(seq[-1])
+    if seq:
+        sketches.append(sketch_contig(b"".join(seq), k, size))
+    sketch = bottom(np.concatenate(sketches), size) if sketches else np.empty(0, dtype = np.uint64)
+    return fna, sketch, contigs, length
+
+
+# Mash distance from the Jaccard index estimated between one sketch and a stack of sketches.
+# As in Mash the estimate is the share of the bottom sketch of the union that is in both sketches
+def mash_distance(sketch, others, others_len, k = KMER, size = SKETCH_SIZE):
+    jaccard = np.zeros(len(others))
+    for j, row in enumerate(others):
+        row = row[:others_len[j]]
+        union = np.union1d(sketch, row)[:size]
+        if len(union):
+            shared = np.intersect1d(sketch, row, assume_unique = True)
+            jaccard[j] = (shared <= union[-1]).sum() / len(union)
+    with np.errstate(divide = "ignore"):
+        distance = -np.log(2 * jaccard / (1 + jaccard)) / k
+    return np.where(jaccard > 0, distance, 1.0)
+
+
+# Greedily cluster genomes of one species: each genome joins the closest representative within max_dist or becomes one
+def greedy_cluster(genomes, sketches, max_dist, max_reps = None):
+    reps = []
+    members = {}
+    # Pad sketches to a matrix so the distance to every representative is one vectorised call
+    width = max((len(s) for s in sketches.values()), default = 0)
+    rep_matrix = np.full((len(genomes), width), np.iinfo(np.uint64).max, dtype = np.uint64)
+    rep_len = np.zeros(len(genomes), dtype = np.int64)
+    for genome in genomes:
+        sketch = sketches[genome]
+        if reps:
+            dist = mash_distance(sketch, rep_matrix[:len(reps)], rep_len[:len(reps)])
+            closest = int(np.argmin(dist))
+            # Join the closest cluster if near enough, or if we are capping the number of representatives and are at the cap
+            if dist[closest] <= max_dist or (max_reps and len(reps) >= max_reps):
+                members[reps[closest]].append(genome)
+                continue
+        rep_matrix[len(reps), :len(sketch)] = sketch
+        rep_len[len(reps)] = len(sketch)
+        reps.append(genome)
+        members[genome] = [genome]
+    return members
+
+
+# Sketch and cluster all genomes in the run directory within each species and set aside everything that is not a representative
+def dereplicate(outdir, domain, species_map, max_dist, threads, logger, max_reps = None):
+    all_fna = sorted(str(i) for i in Path(f"{outdir}/refseq/{domain}/").glob('*/*.fna'))
+    logger.info(f"Sketching {len(all_fna)} genomes for dereplication at a Mash distance of {max_dist}\n")
+    with multiprocessing.Pool(threads) as pool:
+        results = pool.map(sketch_genome, all_fna)
+
+    sketches = {Path(fna).parent.name: sketch for fna, sketch, _, _ in results}
+    # Complete genomes (fewest contigs) and then the longest are looked at first so they become the representatives
+    order = [Path(fna).parent.name for fna, _, contigs, length in sorted(results, key = lambda r: (r[2], -r[3], r[0]))]
+
+    by_species = {}
+    for gcf in order:
+        by_species.setdefault(species_map.get(gcf, "sp."), []).append(gcf)
+    clusters = {}
+    for species, genomes in by_species.items():
+        clusters.update(greedy_cluster(genomes, sketches, max_dist, max_reps))
+
+    # Move non representatives out of the way so no later stage sees them
+    derep_dir = Path(f"{outdir}/dereplicated")
+    derep_dir.mkdir(exist_ok = True)
+    weights = {}
+    with journal.atomic_write(f"{outdir}/{DEREP_NAME}") as f_out:
+        f_out.write("GCF\tRepresentative\tSpecies\tClusterSize\n")
+        for rep, genomes in clusters.items():
+            weights[rep] = len(genomes)
+            for gcf in genomes:
+                f_out.write(f"{gcf}\t{rep}\t{species_map.get(gcf, 'sp.')}\t{len(genomes)}\n")
+                if gcf != rep:
+                    shutil.rmtree(derep_dir / gcf, ignore_errors = True) # left by an earlier dereplication
+                    shutil.move(f"{outdir}/refseq/{domain}/{gcf}", derep_dir / gcf)
+    logger.info(f"Kept {len(clusters)} representatives of {len(all_fna)} genomes after dereplication\n\n")
+    return weights
+
+
+# Read back the cluster size of each representative and the species of every genome (representative or not) from a previous dereplication
+def derep_weights(outdir):
+    weights, all_species = {}, []
+    if not Path(f"{outdir}/{DEREP_NAME}").is_file():
+        return weights, all_species
+    with open(f"{outdir}/{DEREP_NAME}", "r") as f_in:
+        next(f_in)
+        for line in f_in:
+            gcf, rep, species, size = line.rstrip("\n").split("\t")
+            weights[rep] = int(size)
+            all_species.append(species)
+    return weights, all_species
+
+
+# Read back the representative and species of every genome (representative or not) from a previous dereplication
+def derep_members(outdir):
+    members = {}
+    if not Path(f"{outdir}/{DEREP_NAME}").is_file():
+        return members
+    with open(f"{outdir}/{DEREP_NAME}", "r") as f_in:
+        next(f_in)
+        for line in f_in:
+            gcf, rep, species, _ = line.rstrip("\n").split("\t")
+            members[gcf] = (rep, species)
+    return members
@@ -10,9 +10,23 @@ import matplotlib.pyplot as plt
 import fastcluster
 from matplotlib.backends.backend_pdf import PdfPages
 import networkx as nx
-from itertools import combinations
 import sys
-from scipy.sparse import dok_matrix
+from multiprocessing.pool import ThreadPool
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from matplotlib.collections import LineCollection
+from matplotlib.patches import Patch
+
+# Above this many genomes the heatmaps are drawn from collapsed allele profiles instead of one row per genome
+LARGE_GENUS = 1000
+# Heatmap images are binned down to at most this many pixels along each axis
+MAX_PIXELS = 2000
+# Only label heatmap rows when there are few enough to read
+MAX_LABELS = 150
+# Graphs are drawn page by page in the large mode once there are more components than fit on one readable page
+GRAPHS_PER_PAGE = 25
+# Components bigger than this are laid out spectrally (sparse eigenvectors) rather than by force direction
+LARGE_COMPONENT = 2000
 
 def heatmap_meta(gcf_species):
     # Turn gcf species cross dictionary into series
@@ -125,55 +139,190 @@ def pdf_save(plot_clus, plot_dendo, outdir, genus, name):
     plots = [plot_clus, plot_dendo]
     with PdfPages(f"{outdir}/figures/{genus}-{name}_heatmaps.pdf") as pdf_pages:
         for plot in plots:
-            pdf_pages.savefig(plot.fig)
+            pdf_pages.savefig(getattr(plot, "fig", plot)) # seaborn clustermaps or plain figures from the large genus mode
+            plt.close(getattr(plot, "fig", plot))
     return
 
-# =============================================================================
-# def create_adjacency(pairwise_df, cluster_df):
-#     # Create new dataframe filled with the zame index and column as pairwise_df but filled with 0s
-#     adjacency_df = pd.DataFrame(np.zeros((len(pairwise_df), len(pairwise_df.columns))), index=pairwise_df.index, columns=pairwise_df.columns)
-#     # Get all possible pairs of indexs
-#     pairs = list(combinations(cluster_df.index,2))
-#     # For each pair mask where they both belong to the same cluster
-#     for i,j in pairs:
-#         mask = (cluster_df.loc[i] > 0) & (cluster_df.loc[j] > 0)
-#         adjacency_df[j][i] = mask.sum()
-#         adjacency_df[i][j] = mask.sum()
-#     return adjacency_df
-# =============================================================================
-
-def create_adjacency(pairwise_df, cluster_df):
-    # Create a dictionary that maps the string index to an integer index
-    index_map = {index: i for i, index in enumerate(pairwise_df.index)}
-    # Convert the cluster dataframe to a numpy array
-    cluster_arr = cluster_df.to_numpy()
-    # Create a sparse matrix with the same shape as the pairwise_df dataframe
-    adjacency_mat = dok_matrix(pairwise_df.shape, dtype=np.int32)
-    # For each pair of indices that belong to the same cluster, set the corresponding entry in the adjacency matrix to the sum of alelles they share
-    pairs = list(combinations(cluster_df.index, 2))
-    for i, j in pairs:
-        # Create a mask of values greater than 0
-        mask = (cluster_arr[index_map[i]] > 0) & (cluster_arr[index_map[j]] > 0)
-        
-        adjacency_mat[index_map[i], index_map[j]] = mask.sum()
+
+# Find genomes with identical allele profiles, returning the first genome of each profile, the profile of each genome and the profile sizes
+def profile_groups(cluster_df):
+    counts = np.ascontiguousarray(cluster_df.to_numpy(dtype = np.int32))
+    # Rows with the same bytes have the same allele copy numbers
+    row_bytes = counts.view(np.dtype((np.void, counts.shape[1] * counts.itemsize))).ravel()
+    _, first, inverse, weights = np.unique(row_bytes, return_index = True, return_inverse = True, return_counts = True)
+    return counts, first, inverse.ravel(), weights
+
+
+# Collapse genomes with identical allele profiles into one weighted row each
+def collapse_profiles(cluster_df, species_series):
+    counts, first, inverse, weights = profile_groups(cluster_df)
+    profiles = counts[first]
+    # Label each profile with its most common species, noting when others share it
+    profile_species, n_species = main_species(species_series.reindex(cluster_df.index), inverse)
+    profile_labels = [f"{s}{f' +{n - 1} sp.' if n > 1 else ''} ({w})" for s, n, w in zip(profile_species, n_species, weights)]
+    return profiles, weights, profile_species, profile_labels
+
+
+# Most common species of each profile and how many species it holds
+def main_species(species_series, inverse):
+    grouped = pd.Series(species_series.to_numpy()).groupby(inverse)
+    return list(grouped.agg(lambda s: s.value_counts().index[0])), list(grouped.nunique())
+
+
+# Order the leaves of a linkage without recursion (scipy's dendrogram recurses once per level and hits the recursion limit on large trees)
+def leaf_order(linkage, n_leaves):
+    if n_leaves < 2:
+        return list(range(n_leaves))
+    order = []
+    stack = [2 * n_leaves - 2] # root
+    while stack:
+        node = stack.pop()
+        if node < n_leaves:
+            order.append(node)
+        else:
+            left, right = linkage[node - n_leaves, :2].astype(int)
+            stack.append(right) # pushed first so the left branch is drawn first
+            stack.append(left)
+    return order
+
+
+# Draw a dendrogram iteratively from a linkage as one rasterized line collection. Leaves sit at 0.5, 1.5, ... in the given order
+def draw_dendrogram(ax, linkage, order, orientation):
+    n_leaves = len(order)
+    position = np.zeros(2 * n_leaves - 1)
+    position[order] = np.arange(n_leaves) + 0.5
+    height = np.zeros(2 * n_leaves - 1)
+    segments = []
+    # Merges are listed bottom up so children are always placed before their parent
+    for i, (left, right, dist, _) in enumerate(linkage):
+        left, right, node = int(left), int(right), n_leaves + i
+        position[node] = (position[left] + position[right]) / 2
+        height[node] = dist
+        segments.append([(position[left], height[left]), (position[left], dist), (position[right], dist), (position[right], height[right])])
+    if orientation == "left": # rows: position along y, height along x
+        segments = [[(h, p) for p, h in seg] for seg in segments]
+        ax.set_ylim(n_leaves, 0)
+        ax.set_xlim(height.max() * 1.05 if height.max() else 1, 0)
+    else:
+        ax.set_xlim(0, n_leaves)
+        ax.set_ylim(0, height.max() * 1.05 if height.max() else 1)
+    ax.add_collection(LineCollection(segments, colors = "black", linewidths = 0.3, rasterized = True))
+    ax.axis("off")
+    return
+
+
+# Bin a sparse set of (row, col) cells of an ordered matrix into an image no bigger than MAX_PIXELS along each axis, keeping the max of each bin
+def binned_image(rows, cols, values, shape):
+    row_bin = max(1, int(np.ceil(shape[0] / MAX_PIXELS)))
+    col_bin = max(1, int(np.ceil(shape[1] / MAX_PIXELS)))
+    image = np.zeros((int(np.ceil(shape[0] / row_bin)), int(np.ceil(shape[1] / col_bin))), dtype = np.float32)
+    np.maximum.at(image, (rows // row_bin, cols // col_bin), values)
+    return image
+
+
+# Linkage of binary profiles using the memory efficient vector form so large sets do not need a full distance matrix in memory
+def profile_linkage(profiles):
+    if len(profiles) < 2:
+        return np.empty((0, 4))
+    return fastcluster.linkage_vector(np.where(profiles > 0, 1.0, 0.0), method = "ward") # clustered on presence like the small heatmaps
+
+
+# Lay out a heatmap with a row dendrogram, species colour strip, weight bar and (optionally) a column dendrogram
+def large_heatmap_figure(image, row_linkage, row_order, col_linkage, col_order, row_colours, weights, labels, species_palette, title):
+    fig = plt.figure(figsize = (16, 16))
+    grid = fig.add_gridspec(2, 5, width_ratios = [2, 0.4, 0.8, 12, 0.3], height_ratios = [2, 14], wspace = 0.02, hspace = 0.02)
+    ax_row_dendro = fig.add_subplot(grid[1, 0])
+    ax_colours = fig.add_subplot(grid[1, 1])
+    ax_weights = fig.add_subplot(grid[1, 2])
+    ax_heatmap = fig.add_subplot(grid[1, 3])
+    ax_cbar = fig.add_subplot(grid[1, 4])
+    
+    if len(row_linkage):
+        draw_dendrogram(ax_row_dendro, row_linkage, row_order, "left")
+    else:
+        ax_row_dendro.axis("off")
+    if col_linkage is not None and len(col_linkage):
+        draw_dendrogram(fig.add_subplot(grid[0, 3]), col_linkage, col_order, "top")
+    
+    # Species colour strip and the number of genomes behind each row, both binned like the heatmap
+    n_rows = len(row_order)
+    row_bin = max(1, int(np.ceil(n_rows / MAX_PIXELS)))
+    colour_strip = np.array([row_colours[i] for i in row_order[::row_bin]])[:, np.newaxis, :]
+    ax_colours.imshow(colour_strip, aspect = "auto", interpolation = "nearest", extent = (0, 1, n_rows, 0), rasterized = True)
+    ax_colours.axis("off")
+    ordered_weights = np.asarray(weights)[row_order]
+    ax_weights.barh(np.arange(n_rows) + 0.5, ordered_weights, height = 1, color = "#7f7f7f", rasterized = True)
+    ax_weights.set_ylim(n_rows, 0)
+    ax_weights.set_xscale("log")
+    ax_weights.set_yticks([])
+    ax_weights.set_xlabel("Genomes", fontsize = 8)
+    ax_weights.tick_params(axis = "x", labelsize = 6)
     
-    # Copy the values from the upper triangle to the lower triangle
-    adjacency_mat += np.triu(adjacency_mat.toarray(), k=1).T
+    mesh = ax_heatmap.imshow(image, aspect = "auto", interpolation = "nearest", cmap = sns.cm.rocket_r, extent = (0, image.shape[1], n_rows, 0), rasterized = True)
+    ax_heatmap.set_xticks([])
+    if n_rows <= MAX_LABELS:
+        ax_heatmap.yaxis.tick_right()
+        ax_heatmap.set_yticks(np.arange(n_rows) + 0.5)
+        ax_heatmap.set_yticklabels([labels[i] for i in row_order], fontsize = 6)
+    else:
+        ax_heatmap.set_yticks([])
+    fig.colorbar(mesh, cax = ax_cbar)
     
-    adjacency_df = pd.DataFrame(adjacency_mat, index=pairwise_df.index, columns=pairwise_df.columns)
-    return adjacency_df
+    handles = [Patch(color = colour, label = species) for species, colour in species_palette.items()]
+    fig.legend(handles = handles, loc = "upper left", ncol = max(1, len(handles) // 20), fontsize = 6, frameon = False)
+    fig.suptitle(title, fontsize = 10)
+    return fig
 
 
-def create_graph(adjacency_df):
-    # Create the graph
-    graph = nx.from_pandas_adjacency(adjacency_df)
-    graph.remove_nodes_from(list(nx.isolates(graph)))# Remove singletons
-    #pos = nx.spring_layout(graph, k = 0.15, iterations = 15)
-    #nx.draw(graph, pos, node_size = 100, font_size = 8)
-    #network_plot = nx.draw_networkx(graph, pos, node_size = 100, font_size = 8)
+# Heatmaps for large genera: genomes with the same allele profile are collapsed into one weighted row before clustering and the matrix body is rasterized
+def large_heatmaps(cluster_df, species_series, species_palette):
+    profiles, weights, profile_species, labels = collapse_profiles(cluster_df, species_series)
+    row_colours = [species_palette[s] for s in profile_species]
     
-    # Create a list of sub graphs
-    graph_subs = [graph.subgraph(c) for c in nx.connected_components(graph)]
+    # Cluster the profiles and the alleles
+    row_linkage = profile_linkage(profiles)
+    row_order = leaf_order(row_linkage, len(profiles))
+    col_linkage = profile_linkage(profiles.T)
+    col_order = leaf_order(col_linkage, profiles.shape[1])
+    
+    # Allele membership of each profile, placed by the clustering order
+    row_pos = np.empty(len(row_order), dtype = np.int64)
+    row_pos[row_order] = np.arange(len(row_order))
+    col_pos = np.empty(len(col_order), dtype = np.int64)
+    col_pos[col_order] = np.arange(len(col_order))
+    rows, cols = np.nonzero(profiles)
+    image = binned_image(row_pos[rows], col_pos[cols], profiles[rows, cols].astype(np.float32), profiles.shape)
+    fig_clus = large_heatmap_figure(image, row_linkage, row_order, col_linkage, col_order, row_colours, weights, labels, species_palette,
+                                    f"Allele membership of {len(cluster_df.index)} genomes collapsed into {len(profiles)} profiles")
+    
+    # Profiles that share at least one allele, computed as a sparse product so it never becomes dense
+    incidence = csr_matrix((profiles > 0).astype(np.int32))
+    shared = (incidence @ incidence.T).tocoo()
+    image = binned_image(row_pos[shared.row], row_pos[shared.col], np.ones(shared.nnz, dtype = np.float32), (len(profiles), len(profiles)))
+    fig_pair = large_heatmap_figure(image, row_linkage, row_order, row_linkage, row_order, row_colours, weights, labels, species_palette,
+                                    f"Shared alleles between the {len(profiles)} allele profiles of {len(cluster_df.index)} genomes")
+    return fig_clus, fig_pair
+
+def create_adjacency(cluster_df):
+    # Genome x allele incidence, the number of alleles two genomes share is then one sparse product
+    incidence = csr_matrix((cluster_df.to_numpy() > 0).astype(np.int32))
+    adjacency = (incidence @ incidence.T).tocsr()
+    adjacency.setdiag(0) # a genome sharing alleles with itself is not an edge
+    adjacency.eliminate_zeros()
+    return adjacency, list(cluster_df.index)
+
+
+def create_graph(adjacency, nodes):
+    # Find connected components on the sparse adjacency and drop singletons before anything is handed to networkx
+    n_components, labels = connected_components(adjacency, directed = False)
+    degree = np.diff(adjacency.indptr)
+    graph_subs = []
+    for component in range(n_components):
+        members = np.flatnonzero(labels == component)
+        if len(members) < 2 or not degree[members].any():
+            continue
+        graph = nx.from_scipy_sparse_array(adjacency[members][:, members]) # edge weights are the shared allele counts
+        graph_subs.append(nx.relabel_nodes(graph, {i: nodes[m] for i, m in enumerate(members)}))
     n_subplots = len(graph_subs) # determine the number of sub graps
     return graph_subs, n_subplots
 
@@ -215,3 +364,110 @@ def draw_graphs(graph_subs, n_subplots, species_palette, row_palette, outdir, ge
     plt.savefig(f"{outdir}/figures/{genus}-{name}_graphs.pdf", bbox_inches = "tight")
     return
 
+
+# Graphs of the collapsed allele profiles for the large mode. Profiles shared by several genomes are kept even without edges as those genomes form a clique
+def profile_graphs(cluster_df, gcf_species):
+    counts, first, inverse, weights = profile_groups(cluster_df)
+    adjacency, _ = create_adjacency(pd.DataFrame(counts[first]))
+    profile_species, _ = main_species(pd.Series(gcf_species).reindex(cluster_df.index), inverse)
+    n_components, labels = connected_components(adjacency, directed = False)
+    graph_subs = []
+    for component in range(n_components):
+        members = np.flatnonzero(labels == component)
+        if len(members) == 1 and weights[members[0]] == 1:
+            continue # a genome sharing no alleles with any other
+        graph = nx.from_scipy_sparse_array(adjacency[members][:, members])
+        for i, member in enumerate(members):
+            graph.nodes[i]["size"] = int(weights[member])
+            graph.nodes[i]["species"] = profile_species[member]
+        graph_subs.append(graph)
+    return graph_subs
+
+
+# Lay out one component, force directed for small ones and spectral for those too big for it
+def component_layout(graph):
+    if len(graph) > LARGE_COMPONENT:
+        return nx.spectral_layout(graph, weight = None) # sparse eigen decomposition, near linear in the edge count
+    return nx.spring_layout(graph, seed = 1) # networkx switches to its sparse solver above 500 nodes
+
+
+# Large genus mode: lay out the collapsed profile graphs the components in parallel and spread them over as many pages as needed
+def draw_large_graphs(graph_subs, species_palette, outdir, genus, name, threads = 1):
+    collapsed = sorted(graph_subs, key = lambda graph: sum(size for _, size in graph.nodes(data = "size")), reverse = True) # biggest components first
+    
+    # The layouts are mostly numpy work so threads are enough (and we may already be inside a worker process that cannot have children)
+    with ThreadPool(max(1, threads)) as pool:
+        layouts = pool.map(component_layout, collapsed)
+    
+    n_pages = int(np.ceil(len(collapsed) / GRAPHS_PER_PAGE))
+    with PdfPages(f"{outdir}/figures/{genus}-{name}_graphs.pdf") as pdf_pages:
+        for page in range(n_pages):
+            page_graphs = collapsed[page * GRAPHS_PER_PAGE:(page + 1) * GRAPHS_PER_PAGE]
+            n_rows = int(np.ceil(np.sqrt(len(page_graphs))))
+            n_cols = int(np.ceil(len(page_graphs) / n_rows))
+            fig, axs = plt.subplots(n_rows, n_cols, figsize = (n_cols * 5, n_rows * 5), squeeze = False)
+            axs = axs.flatten()
+            for i, graph in enumerate(page_graphs):
+                pos = layouts[page * GRAPHS_PER_PAGE + i]
+                # Node area grows with the number of genomes collapsed into it
+                node_sizes = [30 * np.sqrt(graph.nodes[n]["size"]) for n in graph.nodes]
+                node_cols = [species_palette[graph.nodes[n]["species"]] for n in graph.nodes]
+                edge_widths = np.array([w for _, _, w in graph.edges(data = "weight")], dtype = float)
+                edges = nx.draw_networkx_edges(graph, pos, ax = axs[i], width = edge_widths / max(edge_widths.max(initial = 1), 1) * 2, alpha = 0.5)
+                nodes = nx.draw_networkx_nodes(graph, pos, ax = axs[i], node_size = node_sizes, node_color = node_cols, linewidths = 0)
+                for artist in (edges, nodes):
+                    if artist is not None and hasattr(artist, "set_rasterized"):
+                        artist.set_rasterized(True)
+                n_genomes = sum(graph.nodes[n]["size"] for n in graph.nodes)
+                axs[i].set_title(f"{n_genomes} genomes, {len(graph)} profiles", fontsize = 8)
+                axs[i].axis("off")
+            # Make any unused subplots blank
+            for i in range(len(page_graphs), n_rows * n_cols):
+                axs[i].axis("off")
+            handles = [Patch(color = colour, label = species) for species, colour in species_palette.items()]
+            fig.legend(handles = handles, loc = "upper left", ncol = max(1, len(handles) // 20), fontsize = 6, frameon = False)
+            fig.suptitle(f"{genus} {name} page {page + 1} of {n_pages}", fontsize = 10)
+            pdf_pages.savefig(fig, bbox_inches = "tight")
+            plt.close(fig)
+    return
+
+
+# Resolution profile of the window scan: species resolved and allele diversity by window start and length
+def window_scan_figure(scan_df, outdir, genus):
+    fig, axs = plt.subplots(2, 1, figsize = (12, 8), sharex = True)
+    for ax, value, label in zip(axs, ["ResolvedSpecies", "Shannon"], ["Species resolved", "Shannon diversity of alleles"]):
+        grid = scan_df.pivot(index = "Length", columns = "Start", values = value)
+        image = ax.imshow(grid.to_numpy(), aspect = "auto", origin = "lower", interpolation = "nearest", cmap = "viridis",
+                          extent = [grid.columns.min(), grid.columns.max(), grid.index.min(), grid.index.max()])
+        image.set_rasterized(True)
+        ax.set_ylabel("Window length (columns)")
+        fig.colorbar(image, ax = ax, label = label)
+    axs[-1].set_xlabel("Window start (alignment column)")
+    axs[0].set_title(f"{genus} 16S window scan")
+    with PdfPages(f"{outdir}/figures/{genus}_window_scan.pdf") as pdf_pages:
+        pdf_pages.savefig(fig, bbox_inches = "tight")
+    plt.close(fig)
+    return
+
+
+# Species x species confusion as the fraction of each row species' genomes sharing an allele with the column species
+def species_confusion_heatmap(confusion, outdir, genus, name):
+    counts = confusion.to_numpy()
+    fraction = counts / np.maximum(np.diag(counts), 1)[:, None]
+    n_species = len(confusion.index)
+    size = min(max(4, 0.15 * n_species + 2), 30)
+    fig, ax = plt.subplots(figsize = (size + 1.5, size))
+    image = ax.imshow(fraction, cmap = "Reds", vmin = 0, vmax = 1, interpolation = "nearest")
+    image.set_rasterized(True)
+    if n_species <= MAX_LABELS:
+        ax.set_xticks(range(n_species), labels = confusion.columns, rotation = 90, fontsize = 6)
+        ax.set_yticks(range(n_species), labels = confusion.index, fontsize = 6)
+    else:
+        ax.set_xticks([])
+        ax.set_yticks([])
+    fig.colorbar(image, ax = ax, label = "Fraction of the row species' genomes sharing an allele with the column species")
+    ax.set_title(f"{genus} {name} species confusion ({n_species} species)")
+    with PdfPages(f"{outdir}/figures/{genus}-{name}_species_confusion.pdf") as pdf_pages:
+        pdf_pages.savefig(fig, bbox_inches = "tight")
+    plt.close(fig)
+    return
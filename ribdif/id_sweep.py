@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from ribdif import vsearch_run, journal, incidence
+
+# Clustering amplicons at several identities from one pairwise vsearch search of their unique alleles
+
+COMPLEMENT = str.maketrans("ACGTRYKMBDHVNacgtrykmbdhvn", "TGCAYRMKVHDBNtgcayrmkvhdbn")
+
+
+# Read the labels and sequences of an amplicon file
+def read_amplicons(path):
+    amplicons, label, seq = [], None, []
+    with open(path, "r") as f_in:
+        for line in f_in:
+            if line.startswith(">"):
+                if label is not None:
+                    amplicons.append((label, "".join(seq)))
+                label, seq = line[1:].split()[0], [] # vsearch labels stop at the first space
+            else:
+                seq.append(line.strip())
+    if label is not None:
+        amplicons.append((label, "".join(seq)))
+    return amplicons
+
+
+# The same sequence on either strand gives the same key
+def canonical(seq):
+    seq = seq.upper()
+    return min(seq, seq.translate(COMPLEMENT)[::-1])
+
+
+# Collapse identical amplicons into unique alleles ordered the way cluster_fast visits them (longest first, then most common)
+def dereplicate_amplicons(amplicons):
+    members = {}
+    for i, (_, seq) in enumerate(amplicons):
+        members.setdefault(canonical(seq), []).append(i)
+    order = sorted(members, key = lambda seq: (-len(seq), -len(members[seq]), members[seq][0]))
+    return order, [members[seq] for seq in order]
+
+
+# Write the alleles for vsearch labelled by their position in the visiting order
+def write_uniques(uniques, members, path):
+    with journal.atomic_write(path) as f_out:
+        for i, (seq, group) in enumerate(zip(uniques, members)):
+            f_out.write(f">u{i};size={len(group)}\n{seq}\n")
+    return
+
+
+# Read the allele pairs vsearch found into a symmetric sparse matrix of identities (as fractions)
+def read_pairs(path, n_uniques):
+    pairs = pd.read_csv(path, sep = "\t", header = None, names = ["query", "target", "id"], dtype = {"query": str, "target": str, "id": float})
+    query = pairs["query"].str.split(";").str[0].str[1:].astype(int).to_numpy()
+    target = pairs["target"].str.split(";").str[0].str[1:].astype(int).to_numpy()
+    identity = pairs["id"].to_numpy() / 100
+    # Both directions are kept, where vsearch aligned a pair both ways the best identity wins
+    rows, cols, values = np.concatenate([query, target]), np.concatenate([target, query]), np.concatenate([identity, identity])
+    best = pd.DataFrame({"row": rows, "col": cols, "id": values}).groupby(["row", "col"], as_index = False)["id"].max()
+    return csr_matrix((best["id"].to_numpy(), (best["row"].to_numpy(), best["col"].to_numpy())), shape = (n_uniques, n_uniques))
+
+
+# Centroid clustering like cluster_fast: each allele in turn joins its closest centroid within the identity or becomes a centroid itself
+def centroid_clusters(identities, threshold):
+    n_uniques = identities.shape[0]
+    centroid_of = np.full(n_uniques, -1, dtype = np.int64)
+    is_centroid = np.zeros(n_uniques, dtype = bool)
+    for i in range(n_uniques):
+        neighbours = identities.indices[identities.indptr[i]:identities.indptr[i + 1]]
+        values = identities.data[identities.indptr[i]:identities.indptr[i + 1]]
+        candidates = is_centroid[neighbours] & (values >= threshold)
+        if candidates.any():
+            centroid_of[i] = neighbours[candidates][np.argmax(values[candidates])]
+        else:
+            centroid_of[i] = i
+            is_centroid[i] = True
+    # Number the clusters in the order their centroids were made
+    centroids = np.flatnonzero(is_centroid)
+    cluster_number = np.full(n_uniques, -1, dtype = np.int64)
+    cluster_number[centroids] = np.arange(len(centroids))
+    return cluster_number[centroid_of], centroid_of
+
+
+# Single linkage: alleles are in the same cluster if a chain of pairs within the identity joins them
+def single_linkage_clusters(identities, threshold):
+    linked = identities.multiply(identities >= threshold).tocsr()
+    _, labels = connected_components(linked, directed = False)
+    # Number the clusters by their first allele in visiting order, which is also taken as their centroid
+    _, first, cluster = np.unique(labels, return_index = True, return_inverse = True)
+    order = np.argsort(first)
+    renumber = np.empty(len(order), dtype = np.int64)
+    renumber[order] = np.arange(len(order))
+    return renumber[cluster.ravel()], first[cluster.ravel()]
+
+
+# Write the clusters of every amplicon in vsearch's uc format so the reports can read them like any other clustering
+def write_uc(path, amplicons, members, clusters, centroid_of, identities):
+    n_clusters = int(clusters.max()) + 1 if len(clusters) else 0
+    centroid_label = {}
+    sizes = np.zeros(n_clusters, dtype = np.int64)
+    with journal.atomic_write(path) as f_out:
+        for u, group in enumerate(members):
+            cluster = clusters[u]
+            if centroid_of[u] == u:
+                centroid_label[cluster] = amplicons[group[0]][0]
+            identity = 100.0 if centroid_of[u] == u else identities[u, centroid_of[u]] * 100
+            for i in group:
+                label, seq = amplicons[i]
+                if label == centroid_label.get(cluster):
+                    f_out.write(f"S\t{cluster}\t{len(seq)}\t*\t*\t*\t*\t*\t{label}\t*\n")
+                else:
+                    # Single linkage members may never have been aligned to the centroid, they have no identity to report
+                    ident = f"{identity:.1f}" if identity else "*"
+                    f_out.write(f"H\t{cluster}\t{len(seq)}\t{ident}\t+\t0\t0\t*\t{label}\t{centroid_label[cluster]}\n")
+                sizes[cluster] += 1
+        for cluster in range(n_clusters):
+            f_out.write(f"C\t{cluster}\t{sizes[cluster]}\t*\t*\t*\t*\t*\t{centroid_label[cluster]}\t*\n")
+    return
+
+
+# Name the reports of a primer at one identity are made under
+def sweep_name(name, threshold):
+    return f"{name}-id{threshold:g}"
+
+
+# Drop the names of sweep identities from a list of reported names, leaving the primers themselves
+def primer_names(names):
+    return [n for n in names if not any(n.startswith(f"{m}-id") for m in names if m != n)]
+
+
+# Cluster a primer's amplicons at every identity of the sweep and write a table of how resolution changes
+def sweep(outdir, genus, name, thresholds, linkage, species_map, log_dir, threads, logger):
+    amplicon_dir = f"{outdir}/amplicons/{name}"
+    amplicons = read_amplicons(f"{amplicon_dir}/{genus}-{name}.amplicons")
+    uniques, members = dereplicate_amplicons(amplicons)
+    logger.info(f"Sweeping {name} over identities {', '.join(f'{t:g}' for t in thresholds)} with {len(uniques)} unique alleles from {len(amplicons)} amplicons\n")
+
+    # One pairwise search of the alleles down to the lowest identity
+    uniques_path, pairs_path = f"{amplicon_dir}/{genus}-{name}.uniques", f"{amplicon_dir}/{genus}-{name}.pairs"
+    write_uniques(uniques, members, uniques_path)
+    vsearch_run.vsearch_pairs(uniques_path, pairs_path, min(thresholds), log_dir, name, threads, logger)
+    identities = read_pairs(pairs_path, len(uniques))
+
+    # Genome and species of every amplicon, as the reports take them
+    species_map = species_map or {}
+    gcfs = ["_".join(label.split("_")[:2]) for label, _ in amplicons]
+    species = [species_map.get(gcf, label.split("_")[5]) for gcf, (label, _) in zip(gcfs, amplicons)]
+    genome_index = {gcf: i for i, gcf in enumerate(dict.fromkeys(gcfs))}
+    gcf_species = dict(zip(gcfs, species))
+    amplicon_genome = np.array([genome_index[gcf] for gcf in gcfs])
+    allele_of = np.empty(len(amplicons), dtype = np.int64)
+    for u, group in enumerate(members):
+        allele_of[group] = u
+
+    names = []
+    with journal.atomic_write(f"{outdir}/{genus}_{name}_id_sweep.tsv") as f_out:
+        f_out.write("Identity\tClusters\tGenomes\tMultiAlleleGenomes\tOverlappingSpecies\tOverlapGroups\n")
+        for threshold in sorted(thresholds, reverse = True):
+            if linkage == "single":
+                clusters, centroid_of = single_linkage_clusters(identities, threshold)
+            else:
+                clusters, centroid_of = centroid_clusters(identities, threshold)
+            current = sweep_name(name, threshold)
+            Path(f"{outdir}/amplicons/{current}").mkdir(exist_ok = True)
+            write_uc(f"{outdir}/amplicons/{current}/{genus}-{current}.uc", amplicons, members, clusters, centroid_of, identities)
+            names.append(current)
+
+            # Summarise the resolution at this identity from the genome x cluster counts
+            counts = np.zeros((len(genome_index), int(clusters.max()) + 1), dtype = np.int32)
+            np.add.at(counts, (amplicon_genome, clusters[allele_of]), 1)
+            cluster_df = pd.DataFrame(counts, index = list(genome_index))
+            combinations = incidence.species_overlap(cluster_df, gcf_species)
+            overlapping = set(s for c in combinations for s in c.split("/")) - {"sp."}
+            multi = int(((counts > 0).sum(axis = 1) > 1).sum())
+            f_out.write(f"{threshold:g}\t{counts.shape[1]}\t{counts.shape[0]}\t{multi}\t{len(overlapping)}\t{len(set(combinations))}\n")
+    return names
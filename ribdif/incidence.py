@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from scipy.sparse import csc_matrix, csr_matrix
+from ribdif import journal
+
+# Genome x allele incidence of each primer, saved so the figures and --report-only can be made without the genomes
+
+INCIDENCE_SUFFIX = "_incidence.npy"
+INDEX_SUFFIX = "_incidence.tsv"
+
+
+# Path of a primer's incidence without its suffix
+def incidence_stem(outdir, genus, name):
+    return f"{outdir}/amplicons/{name}/{genus}-{name}"
+
+
+# Save the incidence of a primer and the GCF and species of each of its rows
+def save_incidence(cluster_df, gcf_species, outdir, genus, name):
+    stem = incidence_stem(outdir, genus, name)
+    counts = cluster_df.to_numpy()
+    # Copy numbers are small so 16 bits keeps the array (and its memory map) a quarter of the default size
+    with journal.atomic_write(f"{stem}{INCIDENCE_SUFFIX}", "wb") as f_out:
+        np.save(f_out, counts.astype(np.uint16 if counts.max(initial = 0) < 2**16 else np.uint32))
+    with journal.atomic_write(f"{stem}{INDEX_SUFFIX}") as f_out:
+        f_out.write("GCF\tSpecies\n")
+        for gcf in cluster_df.index:
+            f_out.write(f"{gcf}\t{gcf_species[gcf]}\n")
+    return
+
+
+# Memory map a primer's incidence and read its row index
+def load_incidence(outdir, genus, name):
+    stem = incidence_stem(outdir, genus, name)
+    counts = np.load(f"{stem}{INCIDENCE_SUFFIX}", mmap_mode = "r")
+    index = pd.read_csv(f"{stem}{INDEX_SUFFIX}", sep = "\t", dtype = str, keep_default_na = False)
+    return counts, list(index.GCF), list(index.Species)
+
+
+# Names of the primers of a run that have a saved incidence
+def saved_primers(outdir, genus):
+    return sorted(path.parent.name for path in Path(f"{outdir}/amplicons").glob(f"*/{genus}-*{INCIDENCE_SUFFIX}")
+                  if path.name == f"{genus}-{path.parent.name}{INCIDENCE_SUFFIX}")
+
+
+# Which genomes pass the report filters
+def genome_mask(gcfs, species, sp_ignore = False, exclude = None, only_species = None):
+    mask = np.ones(len(gcfs), dtype = bool)
+    if sp_ignore:
+        mask &= np.array([s != "sp." for s in species], dtype = bool)
+    if exclude:
+        mask &= np.array([g not in exclude for g in gcfs], dtype = bool)
+    if only_species:
+        mask &= np.array([s in only_species for s in species], dtype = bool)
+    return mask
+
+
+# Cluster dataframe and GCF to species dictionary of the genomes passing the filters, dropping clusters no genome is left in
+def filtered_clusters(counts, gcfs, species, mask):
+    rows = np.flatnonzero(mask)
+    kept = np.asarray(counts[rows]).astype(np.int32) # only the filtered rows are read from the memory map
+    kept = kept[:, kept.sum(axis = 0) > 0]
+    cluster_df = pd.DataFrame(kept, index = [gcfs[i] for i in rows])
+    gcf_species = {gcfs[i]: species[i] for i in rows}
+    return cluster_df, gcf_species
+
+
+# Species sharing a cluster, the same as overlaps.species_overlap but by columns of a sparse matrix rather than by dictionary scans
+def species_overlap(cluster_df, gcf_species):
+    multi = csc_matrix(cluster_df.to_numpy() > 1)
+    species = np.array([gcf_species[gcf] for gcf in cluster_df.index])
+    combinations = []
+    for i in range(multi.shape[1]):
+        cluster_species = set(species[multi.indices[multi.indptr[i]:multi.indptr[i + 1]]])
+        if len(cluster_species) > 1:
+            combinations.append("/".join(cluster_species))
+    return combinations
+
+
+# Pairwise dictionary of which genomes share an allele, in the layout of overlaps.gcf_overlaps
+def pairwise_overlaps(cluster_df):
+    binary = csr_matrix((cluster_df.to_numpy() > 0).astype(np.int32))
+    shared = (binary @ binary.T).toarray() > 0
+    return {gcf: row for gcf, row in zip(cluster_df.index, shared.astype(int).tolist())}
+
+
+# Species x species confusion: how many genomes of the row species share an allele with any genome of the column species,
+# with every genome of the species on the diagonal. Built from which species carry each allele so no genome x genome matrix is made
+def species_confusion(cluster_df, gcf_species, weights = None):
+    weights = weights or {}
+    species = np.array([gcf_species[gcf] for gcf in cluster_df.index])
+    names = sorted(set(species.tolist()) - {"sp."}) + (["sp."] if "sp." in species else []) # unnamed genomes last, as in the heatmaps
+    codes = pd.Index(names).get_indexer(species)
+    genomes = np.arange(len(species))
+    genome_weights = np.array([weights.get(gcf, 1) for gcf in cluster_df.index], dtype = np.int64)
+    binary = csr_matrix((cluster_df.to_numpy() > 0).astype(np.int32))
+    members = csr_matrix((genome_weights, (codes, genomes)), shape = (len(names), len(species)))
+    species_alleles = csr_matrix(((members @ binary) > 0).astype(np.int32)) # which species carry each allele
+    shares = csr_matrix(((binary @ species_alleles.T) > 0).astype(np.int64)) # genomes x species
+    confusion = (members @ shares).toarray()
+    np.fill_diagonal(confusion, np.asarray(members.sum(axis = 1)).ravel())
+    return pd.DataFrame(confusion, index = names, columns = names)
+
+# Numbers of the overlap report of a primer, for tables over many primers (ribdif.run) or genera (batch runs). genome_species
+# holds every genome the primer was tried on, amplified or not
+def report_stats(cluster_df, gcf_species, genome_species, overlap_groups = None):
+    if overlap_groups is None:
+        overlap_groups = species_overlap(cluster_df, gcf_species) if len(cluster_df) else []
+    species = list(genome_species.values())
+    overlapping = {s for group in overlap_groups for s in group.split("/")} - {"sp."}
+    amplified_species = {gcf_species[gcf] for gcf in cluster_df.index} - {"sp."}
+    return {"genomes": len(species), "named_genomes": sum(s != "sp." for s in species), "species": len(set(species) - {"sp."}),
+            "amplified": len(cluster_df), "amplification_rate": round(len(cluster_df) / len(species), 4) if species else 0.0,
+            "amplicons": int(cluster_df.to_numpy().sum()) if len(cluster_df) else 0,
+            "alleles": int(cluster_df.shape[1]), "multi_allele_genomes": int(((cluster_df > 0).sum(axis = 1) > 1).sum()) if len(cluster_df) else 0,
+            "amplified_species": len(amplified_species), "overlapping_species": len(overlapping),
+            "resolved_species": len(amplified_species - overlapping)}
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+import os
+import json
+import hashlib
+import time
+from pathlib import Path
+from contextlib import contextmanager
+
+# Checkpoint journal for --resume, plus atomic writes so a killed run never leaves a truncated file under its final name
+
+JOURNAL_NAME = "ribdif_journal.jsonl"
+
+
+# Fingerprint a mix of paths and plain option values. Files are fingerprinted on size and modification time which is cheap even for thousands of genomes
+def fingerprint(items):
+    digest = hashlib.sha1()
+    for item in items:
+        path = Path(str(item))
+        if isinstance(item, (str, Path)) and path.is_file():
+            stat = path.stat()
+            digest.update(f"F:{path}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+        elif isinstance(item, (str, Path)) and path.is_dir():
+            # Directories are fingerprinted on their sorted listing of files
+            for file in sorted(path.rglob("*")):
+                if file.is_file():
+                    stat = file.stat()
+                    digest.update(f"F:{file}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+        elif isinstance(item, Path):
+            digest.update(f"M:{item};".encode()) # missing file
+        else:
+            digest.update(f"V:{item};".encode())
+    return digest.hexdigest()
+
+
+# Read the journal into a dictionary of unit name to its latest entry
+def load(outdir):
+    state = {}
+    journal_path = Path(f"{outdir}/{JOURNAL_NAME}")
+    if not journal_path.is_file():
+        return state
+    with open(journal_path, "r") as f_in:
+        for line in f_in:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError: # a line cut short by a crash
+                continue
+            state[entry["unit"]] = entry
+    return state
+
+
+# Append a completed unit to the journal
+def record(outdir, state, unit, inputs, outputs, data = None):
+    entry = {"unit": unit, "input": fingerprint(inputs), "output": fingerprint(outputs), "time": time.time()}
+    if data is not None:
+        entry["data"] = data
+    with open(f"{outdir}/{JOURNAL_NAME}", "a") as f_out:
+        f_out.write(json.dumps(entry) + "\n")
+        f_out.flush()
+        os.fsync(f_out.fileno()) # make sure the checkpoint survives the crash we are guarding against
+    state[unit] = entry
+    return
+
+
+# Check if a unit completed with the same inputs and its outputs are still as it left them
+def is_done(state, unit, inputs, outputs):
+    entry = state.get(unit)
+    if not entry:
+        return False
+    if not all(Path(str(o)).exists() for o in outputs):
+        return False
+    return entry["input"] == fingerprint(inputs) and entry["output"] == fingerprint(outputs)
+
+
+# Run a stage unless it completed with the same inputs in the previous run, checkpointing it once it ran
+# outputs can be a function listing them, for stages whose outputs are only known once they ran
+def run_unit(outdir, state, unit, inputs, outputs, stage, logger, skipped = None):
+    if is_done(state, unit, inputs, outputs() if callable(outputs) else outputs):
+        if skipped:
+            logger.info(skipped)
+        return False
+    stage()
+    record(outdir, state, unit, inputs, outputs() if callable(outputs) else outputs)
+    return True
+
+
+# Name of a per genome unit, e.g. barrnap:<genome>
+def genome_unit(kind, file):
+    return f"{kind}:{Path(file).parent.name}"
+
+
+# Files of a per genome task that still need doing, output giving the file the task makes of each
+def pending_genomes(state, kind, files, output):
+    return [file for file in files if not is_done(state, genome_unit(kind, file), [file], [output(file)])]
+
+
+# Checkpoint a per genome task
+def record_genome(outdir, state, kind, file, output):
+    record(outdir, state, genome_unit(kind, file), [file], [output(file)])
+    return
+
+
+# Get the extra data stored with a completed unit
+def unit_data(state, unit):
+    return state.get(unit, {}).get("data")
+
+
+# Forget a unit so it and everything keyed after it is redone
+def invalidate(state, unit):
+    state.pop(unit, None)
+    return
+
+
+# Write to a temporary file next to the target and only move it into place once it was fully written
+@contextmanager
+def atomic_write(path, mode = "w", **kwargs):
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    try:
+        with open(tmp_path, mode, **kwargs) as f_out:
+            yield f_out
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok = True)
+        raise
+
+
+# Remove temporary files left behind by a killed run
+def clean_partials(outdir):
+    count = 0
+    for tmp in Path(outdir).rglob("*.tmp-*"):
+        if tmp.is_file():
+            tmp.unlink()
+            count += 1
+    return count
@@ -41,6 +41,15 @@ def replace_log_file(outdir, logger):
     Path.unlink(Path(old_log_file))
     return
 
-    
-        
-    
\ No newline at end of file
+# Start a fresh temporary log file for the next run of a batch, the last run's log is already complete in its output directory
+def reset_log_file(workingDir, logger):
+    for handler in logger.handlers[1:]:
+        handler.close()
+        logger.removeHandler(handler)
+        if Path(handler.baseFilename).name.startswith("tmplog_"): # a run that stopped before it had an output directory
+            Path.unlink(Path(handler.baseFilename), missing_ok = True)
+    file_handler = logging.FileHandler(f"{workingDir}/tmplog_{str(uuid.uuid4())}.log", "w")
+    file_handler.setLevel(logging.INFO)
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logger.addHandler(file_handler)
+    return
@@ -7,6 +7,7 @@ import shlex
 from Bio import Phylo
 import pandas as pd
 import re
+from ribdif import resources
 
 
 # Spawning the shell call
@@ -26,20 +27,21 @@ def call_proc_muscle(infile):
     return
 
 
-# Multithreading the msa calls
-def muscle_call_multi(outdir, threads, domain):
-    with multiprocessing.Pool(threads) as pool: # spawn the pool
-        all_16S = [str(i) for i in list(Path(f"{outdir}/refseq/{domain}/").glob('*/*.16S'))]
+# Multithreading the msa calls within the core and memory budget
+def muscle_call_multi(outdir, budget, domain):
+    all_16S = [str(i) for i in list(Path(f"{outdir}/refseq/{domain}/").glob('*/*.16S'))]
+    costs = [resources.alignment_memory(*resources.fasta_dimensions(i)) for i in all_16S] # a handful of 16S copies per genome
+    with multiprocessing.Pool(resources.pool_size(budget, max(costs, default = 0), len(all_16S))) as pool: # spawn the pool
         pool.map(call_proc_muscle, all_16S)
     return
 
 
 
 # Calling Muscle for MSA of all 16S sequences
-def muscle_call_single(infile, outAln, outTree):
+def muscle_call_single(infile, outAln, outTree, threads = 1):
     # Building the command
     #command1 = f"muscle -super5 {infile} -output {outAln} -threads {threads} -nt" # Do I need to strip the alignement file of white space and commas?
-    command1 = f"mafft --quiet {infile}"
+    command1 = f"mafft --quiet --thread {threads} {infile}"
     command2 = f"fasttree -quiet -nopr -gtr -nt {outAln}"
     with open(f"{outAln}", "w") as aln_out:
         subprocess.run(shlex.split(command1), stdout = aln_out, stderr = subprocess.PIPE)
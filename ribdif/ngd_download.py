@@ -1,44 +1,54 @@
 #!/usr/bin/env python3
-import ncbi_genome_download as ngd
 from pathlib import Path
-import gzip
 import shutil
 import logging
+from itertools import repeat
+from multiprocessing.pool import ThreadPool
+from ncbi_genome_download.core import select_candidates, create_downloadjob, worker, get_strain
+from ncbi_genome_download.config import NgdConfig
+from ribdif import store, journal
 # Using Kai's NCBI genome downloader to get all genones of the specified genus
 # Avaliable at: https://github.com/kblin/ncbi-genome-download
+# We drive its candidate selection, checksum and download functions ourselves so each assembly can be handed on for processing as soon as it checks out
 
-def genome_download(genus, outdir, threads, frag, sp_ignore, domain, logger):
+NCBI_URI = "https://ftp.ncbi.nih.gov/genomes"
+METADATA_NAME = "genome_metadata.tsv"
+
+# on_ready(gz_path) is called with each genome in the run directory as soon as its download is verified so it can be processed while the rest download
+# Assemblies are chosen from the assembly summary before anything is downloaded: unnamed species are excluded with sp_ignore, max_per_species caps the genomes kept per species
+# and keep(accession), if given, picks the chosen assemblies a sharded run downloads
+def genome_download(genus, outdir, parallel, frag, sp_ignore, domain, logger, genome_store = None, on_ready = None, uri = NCBI_URI, max_per_species = None, assembly_levels = None, keep = None):
     genera = genus.replace("_", " ") # replace "_" with " "
-    assembly_level = "all" if frag else "complete" # assign assembly level based on user input
+    if assembly_levels:
+        assembly_level = assembly_levels
+    else:
+        assembly_level = "all" if frag else "complete" # assign assembly level based on user input
     
     # Download genomes with specific domain and genus/species
     logger.info(f"Downloading all genome records of {genus} from NCBI at {assembly_level} assembly level\n")
-    ngd.download(section='refseq', 
-           file_formats = 'fasta', 
-           genera = genera,  
-           output = outdir, 
-           assembly_levels = assembly_level,
-           parallel = threads*2,
-           groups = domain)
+    selected, removed, outside = ngd_fetch(genera, outdir, assembly_level, parallel, domain, genome_store, logger, on_ready, uri, sp_ignore, max_per_species, keep)
+    if not selected and outside:
+        return empty_shard(genus, outside, logger)
     status, count = download_checker(outdir, domain, logger, genus, sp_ignore)
     
     # if non bacteria domain and no complete genomes were downloaded, try again at chromosome level as it is very rare to have "complete" non bacteria genomes
     if domain != "bacteria" and status == 1 and assembly_level == "complete":
         logger.info(f"\nNo complete genomes for {genus} were found so we will try again using 'chromosome' assembly level as this is what non bacteria genomes are usually added as")
         assembly_level = "chromosome"
-        ngd.download(section='refseq', 
-               file_formats = 'fasta', 
-               genera = genera,  
-               output = outdir, 
-               assembly_levels = assembly_level,
-               parallel = threads*2,
-               groups = domain)
+        selected, removed, outside = ngd_fetch(genera, outdir, assembly_level, parallel, domain, genome_store, logger, on_ready, uri, sp_ignore, max_per_species, keep)
+        if not selected and outside:
+            return empty_shard(genus, outside, logger)
+        status, count = download_checker(outdir, domain, logger, genus, sp_ignore)
+    
+    if status == 0:
+        # Remove genomes left in the run directory by an earlier run that the current selection excludes, then record where each species label came from
+        prune(outdir, domain, [entry["assembly_accession"] for entry in selected])
         status, count = download_checker(outdir, domain, logger, genus, sp_ignore)
+        metadata_write(outdir, selected)
         
-    # Remove genomes of unknown species if genomes were downloaded (status ==0)
-    if sp_ignore and status == 0:
-        sp_count = sp_remove(outdir, domain) # Remove genomes of unknown species
-        logger.info(f"{count} genomes of {genus} were downloaded and {sp_count} were removed due to being unnamed species\n\n")
+    # Report genomes that were never downloaded because of the selection
+    if removed and status == 0:
+        logger.info(f"{count} genomes of {genus} were downloaded and {removed} were excluded from their assembly metadata before download\n\n")
     elif status == 0: 
         logger.info(f"{count} genomes of {genus} were downloaded\n\n")
     
@@ -46,6 +56,132 @@ def genome_download(genus, outdir, threads, frag, sp_ignore, domain, logger):
         
     return status
 
+# A shard none of the chosen genomes fall in has nothing to download, which is not a failure
+def empty_shard(genus, outside, logger):
+    logger.info(f"None of the {outside} chosen genomes of {genus} fall in this shard\n\n")
+    return 0
+
+# Download the genomes into the run directory or, if using a shared store, into the store and link them into the run directory (if one is given)
+# Returns the selected assembly summary entries, how many were excluded by the selection and how many were left to other shards
+def ngd_fetch(genera, outdir, assembly_level, parallel, domain, genome_store, logger, on_ready = None, uri = NCBI_URI, sp_ignore = False, max_per_species = None, keep = None):
+    target = genome_store or outdir
+    # The assembly summary is cached for a day when using a store as the same summary is likely to be used by many runs
+    config = NgdConfig.from_kwargs(section = 'refseq', 
+                                   file_formats = 'fasta', 
+                                   genera = genera,  
+                                   assembly_levels = assembly_level,
+                                   groups = domain,
+                                   output = str(target),
+                                   uri = uri,
+                                   use_cache = genome_store is not None)
+    candidates = select_candidates(config)
+    n_candidates = len(candidates)
+    candidates = select_assemblies(candidates, sp_ignore, max_per_species)
+    n_selected = len(candidates)
+    if keep:
+        candidates = [(entry, group) for entry, group in candidates if keep(entry["assembly_accession"])]
+    if not candidates:
+        return [], n_candidates - n_selected, n_selected
+    
+    # Downloads are network bound so run them in threads and pass each assembly on as soon as it is verified
+    failed = 0
+    with ThreadPool(parallel) as pool:
+        for accession, local_file, success in pool.imap_unordered(fetch_assembly, zip(candidates, repeat(config))):
+            if not success:
+                failed += 1
+                continue
+            if genome_store and outdir:
+                store.adopt(genome_store, domain, [accession], outdir, parallel)
+            if on_ready:
+                on_ready(f"{outdir}/refseq/{domain}/{accession}/{Path(local_file).name}")
+    if genome_store and outdir:
+        logger.info(f"Linked {len(candidates) - failed} genomes from the genome store at {genome_store}\n")
+    if failed:
+        logger.warning(f"{failed} genomes failed to download or did not match their MD5 checksum\n")
+    return [entry for entry, _ in candidates], n_candidates - n_selected, n_selected - len(candidates)
+
+# Download a genus into the genome store alone, ahead of the run that will link them (see batch.py)
+def prefetch(genus, genome_store, parallel, frag, domain, logger, uri = NCBI_URI, sp_ignore = False, max_per_species = None, assembly_levels = None):
+    assembly_level = assembly_levels or ("all" if frag else "complete")
+    selected, _, _ = ngd_fetch(genus.replace("_", " "), None, assembly_level, parallel, domain, genome_store, logger, None, uri, sp_ignore, max_per_species)
+    return len(selected)
+
+# Get the species epithet from the assembly summary organism name, e.g. "Vibrio cholerae O1" -> "cholerae", "Vibrio sp. A12" -> "sp."
+def entry_species(entry):
+    words = entry["organism_name"].replace("[", "").replace("]", "").split()
+    if len(words) < 2:
+        return "sp."
+    return words[1]
+
+# Rank assemblies so the most useful are kept when capping: reference/representative first, then the most complete
+def entry_rank(entry):
+    category = {"reference genome": 0, "representative genome": 1}.get(entry.get("refseq_category", "na"), 2)
+    level = {"Complete Genome": 0, "Chromosome": 1, "Scaffold": 2, "Contig": 3}.get(entry.get("assembly_level", ""), 4)
+    return category, level
+
+# Choose which candidate assemblies to download from their metadata alone
+def select_assemblies(candidates, sp_ignore, max_per_species):
+    if sp_ignore:
+        candidates = [c for c in candidates if entry_species(c[0]) != "sp."]
+    if max_per_species:
+        kept = []
+        per_species = {}
+        newest = sorted(candidates, key = lambda c: c[0].get("seq_rel_date", ""), reverse = True) # ties in rank go to the newest assembly
+        for candidate in sorted(newest, key = lambda c: entry_rank(c[0])):
+            species = entry_species(candidate[0])
+            # unnamed genomes are not one species so they are never capped
+            if species != "sp." and per_species.get(species, 0) >= max_per_species:
+                continue
+            per_species[species] = per_species.get(species, 0) + 1
+            kept.append(candidate)
+        candidates = kept
+    return candidates
+
+# Remove genome directories of accessions that are not part of the current selection
+def prune(outdir, domain, accessions):
+    keep = set(accessions)
+    for genome_dir in Path(f"{outdir}/refseq/{domain}").glob("*"):
+        if genome_dir.is_dir() and genome_dir.name not in keep:
+            shutil.rmtree(genome_dir)
+    return
+
+# Write the metadata of the selected assemblies, this is where species labels are taken from downstream
+def metadata_write(outdir, entries):
+    with journal.atomic_write(f"{outdir}/{METADATA_NAME}") as f_out:
+        f_out.write("GCF\tOrganism\tSpecies\tStrain\tAssemblyLevel\tRefseqCategory\tTaxid\tSpeciesTaxid\n")
+        for entry in entries:
+            f_out.write("\t".join([entry["assembly_accession"], entry["organism_name"], entry_species(entry), get_strain(entry), entry["assembly_level"], entry["refseq_category"], entry["taxid"], entry["species_taxid"]]) + "\n")
+    return
+
+# Read the species label of each genome from the metadata written at download, empty if there is none (e.g. user genomes)
+def metadata_species(outdir):
+    species = {}
+    if not Path(f"{outdir}/{METADATA_NAME}").is_file():
+        return species
+    with open(f"{outdir}/{METADATA_NAME}", "r") as f_in:
+        next(f_in) # header
+        for line in f_in:
+            fields = line.rstrip("\n").split("\t")
+            species[fields[0]] = fields[2]
+    return species
+
+# Download one assembly, skipping it if a copy with a matching checksum is already present. Returns the accession, its fasta and if it checked out
+def fetch_assembly(candidate_config):
+    (entry, group), config = candidate_config
+    accession = entry["assembly_accession"]
+    try:
+        jobs = create_downloadjob(entry, group, config) # fetches the MD5 checksums and only makes jobs for missing or changed files
+        local_dir = Path(f"{config.output}/{config.section}/{group}/{accession}")
+        for job in jobs:
+            if not worker(job): # worker verifies the checksum after downloading
+                Path(job.local_file).unlink(missing_ok = True) # do not leave a corrupt genome behind
+                return accession, None, False
+        local_file = next(local_dir.glob("*_genomic.fna.gz"), None)
+        return accession, local_file, local_file is not None
+    except Exception as err: # a network error for one assembly should not stop the others
+        logging.getLogger("ncbi-genome-download").error(f"Download of {accession} failed: {err!r}")
+        return accession, None, False
+
 # Checking if the download worked 
 def download_checker(outdir, domain, logger, genus, sp_ignore): 
     try:
@@ -70,19 +206,3 @@ def download_checker(outdir, domain, logger, genus, sp_ignore):
         logger.error(f"Download failed because {genus} is invalid or there are no records of the requested type in NCBI")
         return 1, False
     return 0, count
-
-def sp_remove(outdir, domain):
-    sp_count = 0
-    downloads = list(Path(f"{outdir}/refseq/{domain}").rglob("*.fna.gz"))
-    for download in downloads:
-        splitline = sp_get(download)
-        if splitline[2] == "sp.":
-            shutil.rmtree(Path(download).parent)
-            sp_count += 1
-    return sp_count
-
-def sp_get(download):
-    with gzip.open(download, "r") as f_in:
-        line = f_in.readline()
-        splitline = str(line).strip().split(" ")
-    return splitline
\ No newline at end of file
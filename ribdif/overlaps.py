@@ -2,11 +2,13 @@
 
 import pandas as pd
 import numpy as np
+from ribdif import journal
 
 
 
 # Import and clean the cluster file
-def uc_cleaner(outdir, genus, name):
+# Species are taken from species_map (GCF to species from the assembly metadata) where possible and from the fasta header otherwise
+def uc_cleaner(outdir, genus, name, species_map = None):
     
     uc_path = f"{outdir}/amplicons/{name}/{genus}-{name}.uc"
     
@@ -17,7 +19,8 @@ def uc_cleaner(outdir, genus, name):
     
     # Create new columns
     uc_df_clean.loc[:, "GCF"] = ["_".join(i.split("_")[:2]) for i in uc_df_clean[8]] # GCF column
-    uc_df_clean.loc[:, "Species"] = [i.split("_")[5] for i in uc_df_clean[8]]  # Species column
+    species_map = species_map or {}
+    uc_df_clean.loc[:, "Species"] = [species_map.get(gcf, i.split("_")[5]) for gcf, i in zip(uc_df_clean.GCF, uc_df_clean[8])]  # Species column
     
     # Sorting dataframe
     #uc_df_clean = uc_df_clean.sort_values(by = ["GCF"]) # check if this matters later on
@@ -92,18 +95,21 @@ def gcf_overlaps(all_gcfs, uc_dict_clean, gcf_species):
     return pairwise_match
 
 
-def overlap_report(combinations, gcf_species, cluster_df, genus, name, outdir, logger, shannon_div, unique_species, all_species, genome_count, user):
+# weights is the dereplication cluster size of each representative GCF so counts reflect every genome that was downloaded
+def overlap_report(combinations, gcf_species, cluster_df, genus, name, outdir, logger, shannon_div, unique_species, all_species, genome_count, user, weights = None):
+    weights = weights or {}
     
     total_named_genomes = len([s for s in all_species if s != "sp."])
     total_unamed_genomes = genome_count - total_named_genomes
     total_unique_species = len(unique_species)
     
-    amplify_count = len(cluster_df.index)
-    amplify_named_genomes = len([s for s in gcf_species.values() if s != "sp."]) # Recovering species names that are not equal so "sp."
-    amplify_unamed_genomes = len(gcf_species) - amplify_named_genomes # Subtracting names species from total specpes
+    amplify_count = sum(weights.get(gcf, 1) for gcf in cluster_df.index)
+    amplify_named_genomes = sum(weights.get(gcf, 1) for gcf, s in gcf_species.items() if s != "sp.") # Recovering species names that are not equal so "sp."
+    amplify_unamed_genomes = sum(weights.get(gcf, 1) for gcf in gcf_species) - amplify_named_genomes # Subtracting names species from total specpes
     amplify_unique_species = len([i for i in set(gcf_species.values()) if i != "sp."]) # unique names speices
-    # turning the cluster_df binary with np.where and summing rows then counting the times rowsum is greater that 1
-    multi_allele = sum(np.where(cluster_df > 0, 1, 0).sum(axis = 1) > 1)
+    # turning the cluster_df binary with np.where and summing rows then weighting the rows whose sum is greater that 1
+    row_weights = np.array([weights.get(gcf, 1) for gcf in cluster_df.index])
+    multi_allele = int(((np.where(cluster_df > 0, 1, 0).sum(axis = 1) > 1) * row_weights).sum())
     if combinations: # are the unique entries into combinations greater than 0. Not sure we need the set.
         unq_combs = sorted(set(combinations), key = len, reverse = True) # getting unique combinations and sorting by reverse string length
         has_overlap = set([e for c in combinations for e in c.split("/")]) # getting a unique set of species that experienced overlap
@@ -114,7 +120,7 @@ def overlap_report(combinations, gcf_species, cluster_df, genus, name, outdir, l
         has_overlap = []
         
     count_overlap = len(has_overlap)
-    with open(f"{outdir}/{genus}_{name}_overlap_report.txt", "w+") as f_out:
+    with journal.atomic_write(f"{outdir}/{genus}_{name}_overlap_report.txt") as f_out:
         f_out.write(f"""Summary of {genus} differentiation by {name} amplicons:\n
                     Genomes downloaded: {genome_count}
                     \tWith species name: {total_named_genomes}
@@ -127,12 +133,14 @@ def overlap_report(combinations, gcf_species, cluster_df, genus, name, outdir, l
                     {multi_allele} of {amplify_count} ({round(100*multi_allele/amplify_count, 2)}%) genomes that amplified have multiple alleles.
                     {count_overlap} of {amplify_unique_species} ({0 if user else round(100*count_overlap/amplify_unique_species, 2)}%) species that experienced amplification have at least one overlap.\n
                     Total shannon diversity for {name} is: {shannon_div}\n\n""")
+        if weights:
+            f_out.write(f"Counts are weighted by dereplication cluster size, {len(cluster_df.index)} representative genomes amplified\n\n")
         if unq_combs:
             for i in range(len(unq_combs)):
                 members = unq_combs[i].split("/")
                 f_out.write(f"Group {i}:\t" + ' / '.join(members) + "\n")
-        f_out.seek(0)
-        logger.info(f_out.read())
+    with open(f"{outdir}/{genus}_{name}_overlap_report.txt", "r") as f_in:
+        logger.info(f_in.read())
         
 #[i.replace("sp.", f"sp._{x}") for x, i in enumerate(combinations) if "sp." in i]
 
@@ -1,5 +1,4 @@
 #!/usr/bin/env python3
-import multiprocessing
 import subprocess
 from pathlib import Path
 from itertools import repeat
@@ -8,7 +7,9 @@ import csv
 import fileinput
 import logging
 import shutil
+import numpy as np
 from ribdif.utils import detect_encode
+from ribdif import resources, primer_match, seed_index, journal
 """
 Implement a producer and consumer setup for writing the pcr output whe multiprocessing: https://stackoverflow.com/questions/11196367/processing-single-file-from-multiple-processes
 
@@ -33,8 +34,8 @@ def call_proc_pcr(infile, primer_path, genus, name, fwd, rvs, length, workingDir
             subprocess.run(shlex.split(command), stdout = f_std, stderr = f_err)
     return 
 
-# Multithreading the in silico pcr calls
-def pcr_parallel_call(outdir, genus, primer_file, workingDir, threads, logger, domain):
+# Multithreading the in silico pcr calls within the core and memory budget
+def pcr_parallel_call(outdir, genus, primer_file, workingDir, budget, logger, domain):
     amplicon_dir = Path(f"{outdir}/amplicons") # path to amplicon directory
     amplicon_dir.mkdir(parents = True, exist_ok = True) # making the directory
     multi = True
@@ -48,11 +49,11 @@ def pcr_parallel_call(outdir, genus, primer_file, workingDir, threads, logger, d
             if primer_path.is_dir():
                 shutil.rmtree(primer_path, ignore_errors = False)
             primer_path.mkdir(parents = True, exist_ok = False)
-            with multiprocessing.Pool(threads) as pool: # spawn the pool # opening the pool
-                all_fna = [str(i) for i in list(Path(f"{outdir}/refseq/{domain}/").rglob('*.fna'))] # generate list of files ending in .fna
-                #counter = range(len(all_fna))
-                longer_length = int((float(length)+(float(length)*0.5)))
-                pool.starmap(call_proc_pcr, zip(all_fna, repeat(primer_path), repeat(genus), repeat(name), repeat(fwd), repeat(rvs), repeat(longer_length), repeat(workingDir), repeat(multi))) # removed counter
+            all_fna = [str(i) for i in list(Path(f"{outdir}/refseq/{domain}/").rglob('*.fna'))] # generate list of files ending in .fna
+            #counter = range(len(all_fna))
+            longer_length = int((float(length)+(float(length)*0.5)))
+            costs = [resources.genome_memory(fna, "pcr") for fna in all_fna] # estimate memory of each call from genome size
+            resources.budget_starmap(call_proc_pcr, zip(all_fna, repeat(primer_path), repeat(genus), repeat(name), repeat(fwd), repeat(rvs), repeat(longer_length), repeat(workingDir), repeat(multi)), costs, budget, logger) # removed counter
             names.append(name)
             amplicon_filter(outdir, name, genus, length)
     return names
@@ -128,4 +129,56 @@ def amplicon_filter(outdir, name, genus, length):
                           if (line.startswith(">") and len(lines[i+1]) >= (length * 0.9)) 
                           or (len(line) >= (length * 0.9) and lines[i-1].startswith(">"))]
         with open(file, "w") as f_in:
-            f_in.writelines(modified_lines)
\ No newline at end of file
+            f_in.writelines(modified_lines)
+
+# PCR of every primer through the genomes' seed index. Sites either primer could start an amplicon at (up to one mismatch or one indel)
+# are looked up in the index and in_silico_PCR.pl is run only on the stretches around them, leaving the same temp amplicon and
+# summary files as the parallel PCR leaves after its book keeping
+def pcr_indexed(outdir, genus, primer_file, index, workingDir, logger):
+    amplicon_dir = Path(f"{outdir}/amplicons")
+    amplicon_dir.mkdir(parents = True, exist_ok = True)
+    logger.info("Generating amplicon sequences from the seed index\n\n")
+    encoding = detect_encode(primer_file)
+    with open(primer_file, "r", encoding = encoding) as f_primer:
+        names = []
+        for primer in f_primer:
+            name, fwd, rvs, length = primer.strip().split("\t")
+            primer_path = Path(f"{amplicon_dir}/{name}")
+            if primer_path.is_dir():
+                shutil.rmtree(primer_path, ignore_errors = False)
+            primer_path.mkdir(parents = True, exist_ok = False)
+            longer_length = int((float(length)+(float(length)*0.5)))
+            sites = np.concatenate([found for p in (fwd, rvs) for found in (seed_index.indexed_sites(index, p, 1), seed_index.indel_sites(index, p))])
+            # A start match is at most a primer and a base long and is followed by at most longer_length bases of amplicon
+            pad = max(len(primer_match.clean_primer(p)) for p in (fwd, rvs)) + 1
+            windows = seed_index.site_windows(index["offsets"], sites, pad, pad + longer_length)
+            with open(f"{primer_path}/{genus}-{name}.windows", "wb") as f_out:
+                for count, (start, end) in enumerate(windows):
+                    f_out.write(f">w{count:010d}\n".encode() + index["text"][start:end].tobytes() + b"\n")
+            if windows:
+                call_proc_pcr(f"{primer_path}/{genus}-{name}.windows", primer_path, genus, name, fwd, rvs, longer_length, workingDir, False)
+            else:
+                Path(f"{primer_path}/{genus}-{name}.temp.amplicons").touch()
+            amplified = window_summary(f"{primer_path}/{genus}-{name}.summary", windows, index)
+            Path(f"{primer_path}/{genus}-{name}.windows").unlink()
+            logger.info(f"{name} amplified {amplified} times\n")
+            names.append(name)
+    return names
+
+# Move the summary of a PCR over seed index windows back onto the sequences and positions of the genomes
+def window_summary(summary, windows, index):
+    rows = []
+    if Path(summary).is_file():
+        with open(summary, "r") as f_in:
+            rows = [line.rstrip("\n").split("\t") for line in f_in]
+    amplified = 0
+    with journal.atomic_write(summary) as f_sum:
+        f_sum.write("AmpId\tSequenceId\tPositionInSequence\tLength\tMisc\n")
+        for row in rows[1:]:
+            if len(row) < 4: # "No amplification"
+                continue
+            start = windows[int(row[1][1:])][0] + int(row[2]) - 1
+            seq = int(np.searchsorted(index["offsets"], start, side = "right")) - 1
+            f_sum.write(f"{row[0]}\t{index['labels'][seq]}\t{start - index['offsets'][seq] + 1}\t{row[3]}\t{row[4] if len(row) > 4 else ''}\n")
+            amplified += 1
+    return amplified
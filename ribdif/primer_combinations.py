@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+from itertools import combinations
+import numpy as np
+import pandas as pd
+from ribdif import incidence, journal
+from ribdif.dereplicate import mix64
+
+# Ranking combinations of primers by the genomes and species they tell apart together, from hashed allele signatures
+
+COMBINATIONS_NAME = "primer_combinations.tsv"
+
+
+# Signature of each genome's allele set for every primer, one row per primer over the union of amplified genomes
+def primer_signatures(outdir, genus, names, sp_ignore = False, exclude = None, only_species = None):
+    loaded = {name: incidence.load_incidence(outdir, genus, name) for name in names}
+    gcf_species = {}
+    for _, gcfs, species in loaded.values():
+        gcf_species.update(zip(gcfs, species))
+    all_gcfs = list(gcf_species)
+    mask = incidence.genome_mask(all_gcfs, list(gcf_species.values()), sp_ignore, exclude, only_species)
+    all_gcfs = [gcf for gcf, keep in zip(all_gcfs, mask) if keep]
+    position = {gcf: i for i, gcf in enumerate(all_gcfs)}
+
+    rng = np.random.default_rng(0)
+    signatures = np.zeros((len(names), len(all_gcfs)), dtype = np.uint64) # genomes a primer does not amplify have the empty set
+    for p, name in enumerate(names):
+        counts, gcfs, _ = loaded[name]
+        keys = rng.integers(1, np.iinfo(np.uint64).max, size = counts.shape[1], dtype = np.uint64)
+        rows = [i for i, gcf in enumerate(gcfs) if gcf in position]
+        present = np.asarray(counts[rows]) > 0
+        # uint64 sums wrap around which is what we want for a hash
+        signatures[p, [position[gcfs[i]] for i in rows]] = (present * keys).sum(axis = 1, dtype = np.uint64)
+    # Salt each primer so the same allele sets under different primers do not cancel out
+    salts = rng.integers(1, np.iinfo(np.uint64).max, size = (len(names), 1), dtype = np.uint64)
+    return mix64(signatures ^ salts), all_gcfs, [gcf_species[gcf] for gcf in all_gcfs]
+
+
+# How well one combination resolves the genomes: genomes sharing a combined signature are indistinguishable
+def resolution(combined, species_codes, named, weights):
+    _, classes = np.unique(combined, return_inverse = True)
+    classes = classes.ravel()
+    # A class is pure when all its genomes are of one species
+    n_species = species_codes.max() + 1
+    class_species = np.unique(classes.astype(np.int64) * n_species + species_codes)
+    species_per_class = np.bincount(class_species // n_species, minlength = classes.max() + 1)
+    pure = species_per_class[classes] == 1
+    genomes_per_class = np.bincount(classes)
+    unique = genomes_per_class[classes] == 1
+    # A named species is resolved when none of its genomes share a class with another species
+    impure_species = np.unique(species_codes[~pure])
+    resolved_species = int(np.count_nonzero(named) - np.count_nonzero(named[impure_species]))
+    return resolved_species, int(weights[pure].sum()), int(weights[unique].sum()), int(genomes_per_class.size)
+
+
+# Rank every combination of up to max_size primers by the species and then genomes they resolve
+def rank_combinations(outdir, genus, names, max_size, logger, weights = None, sp_ignore = False, exclude = None, only_species = None):
+    signatures, gcfs, species = primer_signatures(outdir, genus, names, sp_ignore, exclude, only_species)
+    weights = weights or {}
+    genome_weights = np.array([weights.get(gcf, 1) for gcf in gcfs], dtype = np.int64)
+    species_names, species_codes = np.unique(np.array(species, dtype = str), return_inverse = True)
+    species_codes = species_codes.ravel()
+    named = species_names != "sp."
+
+    results = []
+    for size in range(1, min(max_size, len(names)) + 1):
+        for combo in combinations(range(len(names)), size):
+            combined = signatures[list(combo)].sum(axis = 0, dtype = np.uint64)
+            results.append(([names[p] for p in combo],) + resolution(combined, species_codes, named, genome_weights))
+    # Most species first, then most genomes, then the fewest primers
+    results.sort(key = lambda r: (-r[1], -r[2], len(r[0]), r[0]))
+
+    with journal.atomic_write(f"{outdir}/{genus}_{COMBINATIONS_NAME}") as f_out:
+        f_out.write("Primers\tPrimerCount\tResolvedSpecies\tNamedSpecies\tSpeciesResolvedGenomes\tUniqueGenomes\tGenomes\tProfiles\n")
+        for primers, resolved_species, resolved_genomes, unique_genomes, n_profiles in results:
+            f_out.write(f"{'+'.join(primers)}\t{len(primers)}\t{resolved_species}\t{int(named.sum())}\t{resolved_genomes}\t{unique_genomes}\t{int(genome_weights.sum())}\t{n_profiles}\n")
+
+    best = pd.read_csv(f"{outdir}/{genus}_{COMBINATIONS_NAME}", sep = "\t").head(10)
+    logger.info(f"Best primer combinations of up to {max_size} primers (all {len(results)} are in {outdir}/{genus}_{COMBINATIONS_NAME}):\n{best.to_string(index = False)}\n\n")
+    return results
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+import gzip
+import numpy as np
+
+# In process primer matching and amplification, following in_silico_PCR.pl
+
+SEQUENCE_CODES = np.full(256, 16, dtype = np.uint8) # anything but A, C, G and T only matches an N in the primer
+for base, code in {"A": 1, "C": 2, "G": 4, "T": 8}.items():
+    SEQUENCE_CODES[ord(base)] = code
+SEPARATOR = ord(">")
+SEQUENCE_CODES[SEPARATOR] = 0 # matches nothing at all
+
+PRIMER_CODES = np.zeros(256, dtype = np.uint8)
+for base, code in {"A": 1, "C": 2, "G": 4, "T": 8, "U": 8, "R": 5, "Y": 10, "S": 6, "W": 9, "K": 12, "M": 3,
+                   "B": 14, "D": 13, "H": 11, "V": 7, "N": 31}.items():
+    PRIMER_CODES[ord(base)] = code
+
+BLOCK = 1 << 24 # positions scanned at once
+COMPLEMENT = str.maketrans("ACGTURYKMBVDHNacgturykmbvdhn", "TGCAAYRMKVBHDNtgcaayrmkvbhdn")
+
+
+# Reverse complement of a sequence or primer
+def revcomp(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+# Clean a primer the way in_silico_PCR.pl does, upper case without digits or punctuation
+def clean_primer(primer):
+    return "".join(c for c in primer.upper() if c.isalpha())
+
+
+# Read the records of fasta files (gzipped or not) as (label, sequence) pairs, labels stop at the first space like in_silico_PCR.pl's ids
+def read_fasta(paths):
+    for path in paths:
+        label, seq = None, []
+        with (gzip.open(path, "rt") if str(path).endswith(".gz") else open(path, "r")) as f_in:
+            for line in f_in:
+                if line.startswith(">"):
+                    if label is not None:
+                        yield label, "".join(seq)
+                    label, seq = line[1:].split()[0], []
+                else:
+                    seq.append(line.strip())
+        if label is not None:
+            yield label, "".join(seq)
+
+
+# Upper case bytes of a sequence with everything that is not a letter dropped, as in_silico_PCR.pl reads sequences
+def clean_sequence(seq):
+    seq = np.frombuffer(seq.encode() if isinstance(seq, str) else seq, dtype = np.uint8) & 0xDF
+    return seq[(seq >= ord("A")) & (seq <= ord("Z"))]
+
+
+# Concatenate sequences into one byte array and its masks, with the start offset of every sequence
+def encode_sequences(seqs):
+    cleaned = [clean_sequence(seq) for seq in seqs]
+    offsets = np.zeros(len(cleaned) + 1, dtype = np.int64)
+    offsets[1:] = np.cumsum([len(seq) + 1 for seq in cleaned])
+    text = np.full(offsets[-1], SEPARATOR, dtype = np.uint8)
+    for start, seq in zip(offsets, cleaned):
+        text[start:start + len(seq)] = seq
+    return text, SEQUENCE_CODES[text], offsets
+
+
+# Mismatches of a primer at every position, positions where the primer would run over a separator or the end get the primer length
+def mismatch_counts(codes, primer_codes):
+    length = len(primer_codes)
+    n_positions = max(len(codes) - length + 1, 0)
+    mismatches = np.full(len(codes), length, dtype = np.uint8 if length < 256 else np.uint16)
+    if n_positions == 0:
+        return mismatches
+    mismatches[:n_positions] = 0
+    for i, base in enumerate(primer_codes):
+        mismatches[:n_positions] += (codes[i:i + n_positions] & base) == 0
+    # Primers never span two sequences
+    separators = np.concatenate([[0], np.cumsum(codes == 0)])
+    mismatches[:n_positions][separators[length:length + n_positions] > separators[:n_positions]] = length
+    return mismatches
+
+
+# Positions a primer binds at with at most the given number of mismatches, along with the mismatch count at each
+def primer_sites(codes, primer, max_mismatches = 1):
+    primer_codes = PRIMER_CODES[np.frombuffer(clean_primer(primer).encode(), dtype = np.uint8)]
+    positions, counts = [], []
+    # Whole genomes are scanned a block at a time so the temporary arrays stay small
+    for block in range(0, max(len(codes), 1), BLOCK):
+        mismatches = mismatch_counts(codes[block:block + BLOCK + len(primer_codes) - 1], primer_codes)[:BLOCK]
+        hits = np.flatnonzero(mismatches <= max_mismatches)
+        positions.append(hits + block)
+        counts.append(mismatches[hits])
+    return np.concatenate(positions), np.concatenate(counts)
+
+
+# Binding sites of a primer, kept in a cache shared by every pair that uses the primer
+def cached_sites(codes, primer, max_mismatches, site_cache):
+    if site_cache is None:
+        return primer_sites(codes, primer, max_mismatches)[0]
+    if primer not in site_cache:
+        site_cache[primer] = primer_sites(codes, primer, max_mismatches)[0]
+    return site_cache[primer]
+
+
+# Amplicons of a primer pair as (start, length, forward) arrays in sequence order, following in_silico_PCR.pl -r
+def amplify(codes, offsets, fwd, rvs, max_length, max_mismatches = 1, site_cache = None):
+    fwd, rvs = clean_primer(fwd), clean_primer(rvs)
+    fwd_sites, rvs_sites = cached_sites(codes, fwd, max_mismatches, site_cache), cached_sites(codes, rvs, max_mismatches, site_cache)
+
+    # Starts are matches of either primer taken left to right without overlapping, like the regular expression split
+    starts = np.concatenate([fwd_sites, rvs_sites])
+    start_len = np.concatenate([np.full(len(fwd_sites), len(fwd)), np.full(len(rvs_sites), len(rvs))])
+    is_fwd = np.concatenate([np.ones(len(fwd_sites), dtype = bool), np.zeros(len(rvs_sites), dtype = bool)])
+    order = np.lexsort((~is_fwd, starts)) # the forward primer is the first alternative of the pattern
+    starts, start_len, is_fwd = starts[order], start_len[order], is_fwd[order]
+    keep = np.zeros(len(starts), dtype = bool)
+    next_free = -1
+    for i in range(len(starts)):
+        if starts[i] >= next_free:
+            keep[i] = True
+            next_free = starts[i] + start_len[i]
+    starts, start_len, is_fwd = starts[keep], start_len[keep], is_fwd[keep]
+    if len(starts) == 0:
+        return starts, starts.copy(), is_fwd
+
+    # An amplicon ends at the first reverse complemented primer after its start, before the next start or the end of its sequence
+    end_fwd, end_rvs = cached_sites(codes, revcomp(fwd), max_mismatches, site_cache), cached_sites(codes, revcomp(rvs), max_mismatches, site_cache)
+    # Reversing the start pattern puts the reverse primer first, which wins where both end at the same position
+    ends = np.concatenate([end_rvs, end_fwd])
+    end_len = np.concatenate([np.full(len(end_rvs), len(rvs)), np.full(len(end_fwd), len(fwd))])
+    if len(ends) == 0:
+        return starts[:0], starts[:0].copy(), is_fwd[:0]
+    order = np.argsort(ends, kind = "stable")
+    ends, end_len = ends[order], end_len[order]
+    after = starts + start_len
+    first = np.minimum(np.searchsorted(ends, after), len(ends) - 1)
+    stop = ends[first] + end_len[first]
+    limit = np.minimum(after + max_length, offsets[np.searchsorted(offsets, starts, side = "right")] - 1)
+    limit[:-1] = np.minimum(limit[:-1], starts[1:])
+    found = (ends[first] >= after) & (stop <= limit)
+    return starts[found], (stop - starts)[found], is_fwd[found]
+
+
+# Which sequence each position falls in
+def sequence_of(positions, offsets):
+    return np.searchsorted(offsets, positions, side = "right") - 1
+
+
+# Sequence of an amplicon, reverse complemented when it started with the reverse primer as in_silico_PCR.pl -r does
+def amplicon_sequence(text, start, length, forward):
+    seq = text[start:start + length].tobytes().decode()
+    return seq if forward else revcomp(seq)
@@ -4,6 +4,7 @@ import multiprocessing
 import subprocess
 import shlex
 from pathlib import Path
+from ribdif import journal
 
 # Spawning the shell call
 def call_proc_pyani(indir):
@@ -12,13 +13,19 @@ def call_proc_pyani(indir):
     command = f"average_nucleotide_identity.py -i {indir} -o {aniDir}"
     # Passing the command to shell piping the stdout and stderr
     subprocess.run(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return
+    return indir
 
 
 # Multithreading the pyani calls
-def pyani_call(outdir, threads, domain):
+# Genomes already checkpointed in the journal state are skipped when resuming
+def pyani_call(outdir, threads, domain, state = None):
+    all_16S_dirs = [i for i in glob(f"{outdir}/refseq/{domain}/*/indiv_16S_dir")] # can we use a faster method than glob?
+    ani_out = lambda indir: Path(indir).parent / "ani" / "ANIm_similarity_errors.tab"
+    if state is not None:
+        all_16S_dirs = journal.pending_genomes(state, "ani", all_16S_dirs, ani_out)
     with multiprocessing.Pool(threads) as pool: # spawn the pool
-        all_16S_dirs = [i for i in glob(f"{outdir}/refseq/{domain}/*/indiv_16S_dir")] # can we use a faster method than glob?
-        pool.map(call_proc_pyani, all_16S_dirs)
+        for indir in pool.imap_unordered(call_proc_pyani, all_16S_dirs):
+            if state is not None:
+                journal.record_genome(outdir, state, "ani", indir, ani_out)
     return
 
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import logging
+import multiprocessing
+from pathlib import Path
+import numpy as np
+from ribdif import figures, incidence, resources, dereplicate
+
+# Figure rendering from the saved allele incidence, straight after the reports or later with ribdif-figures
+
+# Draw the heatmaps and graphs of one primer
+def render_figures(cluster_df, gcf_species, outdir, genus, name, logger, threads = 1, weights = None):
+    # A single genome cannot be clustered (scipy's linkage needs two rows) and its figures would be useless anyway
+    if len(cluster_df.index) < 2:
+        logger.info(f"Only {len(cluster_df.index)} genome amplified for the {name} primer so we will skip making figures as they would be useless\n")
+        return
+    # Generate metadata for heatmaps
+    row_palette, species_series, species_palette = figures.heatmap_meta(gcf_species)
+
+    if len(cluster_df.index) > figures.LARGE_GENUS:
+        # Too many genomes for one row each, plot collapsed allele profiles instead
+        logger.info(f"{len(cluster_df.index)} genomes amplified for {name}, drawing the heatmaps from collapsed allele profiles\n")
+        plot_clus, plot_dendo = figures.large_heatmaps(cluster_df, species_series, species_palette)
+    else:
+        # Plot the cluster matrix
+        cluster_dict = {gcf: row for gcf, row in zip(cluster_df.index, cluster_df.to_numpy().tolist())}
+        plot_clus, _ = figures.cluster_heatmap(cluster_dict, row_palette, species_series)
+
+        # Plot the GCF overlap matrix, genomes overlap if they share any allele
+        pairwise_match = incidence.pairwise_overlaps(cluster_df)
+        plot_dendo, _ = figures.pairwise_heatmap(pairwise_match, row_palette, species_series)
+
+        plot_clus = figures.figure_fix(plot_clus)
+        plot_dendo = figures.figure_fix(plot_dendo)
+
+    # Save the heatmaps
+    figures.pdf_save(plot_clus, plot_dendo, outdir, genus, name)
+
+    # Species confusion, its size set by the number of species however many genomes there are
+    figures.species_confusion_heatmap(incidence.species_confusion(cluster_df, gcf_species, weights), outdir, genus, name)
+
+    # Generate graps from the cluster incidence
+    large = len(cluster_df.index) > figures.LARGE_GENUS
+    if not large:
+        adjacency, nodes = figures.create_adjacency(cluster_df)
+        graph_subs, n_subplots = figures.create_graph(adjacency, nodes)
+        large = n_subplots > figures.GRAPHS_PER_PAGE
+    if large:
+        # Too much for one page, graph the collapsed allele profiles and paginate
+        graph_subs = figures.profile_graphs(cluster_df, gcf_species)
+        n_subplots = len(graph_subs)
+
+    if n_subplots != 0 and large:
+        figures.draw_large_graphs(graph_subs, species_palette, outdir, genus, name, threads)
+    elif n_subplots != 0:
+        # Draw the generated graps into on plot
+        figures.draw_graphs(graph_subs, n_subplots, species_palette, row_palette, outdir, genus, name)
+    else:
+        logger.info(f"Skipping graph making for {name} as no edges were found (even within a single species)\n")
+    return
+
+
+# Render the figures of one saved primer
+def render_saved(outdir, genus, name, logger, threads = 1):
+    counts, gcfs, species = incidence.load_incidence(outdir, genus, name)
+    cluster_df, gcf_species = incidence.filtered_clusters(counts, gcfs, species, np.ones(len(gcfs), dtype = bool))
+    logger.info(f"Drawing figures for {genus} {name}\n")
+    weights, _ = dereplicate.derep_weights(outdir)
+    render_figures(cluster_df, gcf_species, outdir, genus, name, logger, threads, weights)
+    return name
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description = "Draw the heatmaps and graphs of a RibDif2 run from the allele incidence it saved, e.g. after running with --defer-figures")
+    parser.add_argument("-o", "--outdir", dest = "outdir",
+                        help = "Output directory of the RibDif2 run (the one containing amplicons/ and figures/)",
+                        required = True)
+    parser.add_argument("-p", "--primers", dest = "primers",
+                        help = "Comma separated names of the primers to draw. Default is every primer with a saved incidence",
+                        default = None)
+    parser.add_argument("-t", "--threads", dest = "threads",
+                        help = "Number of threads to use. Default is all available",
+                        default = os.cpu_count(),
+                        type = int)
+    parser.add_argument("--memory", dest = "memory",
+                        help = "Memory budget in GB shared by the primers drawn at once. Default is 90%% of the currently available memory",
+                        default = None,
+                        type = float)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(console_handler)
+
+    outdir = Path(args.outdir).resolve()
+    # Each primer's incidence is amplicons/<name>/<genus>-<name>_incidence.npy
+    saved = sorted((path.name[:-len(f"-{path.parent.name}{incidence.INCIDENCE_SUFFIX}")], path.parent.name, path)
+                   for path in Path(f"{outdir}/amplicons").glob(f"*/*-*{incidence.INCIDENCE_SUFFIX}")
+                   if path.name.endswith(f"-{path.parent.name}{incidence.INCIDENCE_SUFFIX}"))
+    if args.primers:
+        wanted = set(args.primers.split(","))
+        saved = [primer for primer in saved if primer[1] in wanted]
+    if not saved:
+        logger.error(f"No saved allele incidence found in {outdir}/amplicons")
+        raise SystemExit(1)
+    Path(f"{outdir}/figures").mkdir(exist_ok = True)
+
+    # Primers are drawn in parallel, each admitted while its incidence fits in the memory budget
+    budget = resources.make_budget(args.threads, args.memory)
+    costs = [resources.incidence_memory(path) for _, _, path in saved]
+    threads = resources.tool_threads(budget, min(len(saved), budget["cores"]))
+    done = resources.budget_starmap(render_saved, [(outdir, genus, name, logger, threads) for genus, name, _ in saved], costs, budget, logger)
+    logger.info(f"Drew figures for {', '.join(done)} in {outdir}/figures")
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    main()
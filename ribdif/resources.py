@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+import os
+import threading
+import multiprocessing
+from pathlib import Path
+import numpy as np
+
+# Core and memory budgeting, so each stage only runs as many tasks at once as both -t/--threads and --memory allow
+
+MB = 1024 ** 2
+GB = 1024 ** 3
+
+# Size of a large bacterial genome, used when the genome has not been downloaded yet
+TYPICAL_GENOME = 12 * MB
+
+# Baseline memory of a single external tool call before it has read any input
+TOOL_BASE = {"barrnap": 150 * MB, "pcr": 50 * MB, "mafft": 100 * MB, "fasttree": 50 * MB, "vsearch": 50 * MB, "reports": 300 * MB}
+
+
+# Get the memory currently available on this node in bytes
+def available_memory():
+    try:
+        with open("/proc/meminfo", "r") as f_in:
+            for line in f_in:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024 # reported in kB
+    except OSError: # not on linux
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return 8 * GB # Could not work it out so assume a modest workstation
+
+
+# Resolve the user given memory limit (in GB) into a budget in bytes
+def memory_budget(memory):
+    if memory:
+        return int(float(memory) * GB)
+    return int(available_memory() * 0.9) # leave a little headroom for the main process and the OS
+
+
+# Build the budget handed to every stage
+def make_budget(threads, memory):
+    return {"cores": max(1, int(threads)), "memory": memory_budget(memory)}
+
+
+# Number of parallel connections for ncbi-genome-download. Downloads are network bound so we allow more than cores but cap it to be kind to NCBI
+def download_parallel(budget):
+    return max(1, min(budget["cores"] * 2, 16))
+
+
+# Number of concurrent workers for a stage given a per task memory estimate
+def pool_size(budget, per_task, n_tasks = None):
+    workers = budget["cores"]
+    if per_task:
+        workers = min(workers, budget["memory"] // per_task)
+    if n_tasks is not None:
+        workers = min(workers, n_tasks)
+    return max(1, int(workers))
+
+
+# Split the cores between concurrently running tasks so each tool gets its share rather than all of them
+def tool_threads(budget, concurrent = 1):
+    return max(1, budget["cores"] // max(1, concurrent))
+
+
+# Memory estimate for a tool reading a genome (or any fasta) of a given size on disk
+def genome_memory(path, tool):
+    try:
+        size = Path(path).stat().st_size
+    except (OSError, TypeError):
+        size = 0
+    if str(path).endswith(".gz"):
+        size *= 4 # rough compression ratio of genomic fasta
+    # barrnap holds the genome and its nhmmer hits in memory, the perl PCR script reads each contig into a string and its reverse complement
+    multiplier = {"barrnap": 6, "pcr": 4}.get(tool, 2)
+    return TOOL_BASE.get(tool, 50 * MB) + size * multiplier
+
+
+# Memory estimate for a tool reading a genome we do not have yet
+def typical_genome_memory(tool):
+    return genome_memory(None, tool) + TYPICAL_GENOME * {"barrnap": 6, "pcr": 4}.get(tool, 2)
+
+
+# Count the sequences and get the longest sequence of a fasta file without holding it in memory
+def fasta_dimensions(path):
+    n_seqs, max_len, current = 0, 0, 0
+    try:
+        with open(path, "r") as f_in:
+            for line in f_in:
+                if line.startswith(">"):
+                    n_seqs += 1
+                    max_len = max(max_len, current)
+                    current = 0
+                else:
+                    current += len(line.strip())
+    except OSError:
+        return 0, 0
+    return n_seqs, max(max_len, current)
+
+
+# Memory estimate for aligning a fasta file with mafft and building a tree with fasttree
+def alignment_memory(n_seqs, seq_len):
+    # mafft FFT-NS-2 keeps an N x N distance matrix and the alignment itself, fasttree needs a profile per sequence
+    matrix = n_seqs * n_seqs * 8
+    alignment = n_seqs * seq_len * 2 * 4
+    return TOOL_BASE["mafft"] + matrix + alignment
+
+
+# Memory estimate for making the reports of a single primer from its amplicon file
+def reports_memory(amplicon_path, msa):
+    n_seqs, seq_len = fasta_dimensions(amplicon_path)
+    # The confusion matrix and its heatmap are genome x genome, the amplicon count is a safe upper bound on the genome count
+    estimate = TOOL_BASE["reports"] + n_seqs * n_seqs * 8 * 3
+    if msa:
+        estimate = max(estimate, alignment_memory(n_seqs, seq_len))
+    return estimate
+
+
+# Memory estimate for drawing the figures of a primer from its saved allele incidence
+def incidence_memory(path):
+    try:
+        n_genomes, n_alleles = np.load(path, mmap_mode = "r").shape # only reads the header
+    except (OSError, ValueError):
+        return TOOL_BASE["reports"]
+    # The incidence is made dense and copied while clustering, the small heatmaps also hold a genome x genome confusion matrix
+    return TOOL_BASE["reports"] + n_genomes * n_alleles * 4 * 4 + min(n_genomes, 1000) ** 2 * 8 * 3
+
+
+# Run func over a list of argument tuples only admitting tasks while the memory of the running tasks fits in the budget
+# on_done(i, result) is called in the parent as each task finishes (e.g. to checkpoint it)
+def budget_starmap(func, arg_list, costs, budget, logger = None, on_done = None):
+    arg_list = list(arg_list)
+    costs = list(costs)
+    if not arg_list:
+        return []
+    workers = min(budget["cores"], len(arg_list))
+    results = [None] * len(arg_list)
+    lock = threading.Condition()
+    state = {"memory": 0, "running": 0}
+    errors = []
+
+    # Callbacks run in the pools result handler thread so release the memory there
+    def release(cost):
+        def callback(_):
+            with lock:
+                state["memory"] -= cost
+                state["running"] -= 1
+                lock.notify_all()
+        return callback
+
+    def store(i, cost):
+        release_cost = release(cost)
+        def callback(result):
+            results[i] = result
+            try:
+                if on_done:
+                    on_done(i, result)
+            except Exception as err: # an exception here would kill the result handler and leave the admission loop waiting forever
+                errors.append(err)
+            finally:
+                release_cost(result)
+        return callback
+
+    def failed(cost):
+        release_cost = release(cost)
+        def callback(err):
+            errors.append(err)
+            release_cost(err)
+        return callback
+
+    with multiprocessing.Pool(workers) as pool:
+        jobs = []
+        for i, (args, cost) in enumerate(zip(arg_list, costs)):
+            if cost > budget["memory"] and logger:
+                logger.warning(f"A task is estimated to need {round(cost/GB, 2)}GB which is more than the {round(budget['memory']/GB, 2)}GB budget. Running it on its own.\n")
+            with lock:
+                # Wait until there is a free core and either the memory fits or nothing else is running (so oversized tasks still run, just alone)
+                while state["running"] >= workers or (state["running"] > 0 and state["memory"] + cost > budget["memory"]):
+                    lock.wait()
+                state["memory"] += cost
+                state["running"] += 1
+            jobs.append(pool.apply_async(func, args, callback = store(i, cost), error_callback = failed(cost)))
+        for job in jobs:
+            job.wait()
+    if errors:
+        raise errors[0]
+    return results
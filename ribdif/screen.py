@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import logging
+import multiprocessing
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from ribdif import primer_match, journal, ngd_download, atlas, store
+from ribdif.id_sweep import canonical
+
+# High throughput screening of candidate primer pairs against the genomes of an existing run (ribdif screen)
+
+SCREEN_NAME = "primer_screen.tsv"
+COLUMNS = ["Name", "Forward", "Reverse", "Genomes", "Amplified", "AmplificationRate", "Amplicons", "MinLength",
+           "MedianLength", "MaxLength", "LengthSpread", "Alleles", "NamedSpecies", "ResolvedSpecies"]
+
+# The preloaded sequences, set in the parent before forking so the workers share them rather than getting copies
+LOADED = {}
+
+
+# Read and encode the sequences of a run once, keeping each distinct sequence once along with the genomes it occurs in
+def load_sequences(rundir, genus, whole, domain, logger):
+    genome_dir = Path(f"{rundir}/refseq/{domain}")
+    if whole:
+        paths = sorted(str(i) for i in genome_dir.glob("*/*.fna"))
+    else:
+        paths = [f"{rundir}/full/{genus}.16S"]
+    species_map = ngd_download.metadata_species(rundir)
+    # User genomes are in directories named without the GCF_ their headers start with
+    genome_dirs = {}
+    for fna in sorted(genome_dir.glob("*/*.fna")):
+        genome_dirs[fna.parent.name] = genome_dirs[f"GCF_{fna.parent.name}"] = fna.parent.name
+
+    genome_species = {}
+    packed = distinct_sequences(run_records(paths, genome_dirs, species_map, genome_species))
+    # Genomes that gave no sequence (e.g. no 16S gene found) still count towards the amplification rate
+    for gcf in dict.fromkeys(genome_dirs.values()):
+        genome_species.setdefault(gcf, species_map.get(gcf, "sp."))
+    return packed_sequences(*packed, genome_species, logger)
+
+
+# The (genome, label, sequence) records of a run's sequences, noting each genome's species as it is first seen
+def run_records(paths, genome_dirs, species_map, genome_species):
+    for label, seq in primer_match.read_fasta(paths):
+        fields = label.split("_")
+        gcf = genome_dirs.get("_".join(fields[:2]), "_".join(fields[:2]))
+        if gcf not in genome_species:
+            genome_species[gcf] = species_map.get(gcf, fields[5] if len(fields) > 5 else "sp.")
+        yield gcf, label, seq
+
+
+# Take the 16S copies of some genera from a genome store's atlas, which already holds each distinct sequence once
+def load_atlas_sequences(genome_store, domain, genera, logger):
+    loaded_atlas = atlas.load_atlas(genome_store, domain)
+    copies = atlas.atlas_slice(loaded_atlas, genera)
+    accessions, first = np.unique(copies["Accession"].to_numpy(), return_index = True)
+    genome_species = dict(zip(accessions, copies["Species"].to_numpy()[first]))
+    # Genomes without a 16S gene are in the atlas as allele -1
+    copy_alleles = copies["Allele"].astype(np.int64).to_numpy()
+    has_16S = copy_alleles >= 0
+    alleles, occ_seq = np.unique(copy_alleles[has_16S], return_inverse = True)
+    return packed_sequences(atlas.allele_sequences(loaded_atlas, alleles), occ_seq.ravel(), copies["Accession"].to_numpy()[has_16S],
+                            copies["Label"].to_numpy()[has_16S], genome_species, logger)
+
+
+# Keep each distinct sequence of some (genome, label, sequence) records once, along with the genome and label of every occurrence of it
+def distinct_sequences(records):
+    seq_index, seqs, occ_seq, occ_genome, occ_label = {}, [], [], [], []
+    for gcf, label, seq in records:
+        seq = seq.upper()
+        if seq not in seq_index:
+            seq_index[seq] = len(seqs)
+            seqs.append(seq)
+        occ_seq.append(seq_index[seq])
+        occ_genome.append(gcf)
+        occ_label.append(label)
+    return seqs, occ_seq, occ_genome, occ_label
+
+
+# Encode the distinct sequences along with which genome each occurrence of them is in, genome_species giving the species of every genome in order
+def packed_sequences(seqs, occ_seq, occ_genome, occ_label, genome_species, logger):
+    text, codes, offsets = primer_match.encode_sequences(seqs)
+    occ_seq = np.array(occ_seq, dtype = np.int64)
+    seq_count = np.bincount(occ_seq, minlength = len(seqs))
+    logger.info(f"Loaded {len(occ_seq)} sequences ({len(seqs)} distinct, {round(len(text)/1e6, 2)}Mb) from {len(genome_species)} genomes\n")
+    species_names, species_codes = np.unique(np.array(list(genome_species.values()), dtype = str), return_inverse = True)
+    return {"text": text, "codes": codes, "offsets": offsets, "seq_count": seq_count,
+            "seq_first": np.concatenate([[0], np.cumsum(seq_count)]), "occ_order": np.argsort(occ_seq, kind = "stable"),
+            "occ_genome": pd.Index(list(genome_species)).get_indexer(occ_genome).astype(np.int64),
+            "occ_label": np.array(occ_label, dtype = object), "genome_species": genome_species, "n_genomes": len(genome_species),
+            "species_codes": species_codes.ravel(), "named": species_names != "sp."}
+
+
+# Read the candidate primers, in the same tab separated format as a primer file (name, forward, reverse, amplicon length)
+def read_candidates(path):
+    candidates = []
+    with open(path, "r", encoding = "utf-8-sig") as f_in:
+        for line in f_in:
+            if not line.strip() or line.startswith("#"):
+                continue
+            name, fwd, rvs, length = line.strip().split("\t")[:4]
+            candidates.append((name, fwd, rvs, length))
+    return candidates
+
+
+# Evaluate one pair against the preloaded sequences
+def evaluate(name, fwd, rvs, length, max_mismatches, site_cache):
+    loaded = LOADED
+    max_length = int((float(length)+(float(length)*0.5))) # the same maximum length as the pipeline's PCR
+    starts, lengths, forward = primer_match.amplify(loaded["codes"], loaded["offsets"], fwd, rvs, max_length, max_mismatches, site_cache)
+    seq_of = primer_match.sequence_of(starts, loaded["offsets"])
+
+    # Alleles are the distinct amplicons on either strand
+    allele_of, alleles = np.empty(len(starts), dtype = np.int64), {}
+    for i, (start, amp_len, fwd_strand) in enumerate(zip(starts, lengths, forward)):
+        allele_of[i] = alleles.setdefault(canonical(primer_match.amplicon_sequence(loaded["text"], start, amp_len, fwd_strand)), len(alleles))
+
+    # Every amplicon of a distinct sequence is an amplicon of each genome the sequence occurs in
+    seq_count, seq_first, occ_order = loaded["seq_count"], loaded["seq_first"], loaded["occ_order"]
+    repeats = seq_count[seq_of]
+    amp_index = np.repeat(np.arange(len(starts)), repeats)
+    within = np.arange(len(amp_index)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    genomes = loaded["occ_genome"][occ_order[seq_first[seq_of[amp_index]] + within]]
+    amp_lengths = lengths[amp_index]
+
+    # Genome x allele presence, a species is resolved when none of its alleles are shared with another species
+    genome_allele = np.unique(genomes * max(len(alleles), 1) + allele_of[amp_index])
+    pair_genome, pair_allele = genome_allele // max(len(alleles), 1), genome_allele % max(len(alleles), 1)
+    amplified = np.unique(pair_genome)
+    species_codes, named = loaded["species_codes"], loaded["named"]
+    n_species = len(named)
+    allele_species = np.unique(pair_allele * n_species + species_codes[pair_genome])
+    shared = np.bincount(allele_species // n_species, minlength = len(alleles)) > 1
+    unresolved = np.unique(allele_species[shared[allele_species // n_species]] % n_species)
+    amplified_species = np.unique(species_codes[amplified])
+    resolved = np.setdiff1d(amplified_species, unresolved)
+
+    rate = len(amplified) / loaded["n_genomes"] if loaded["n_genomes"] else 0
+    if len(amp_lengths):
+        stats = [int(amp_lengths.min()), float(np.median(amp_lengths)), int(amp_lengths.max()), int(amp_lengths.max() - amp_lengths.min())]
+    else:
+        stats = ["NA", "NA", "NA", "NA"]
+    return [name, fwd, rvs, loaded["n_genomes"], len(amplified), round(rate, 4), len(amp_lengths)] + stats + \
+           [len(alleles), int(named[amplified_species].sum()), int(named[resolved].sum())]
+
+
+# Evaluate a batch of pairs, sharing the binding sites of primers they have in common
+def evaluate_batch(batch, max_mismatches):
+    site_cache = {}
+    return [evaluate(name, fwd, rvs, length, max_mismatches, site_cache) for name, fwd, rvs, length in batch]
+
+
+# Screen every candidate pair, streaming results to a partial table and ranking it once all are done
+def screen(candidates, out_path, threads, batch_size, max_mismatches, logger):
+    # Pairs sharing a primer go in the same batch where possible
+    candidates = sorted(candidates, key = lambda c: (primer_match.clean_primer(c[1]), primer_match.clean_primer(c[2])))
+    batches = [(candidates[i:i + batch_size], max_mismatches) for i in range(0, len(candidates), batch_size)]
+    partial = f"{out_path}.partial"
+    done = 0
+    # Forked workers see the preloaded sequences without copying them
+    with open(partial, "w") as f_part, multiprocessing.get_context("fork").Pool(threads) as pool:
+        f_part.write("\t".join(COLUMNS) + "\n")
+        for rows in pool.imap_unordered(batch_call, batches):
+            for row in rows:
+                f_part.write("\t".join(str(value) for value in row) + "\n")
+            f_part.flush()
+            done += len(rows)
+            logger.info(f"Screened {done}/{len(candidates)} primer pairs")
+
+    # Most species resolved, then most genomes amplified, then the tightest lengths
+    ranked = pd.read_csv(partial, sep = "\t", dtype = {"Name": str, "Forward": str, "Reverse": str, "MinLength": "Int64", "MaxLength": "Int64", "LengthSpread": "Int64"})
+    ranked = ranked.sort_values(["ResolvedSpecies", "AmplificationRate", "LengthSpread", "Name"], ascending = [False, False, True, True], na_position = "last")
+    with journal.atomic_write(out_path) as f_out:
+        ranked.to_csv(f_out, sep = "\t", index = False, na_rep = "NA")
+    os.remove(partial)
+    return ranked
+
+
+# Pool helper unpacking a batch and its mismatch allowance
+def batch_call(batch_args):
+    return evaluate_batch(*batch_args)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog = "ribdif screen",
+        description = "Screen a table of candidate primer pairs against the genomes of a RibDif2 run, ranking them by species resolution, amplification rate and amplicon length spread")
+    source = parser.add_mutually_exclusive_group(required = True)
+    source.add_argument("-r", "--run", dest = "run",
+                        help = "Output directory of a RibDif2 run to take the genomes from (the one containing refseq/ and full/)")
+    source.add_argument("--atlas", dest = "atlas",
+                        help = "Comma separated genera (or all) to take the 16S genes of from the 16S atlas of the genome store, without reading any genomes")
+    parser.add_argument("--genome-store", dest = "genome_store",
+                        help = "Genome store holding the atlas for --atlas. Can also be set with the RIBDIF_GENOME_STORE environment variable",
+                        default = None)
+    parser.add_argument("-c", "--candidates", dest = "candidates",
+                        help = "Tab separated candidate primers in the primer file format: name, forward, reverse and amplicon length",
+                        required = True)
+    parser.add_argument("-o", "--output", dest = "output",
+                        help = f"Path of the ranked table. Default is <run>/<genus>_{SCREEN_NAME}, or <genera>_{SCREEN_NAME} in the current directory with --atlas",
+                        default = None)
+    parser.add_argument("-w", "--whole-genome", dest = "whole",
+                        help = "Screen against the whole genomes rather than their 16S genes (needed for non 16S primers)",
+                        action = "store_true")
+    parser.add_argument("-d", "--domain", dest = "domain",
+                        help = "Domain the run's genomes were downloaded for. Default is bacteria",
+                        default = "bacteria")
+    parser.add_argument("-t", "--threads", dest = "threads",
+                        help = "Number of threads to use. Default is all available",
+                        default = os.cpu_count(),
+                        type = int)
+    parser.add_argument("--mismatches", dest = "mismatches",
+                        help = "Mismatches allowed per primer. Default is 1, as in the pipeline's PCR",
+                        default = 1,
+                        type = int)
+    parser.add_argument("--batch", dest = "batch",
+                        help = "Primer pairs matched together by a worker. Default is 50",
+                        default = 50,
+                        type = int)
+    return parser.parse_args(argv)
+
+
+def main(argv = None):
+    args = parse_args(argv)
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(console_handler)
+
+    candidates = read_candidates(args.candidates)
+    if args.atlas:
+        genome_store = store.store_path(args.genome_store)
+        if not genome_store or not (atlas.atlas_dir(genome_store, args.domain) / "copies.tsv").is_file():
+            logger.error("No 16S atlas found, give the genome store the runs used with --genome-store or RIBDIF_GENOME_STORE")
+            raise SystemExit(1)
+        genera = [] if args.atlas == "all" else args.atlas.split(",")
+        label = args.atlas.replace(",", "-")
+        out_path = args.output or f"{Path.cwd()}/{label}_{SCREEN_NAME}"
+        logger.info(f"Screening {len(candidates)} primer pairs against the 16S atlas of {args.atlas}\n")
+        LOADED.update(load_atlas_sequences(genome_store, args.domain, genera, logger))
+    else:
+        rundir = Path(args.run).resolve()
+        # The genus is the name the run's 16S genes were concatenated under
+        full = sorted(Path(f"{rundir}/full").glob("*.16S"))
+        genus = full[0].stem if full else rundir.name
+        if not args.whole and not full:
+            logger.error(f"No 16S genes found in {rundir}/full, screen a whole genome run with -w/--whole-genome")
+            raise SystemExit(1)
+        out_path = args.output or f"{rundir}/{genus}_{SCREEN_NAME}"
+        logger.info(f"Screening {len(candidates)} primer pairs against {genus} {'whole genomes' if args.whole else '16S genes'}\n")
+        LOADED.update(load_sequences(rundir, genus, args.whole, args.domain, logger))
+    if LOADED["n_genomes"] == 0:
+        logger.error("No genomes to screen against")
+        raise SystemExit(1)
+    ranked = screen(candidates, out_path, max(args.threads, 1), max(args.batch, 1), args.mismatches, logger)
+    logger.info(f"\nBest primer pairs (all {len(ranked)} are in {out_path}):\n{ranked.head(10).to_string(index = False)}\n")
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+import json
+import shutil
+from pathlib import Path
+import numpy as np
+from ribdif import primer_match, journal
+
+# Persistent 8-mer seed index of a whole genome run, so new primers only look at the sites their seeds hit
+
+INDEX_DIR = "seed_index"
+MANIFEST_NAME = "manifest.json"
+SEED = 8
+CHUNK = 1 << 26 # bases hashed at once while building
+MAX_VARIANTS = 4096 # degenerate seeds expanding to more 8-mers than this fall back to a full scan
+
+TWO_BIT = np.full(256, 255, dtype = np.uint8)
+for base, code in {"A": 0, "C": 1, "G": 2, "T": 3}.items():
+    TWO_BIT[ord(base)] = code
+
+
+# Directory the index of a run lives in
+def index_dir(outdir):
+    return Path(f"{outdir}/{INDEX_DIR}")
+
+
+# Check the index was built from the genomes as they are now
+def is_current(outdir, fnas):
+    manifest = index_dir(outdir) / MANIFEST_NAME
+    if not manifest.is_file():
+        return False
+    with open(manifest, "r") as f_in:
+        entry = json.load(f_in)
+    return entry.get("genomes") == journal.fingerprint(fnas) and entry.get("seed") == SEED
+
+
+# 8-mer value of every position of a stretch, with whether the 8-mer is made only of A, C, G and T
+def kmer_values(text):
+    two_bit = TWO_BIT[text]
+    n_positions = max(len(text) - SEED + 1, 0)
+    values = np.zeros(n_positions, dtype = np.uint32)
+    for i in range(SEED):
+        values = (values << 2) | (two_bit[i:i + n_positions] & 3)
+    invalid = np.concatenate([[0], np.cumsum(two_bit == 255)])
+    return values, invalid[SEED:SEED + n_positions] == invalid[:n_positions]
+
+
+# Concatenate the genomes and index every 8-mer, writing the manifest last so a half built index is never used
+def build_index(outdir, fnas, logger):
+    directory = index_dir(outdir)
+    if directory.is_dir():
+        shutil.rmtree(directory)
+    directory.mkdir(parents = True)
+    logger.info(f"Building the seed index of {len(fnas)} genomes\n")
+
+    # Genomes are streamed into one byte file, one sequence at a time
+    offsets, labels = [0], []
+    with open(directory / "text.u8", "wb") as f_text:
+        for label, seq in primer_match.read_fasta(fnas):
+            seq = primer_match.clean_sequence(seq)
+            f_text.write(seq.tobytes() + bytes([primer_match.SEPARATOR]))
+            offsets.append(offsets[-1] + len(seq) + 1)
+            labels.append(label)
+    text = np.memmap(directory / "text.u8", dtype = np.uint8, mode = "r")
+
+    # Two passes of a counting sort: count every 8-mer, then drop each position into its 8-mer's slice
+    counts = np.zeros(4**SEED, dtype = np.int64)
+    ambiguous = []
+    for start in range(0, len(text), CHUNK):
+        chunk = np.asarray(text[start:start + CHUNK + SEED - 1])
+        values, valid = kmer_values(chunk)
+        counts += np.bincount(values[:CHUNK][valid[:CHUNK]], minlength = 4**SEED)
+        letters = chunk[:CHUNK]
+        ambiguous.append(np.flatnonzero((TWO_BIT[letters] == 255) & (letters != primer_match.SEPARATOR)) + start)
+    kmer_starts = np.concatenate([[0], np.cumsum(counts)])
+    position_dtype = np.uint32 if len(text) < 2**32 else np.int64
+    positions = np.lib.format.open_memmap(directory / "positions.npy", mode = "w+", dtype = position_dtype, shape = (int(kmer_starts[-1]),))
+    cursor = kmer_starts[:-1].copy()
+    for start in range(0, len(text), CHUNK):
+        values, valid = kmer_values(np.asarray(text[start:start + CHUNK + SEED - 1]))
+        values = values[:CHUNK]
+        valid = valid[:CHUNK]
+        chunk_positions = np.flatnonzero(valid)
+        values = values[chunk_positions]
+        order = np.argsort(values, kind = "stable")
+        values, chunk_positions = values[order], chunk_positions[order] + start
+        # Rank of each position among those of the same 8-mer in this chunk
+        first = np.searchsorted(values, values, side = "left")
+        positions[cursor[values] + np.arange(len(values)) - first] = chunk_positions
+        cursor += np.bincount(values, minlength = 4**SEED)
+    positions.flush()
+    del positions
+
+    np.save(directory / "kmer_starts.npy", kmer_starts)
+    np.save(directory / "offsets.npy", np.array(offsets, dtype = np.int64))
+    np.save(directory / "ambiguous.npy", np.concatenate(ambiguous) if ambiguous else np.zeros(0, dtype = np.int64))
+    with journal.atomic_write(directory / "labels.txt") as f_out:
+        f_out.write("\n".join(labels) + "\n")
+    with journal.atomic_write(directory / MANIFEST_NAME) as f_out:
+        json.dump({"genomes": journal.fingerprint(fnas), "seed": SEED, "bases": len(text), "sequences": len(labels)}, f_out)
+    logger.info(f"Indexed {len(text)} bases in {len(labels)} sequences\n\n")
+    return
+
+
+# Build the index unless the one on disk was built from the current genomes
+def ensure_index(outdir, fnas, logger):
+    if is_current(outdir, fnas):
+        logger.info("Reusing the seed index as the genomes have not changed\n\n")
+    else:
+        build_index(outdir, fnas, logger)
+    return load_index(outdir)
+
+
+# Memory map the index
+def load_index(outdir):
+    directory = index_dir(outdir)
+    with open(directory / "labels.txt", "r") as f_in:
+        labels = f_in.read().splitlines()
+    return {"text": np.memmap(directory / "text.u8", dtype = np.uint8, mode = "r"),
+            "offsets": np.load(directory / "offsets.npy"),
+            "labels": labels,
+            "kmer_starts": np.load(directory / "kmer_starts.npy"),
+            "positions": np.load(directory / "positions.npy", mmap_mode = "r"),
+            "ambiguous": np.load(directory / "ambiguous.npy")}
+
+
+# Every 8-mer a window of a primer can bind as, bases outside the part it stands for can be anything
+def seed_kmers(primer_codes, window, part):
+    values = np.zeros(1, dtype = np.int64)
+    for i in range(window, window + SEED):
+        code = primer_codes[i] if part[0] <= i < part[1] else 15
+        bases = np.array([b for b in range(4) if code & (1 << b)], dtype = np.int64)
+        values = (values[:, None] * 4 + bases[None, :]).ravel()
+    return values
+
+
+# Number of 8-mers a window expands to
+def seed_variants(primer_codes, window, part):
+    count = 1
+    for i in range(window, window + SEED):
+        code = primer_codes[i] if part[0] <= i < part[1] else 15
+        count *= bin(int(code) & 15).count("1")
+    return count
+
+
+# Mismatches of a primer at the given start positions, windows running over a separator or the end get the primer length
+def site_mismatches(text, starts, primer_codes):
+    length = len(primer_codes)
+    mismatches = np.zeros(len(starts), dtype = np.int64)
+    inside = starts + length <= len(text)
+    mismatches[~inside] = length
+    starts = starts[inside]
+    counts = np.zeros(len(starts), dtype = np.int64)
+    separator = np.zeros(len(starts), dtype = bool)
+    for i, base in enumerate(primer_codes):
+        codes = primer_match.SEQUENCE_CODES[text[starts + i]]
+        counts += (codes & base) == 0
+        separator |= codes == 0
+    counts[separator] = length
+    mismatches[inside] = counts
+    return mismatches
+
+
+# Start positions worth checking for a primer: by the pigeonhole principle one of its max_mismatches + 1 parts binds exactly,
+# plus every start within span of a base no 8-mer was indexed for. None when the primer is too short or degenerate to seed
+def seed_candidates(index, primer_codes, max_mismatches, span):
+    length = len(primer_codes)
+    if length < SEED:
+        return None
+    candidates = []
+    parts = [(int(p[0]), int(p[-1]) + 1) for p in np.array_split(np.arange(length), max_mismatches + 1) if len(p)]
+    for part in parts:
+        # The window with the fewest 8-mers, the most of the part it covers the fewer it expands to
+        window = min(range(length - SEED + 1), key = lambda w: seed_variants(primer_codes, w, part))
+        if seed_variants(primer_codes, window, part) > MAX_VARIANTS:
+            return None
+        for kmer in seed_kmers(primer_codes, window, part):
+            hits = index["positions"][index["kmer_starts"][kmer]:index["kmer_starts"][kmer + 1]]
+            candidates.append(np.asarray(hits, dtype = np.int64) - window)
+    # Windows over bases no 8-mer was indexed for
+    ambiguous = index["ambiguous"]
+    if len(ambiguous):
+        candidates.append((ambiguous[:, None] - np.arange(span)[None, :]).ravel())
+    return np.unique(np.concatenate(candidates))
+
+
+# Binding sites of a primer found through the index, the same as primer_match.primer_sites over the whole text
+def indexed_sites(index, primer, max_mismatches = 1):
+    text = index["text"]
+    primer_codes = primer_match.PRIMER_CODES[np.frombuffer(primer_match.clean_primer(primer).encode(), dtype = np.uint8)]
+    candidates = seed_candidates(index, primer_codes, max_mismatches, len(primer_codes))
+    if candidates is None:
+        return scanned_sites(text, primer, max_mismatches)
+    candidates = candidates[candidates >= 0]
+    mismatches = site_mismatches(text, candidates, primer_codes)
+    return candidates[mismatches <= max_mismatches]
+
+
+# Which of the start positions bind the primer with one inserted or deleted base (after its first and before its last base) and no mismatch,
+# the indels in_silico_PCR.pl -i allows. Only the primer's own bases are checked, so an inserted base may still be a sequence separator
+def site_indels(text, starts, primer_codes):
+    length = len(primer_codes)
+    # Leading bases that bind in place, and the last base that fails to bind one position to the right (insertion) or left (deletion)
+    leading = np.zeros(len(starts), dtype = np.int64)
+    in_place = np.ones(len(starts), dtype = bool)
+    last_insertion = np.full(len(starts), -1, dtype = np.int64)
+    last_deletion = np.full(len(starts), -1, dtype = np.int64)
+    for i, base in enumerate(primer_codes):
+        for shift in (0, 1, -1):
+            positions = starts + i + shift
+            inside = (positions >= 0) & (positions < len(text))
+            binds = inside & ((primer_match.SEQUENCE_CODES[np.asarray(text[np.clip(positions, 0, len(text) - 1)])] & base) != 0)
+            if shift == 0:
+                in_place &= binds
+                leading += in_place
+            elif shift == 1:
+                last_insertion[~binds] = i
+            else:
+                last_deletion[~binds] = i
+    # An indel after base j binds if the j bases before it bind in place and all after it bind shifted
+    insertion = np.maximum(1, last_insertion + 1) <= np.minimum(length - 2, leading)
+    deletion = np.maximum(1, last_deletion) <= np.minimum(length - 2, leading)
+    return insertion | deletion
+
+
+# Binding sites of a primer with a single indel found through the index. The half of the primer away from the indel
+# binds exactly, so the seeds of indexed_sites find the site itself or one base either side of it
+def indel_sites(index, primer):
+    text = index["text"]
+    primer_codes = primer_match.PRIMER_CODES[np.frombuffer(primer_match.clean_primer(primer).encode(), dtype = np.uint8)]
+    if len(primer_codes) < 3: # in_silico_PCR.pl gives primers this short no indels
+        return np.zeros(0, dtype = np.int64)
+    candidates = seed_candidates(index, primer_codes, 1, len(primer_codes) + 1)
+    if candidates is None:
+        return scanned_indels(text, primer_codes)
+    candidates = np.unique((candidates[:, None] + np.arange(-1, 2)[None, :]).ravel())
+    candidates = candidates[candidates >= 0]
+    return candidates[site_indels(text, candidates, primer_codes)]
+
+
+# Indel binding sites by checking every position, a smaller block at a time as each position is checked three ways
+def scanned_indels(text, primer_codes):
+    sites = []
+    for start in range(0, len(text), primer_match.BLOCK >> 4):
+        starts = np.arange(start, min(start + (primer_match.BLOCK >> 4), len(text)), dtype = np.int64)
+        sites.append(starts[site_indels(text, starts, primer_codes)])
+    return np.concatenate(sites) if sites else np.zeros(0, dtype = np.int64)
+
+
+# Stretches of the text around every start site long enough to hold any amplicon from it, merged where they overlap
+# and kept within the site's own sequence, as (start, end) pairs in text order
+def site_windows(offsets, sites, before, after):
+    sites = np.unique(sites)
+    seq = np.searchsorted(offsets, sites, side = "right") - 1
+    starts = np.maximum(sites - before, offsets[seq])
+    ends = np.minimum(sites + after, offsets[seq + 1] - 1)
+    windows = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        if windows and start <= windows[-1][1]:
+            windows[-1][1] = max(windows[-1][1], end)
+        else:
+            windows.append([start, end])
+    return windows
+
+
+# Binding sites by scanning the whole text a block at a time, for primers too short or degenerate to seed
+def scanned_sites(text, primer, max_mismatches):
+    length = len(primer_match.clean_primer(primer))
+    sites = []
+    for start in range(0, len(text), primer_match.BLOCK):
+        block = primer_match.SEQUENCE_CODES[np.asarray(text[start:start + primer_match.BLOCK + length - 1])]
+        positions, _ = primer_match.primer_sites(block, primer, max_mismatches)
+        sites.append(positions[positions < primer_match.BLOCK] + start)
+    return np.concatenate(sites) if sites else np.zeros(0, dtype = np.int64)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import os
+import socketserver
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from ribdif import api, primer_match
+
+# Long lived HTTP service answering primer pair evaluations from genomes held in memory (ribdif serve)
+
+CACHE_SIZE = 10000
+
+
+# Genome sets and the results of the pairs evaluated on them
+class PrimerService:
+    def __init__(self, logger, threads):
+        self.sets = {}
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.logger = logger
+        self.threads = threads
+
+    # Load a genome set once, keyed by its genus and whether it holds whole genomes
+    def load(self, config):
+        config = api.resolve_config({**config, "logger": self.logger})
+        genus, genomes, loaded = api.load_genomes(config)
+        self.sets[(genus, config["whole"])] = (genomes, loaded)
+        self.logger.info(f"Holding {len(genomes)} {genus} genomes ({'whole genomes' if config['whole'] else '16S genes'}) in memory\n")
+        return genus
+
+    # Evaluate a pair on a loaded set, or take it from the cache
+    def evaluate(self, request):
+        genus, whole = request["genus"], bool(request.get("whole", False))
+        if (genus, whole) not in self.sets:
+            raise LookupError(f"No {'whole genomes' if whole else '16S genes'} of {genus} are loaded")
+        fwd, rvs = primer_match.clean_primer(request["forward"]), primer_match.clean_primer(request["reverse"])
+        length, mismatches, identity = float(request["length"]), int(request.get("mismatches", 1)), float(request.get("identity", 1))
+        if not fwd or not rvs or length <= 0:
+            raise ValueError("forward and reverse must be primer sequences and length a positive amplicon length")
+        key = (genus, whole, fwd, rvs, length, mismatches, identity)
+        with self.lock:
+            result = self.cache.get(key)
+            if result is not None:
+                self.cache.move_to_end(key)
+        cached = result is not None
+        if not cached:
+            genomes, loaded = self.sets[(genus, whole)]
+            config = {"mismatches": mismatches, "identity": identity, "threads": self.threads, "logger": self.logger}
+            result = api.evaluate_primer(loaded, genomes, request.get("name", f"{fwd}-{rvs}"), fwd, rvs, length, config)
+            with self.lock:
+                self.cache[key] = result
+                if len(self.cache) > CACHE_SIZE:
+                    self.cache.popitem(last = False)
+        response = {"genus": genus, "whole": whole, "name": result.name, "forward": fwd, "reverse": rvs, "cached": cached,
+                    "stats": result.stats, "overlap_groups": result.overlap_groups,
+                    "species_confusion": {str(k): {str(c): int(v) for c, v in row.items()} for k, row in result.species_confusion.to_dict("index").items()}}
+        if request.get("amplicons"):
+            response["amplicons"] = result.amplicons.drop(columns = "Sequence").to_dict("records")
+        return response
+
+    # The loaded genome sets
+    def genome_sets(self):
+        return [{"genus": genus, "whole": whole, "genomes": len(genomes)} for (genus, whole), (genomes, _) in self.sets.items()]
+
+
+# Requests are JSON in and JSON out
+class ServiceHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def send_json(self, status, body):
+        data = json.dumps(body, default = lambda value: value.item() if hasattr(value, "item") else str(value)).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/genomes":
+            self.send_json(200, self.service.genome_sets())
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/evaluate":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            self.send_json(200, self.service.evaluate(request))
+        except KeyError as error:
+            self.send_json(400, {"error": f"The request has no {error}"})
+        except LookupError as error:
+            self.send_json(404, {"error": str(error)})
+        except (ValueError, TypeError) as error:
+            self.send_json(400, {"error": str(error)})
+
+    # Requests go to the service's logger rather than stderr (Unix socket clients have no address to print)
+    def log_message(self, format, *args):
+        self.service.logger.debug(format % args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+# Serve on a Unix socket if one is given, otherwise on a local port
+def make_server(service, host, port, socket_path):
+    handler = type("BoundHandler", (ServiceHandler,), {"service": service})
+    if socket_path:
+        if Path(socket_path).exists():
+            os.remove(socket_path)
+        return UnixHTTPServer(socket_path, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog = "ribdif serve",
+        description = "Hold the genomes of RibDif2 runs in memory and evaluate primer pairs sent over HTTP, see ribdif/service.py for the requests")
+    parser.add_argument("-r", "--run", dest = "runs",
+                        help = "Output directory of a RibDif2 run whose genomes to hold. Can be given more than once",
+                        action = "append",
+                        default = [])
+    parser.add_argument("--atlas", dest = "atlas",
+                        help = "Comma separated genera (or all) of the genome store's 16S atlas to hold, as one genome set",
+                        default = None)
+    parser.add_argument("--genome-store", dest = "genome_store",
+                        help = "Genome store holding the atlas for --atlas. Can also be set with the RIBDIF_GENOME_STORE environment variable",
+                        default = None)
+    parser.add_argument("-w", "--whole-genome", dest = "whole",
+                        help = "Also hold the whole genomes of the runs, for non 16S primers",
+                        action = "store_true")
+    parser.add_argument("-d", "--domain", dest = "domain",
+                        help = "Domain the runs' genomes were downloaded for. Default is bacteria",
+                        default = "bacteria")
+    parser.add_argument("--host", dest = "host",
+                        help = "Address to listen on. Default is 127.0.0.1",
+                        default = "127.0.0.1")
+    parser.add_argument("--port", dest = "port",
+                        help = "Port to listen on. Default is 8765",
+                        default = 8765,
+                        type = int)
+    parser.add_argument("--socket", dest = "socket",
+                        help = "Listen on this Unix socket instead of a port",
+                        default = None)
+    parser.add_argument("-t", "--threads", dest = "threads",
+                        help = "Threads vsearch may use when a request clusters below an identity of 1. Default is all available",
+                        default = os.cpu_count(),
+                        type = int)
+    return parser.parse_args(argv)
+
+
+def main(argv = None):
+    args = parse_args(argv)
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(console_handler)
+
+    if not args.runs and not args.atlas:
+        logger.error("Give at least one run (-r) or --atlas genera to hold")
+        raise SystemExit(1)
+    service = PrimerService(logger, max(args.threads, 1))
+    for run in args.runs:
+        service.load({"run": run, "domain": args.domain})
+        if args.whole:
+            service.load({"run": run, "domain": args.domain, "whole": True})
+    if args.atlas:
+        service.load({"atlas": "all" if args.atlas == "all" else args.atlas.split(","), "genome_store": args.genome_store, "domain": args.domain})
+
+    server = make_server(service, args.host, args.port, args.socket)
+    logger.info(f"Serving primer evaluations on {args.socket or f'http://{args.host}:{args.port}'}\n")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Stopping\n")
+    finally:
+        server.server_close()
+        if args.socket and Path(args.socket).exists():
+            os.remove(args.socket)
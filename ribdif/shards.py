@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import shutil
+import zlib
+from itertools import repeat
+from pathlib import Path
+from ribdif import journal, logging_config, ngd_download, primer_combinations, resources, utils, vsearch_run
+
+# Sharded runs for clusters (--shards) and ribdif merge, which joins the finished shards and clusters and reports them once
+
+MANIFEST_NAME = "shard.json"
+GENOMES_NAME = "shard_genomes.tsv"
+SHARD_ENV = "SLURM_ARRAY_TASK_ID"
+
+
+# Which shard a genome belongs to, from a checksum of its name so every shard agrees without talking to the others
+def shard_of(name, count):
+    return zlib.crc32(name.encode()) % count
+
+
+# Shard index from the command line, or from the scheduler's array task id
+def shard_index(index):
+    index = index if index is not None else os.environ.get(SHARD_ENV)
+    return int(index) if index is not None else None
+
+
+# Keeps the genomes of one shard, None when the run is not sharded
+def shard_filter(count, index):
+    if not count:
+        return None
+    return lambda name: shard_of(name, count) == index
+
+
+def shard_dir(rundir, index):
+    return Path(f"{rundir}/shards/shard_{index}")
+
+
+# Record the genomes of a finished shard and then its manifest, which is what merge looks for
+def finish_shard(outdir, genus, index, count, names, genome_species, user, whole, logger):
+    with journal.atomic_write(f"{outdir}/{GENOMES_NAME}") as f_out:
+        f_out.write("GCF\tSpecies\n")
+        for gcf, species in sorted(genome_species.items()):
+            f_out.write(f"{gcf}\t{species}\n")
+    manifest = {"genus": genus, "shard": index, "shards": count, "names": names, "genomes": len(genome_species), "user": bool(user), "whole": whole}
+    with journal.atomic_write(f"{outdir}/{MANIFEST_NAME}") as f_out:
+        json.dump(manifest, f_out)
+    logger.info(f"Shard {index} of {count} finished with {len(genome_species)} genomes. Once every shard has finished run: ribdif merge {Path(outdir).parent.parent}\n")
+    return
+
+
+# Manifests of every finished shard of a run, in shard order. Exits if a shard is missing or they disagree on the shard count
+def read_manifests(rundir, logger):
+    manifests = []
+    for path in sorted(Path(f"{rundir}/shards").glob(f"*/{MANIFEST_NAME}")):
+        with open(path, "r") as f_in:
+            manifests.append(json.load(f_in))
+    if not manifests:
+        logger.error(f"No finished shards found in {rundir}/shards")
+        raise SystemExit(1)
+    counts = {manifest["shards"] for manifest in manifests}
+    if len(counts) != 1:
+        logger.error(f"The shards in {rundir}/shards were run with different shard counts ({', '.join(str(c) for c in sorted(counts))})")
+        raise SystemExit(1)
+    missing = sorted(set(range(counts.pop())) - {manifest["shard"] for manifest in manifests})
+    if missing:
+        logger.error(f"Shards {', '.join(str(i) for i in missing)} of {rundir} have not finished")
+        raise SystemExit(1)
+    return sorted(manifests, key = lambda manifest: manifest["shard"])
+
+
+# Concatenate the shards' copies of a file, keeping the header line of tables once
+def join_files(paths, out_path, header = False):
+    paths = [path for path in paths if Path(path).is_file()]
+    if not paths:
+        return False
+    Path(out_path).parent.mkdir(parents = True, exist_ok = True)
+    with journal.atomic_write(out_path) as f_out:
+        for i, path in enumerate(paths):
+            with open(path, "r") as f_in:
+                if header and i > 0:
+                    next(f_in, None)
+                shutil.copyfileobj(f_in, f_out)
+    return True
+
+
+# Join the shards of a run and cluster and report their amplicons
+def merge(rundir, ident, msa, threads, memory, defer_figures, combinations, logger):
+    manifests = read_manifests(rundir, logger)
+    genus, user, whole = manifests[0]["genus"], manifests[0]["user"], manifests[0]["whole"]
+    dirs = [shard_dir(rundir, manifest["shard"]) for manifest in manifests]
+    names = []
+    for manifest in manifests:
+        names.extend(name for name in manifest["names"] if name not in names)
+    genome_species = {}
+    for shard in dirs:
+        with open(shard / GENOMES_NAME, "r") as f_in:
+            next(f_in)
+            genome_species.update(line.rstrip("\n").split("\t") for line in f_in)
+    logger.info(f"Merging {len(dirs)} shards of {genus} with {len(genome_species)} genomes and {len(names)} amplifying primers\n\n")
+
+    join_files([shard / ngd_download.METADATA_NAME for shard in dirs], f"{rundir}/{ngd_download.METADATA_NAME}", header = True)
+    if not whole:
+        join_files([shard / "full" / f"{genus}.16S" for shard in dirs], f"{rundir}/full/{genus}.16S")
+        join_files([shard / f"{genus}_16S_summary.tsv" for shard in dirs], f"{rundir}/{genus}_16S_summary.tsv", header = True)
+    for name in names:
+        join_files([shard / "amplicons" / name / f"{genus}-{name}.amplicons" for shard in dirs], f"{rundir}/amplicons/{name}/{genus}-{name}.amplicons")
+        join_files([shard / f"{genus}_{name}-amp_summary.tsv" for shard in dirs], f"{rundir}/{genus}_{name}-amp_summary.tsv", header = True)
+        join_files([shard / f"{genus}_{name}_binding.tsv" for shard in dirs], f"{rundir}/{genus}_{name}_binding.tsv", header = True)
+    if not names:
+        logger.error("No amplification for any of the given primers was successfull in any shard. Try again with different primers")
+        raise SystemExit(1)
+
+    budget = resources.make_budget(threads, memory)
+    log_dir = Path(rundir) / "ribdif_logs"
+    log_dir.mkdir(exist_ok = True, parents = True)
+    logger.info("Making unique clusters with vsearch.\n\n")
+    for name in names:
+        vsearch_run.vsearch_call(rundir, genus, name, ident, log_dir, resources.tool_threads(budget), logger)
+
+    # The same reports as a run over every genome, user genomes have no species
+    Path(f"{rundir}/figures").mkdir(exist_ok = True)
+    logger.info("Making reports and figures\n\n")
+    all_species = ["sp."] * len(genome_species) if user else list(genome_species.values())
+    unique_species = set() if user else set(all_species) - {"sp."}
+    species_map = {} if user else genome_species
+    report_costs = [resources.reports_memory(f"{rundir}/amplicons/{name}/{genus}-{name}.amplicons", msa) for name in names]
+    report_threads = resources.tool_threads(budget, min(len(names), budget["cores"]))
+    resources.budget_starmap(utils.make_reports, zip(names, repeat(msa), repeat(rundir), repeat(genus), repeat(logger), repeat(user), repeat(unique_species), repeat(all_species), repeat(len(all_species)), repeat(report_threads), repeat(species_map), repeat({}), repeat(defer_figures)), report_costs, budget, logger)
+    if combinations and len(names) > 1:
+        primer_combinations.rank_combinations(rundir, genus, names, combinations, logger, {})
+    logger.info(f"You can find a saved version of the above at {rundir}/ribdif_log_file.log")
+    return
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog = "ribdif merge",
+        description = "Join the shards of a RibDif2 run made with --shards and cluster and report them as one run")
+    parser.add_argument("rundir",
+                        help = "Output directory of the sharded run, e.g. results/Ruegeria")
+    parser.add_argument("-i", "--id", dest = "id",
+                        help = "Identity to cluster amplicons at if not using the default 1.0. e.g. .99",
+                        default = 1)
+    parser.add_argument("-m", "--msa", dest = "msa",
+                        help = "Make multiple sequence alignment and trees of amplicons",
+                        action = "store_true")
+    parser.add_argument("--primer-combinations", dest = "primer_combinations",
+                        help = "Rank every combination of up to this many primers by how many species and genomes they tell apart together",
+                        default = None,
+                        type = int)
+    parser.add_argument("--defer-figures", dest = "defer_figures",
+                        help = "Skip drawing the heatmaps and graphs. Draw them later with ribdif-figures -o <rundir>",
+                        action = "store_true")
+    parser.add_argument("-t", "--threads", dest = "threads",
+                        help = "Number of threads to use. Default is all available",
+                        default = os.cpu_count(),
+                        type = int)
+    parser.add_argument("--memory", dest = "memory",
+                        help = "Memory budget in GB. Default is 90%% of the currently available memory",
+                        default = None,
+                        type = float)
+    return parser.parse_args(argv)
+
+
+def main(argv = None):
+    args = parse_args(argv)
+    workingDir = Path(os.path.realpath(os.path.dirname(__file__)))
+    logger = logging_config.configure_logging(workingDir)
+    rundir = Path(args.rundir).resolve()
+    if not rundir.is_dir():
+        logger.error(f"{rundir} does not exist")
+        raise SystemExit(1)
+    logging_config.replace_log_file(rundir, logger)
+    merge(rundir, args.id, args.msa, args.threads, args.memory, args.defer_figures, args.primer_combinations, logger)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import hashlib
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+from ribdif import bgzf_fasta
+
+# Shared genome store, genomes are downloaded once and linked into each run's refseq tree.
+# The genomes are kept block gzipped (see bgzf_fasta.py) and unpacked for the tools that need plain fasta
+
+# Processed files that are shared through the store, in the order they are made
+SHARED_SUFFIXES = [".fna", ".fna.rRNA", ".fna.rRNA.16S"]
+
+
+# Resolve the store path given by the user or the environment
+def store_path(store):
+    store = store or os.environ.get("RIBDIF_GENOME_STORE")
+    if not store:
+        return None
+    Path(store).mkdir(parents = True, exist_ok = True)
+    return Path(store).resolve()
+
+
+# Directory a domain's genomes live in within the store
+def domain_dir(store, domain):
+    return Path(f"{store}/refseq/{domain}")
+
+
+# Link a file into place, falling back to a symlink when a hard link is not possible (e.g. across filesystems)
+def link_file(src, dst):
+    dst = Path(dst)
+    if dst.exists() or dst.is_symlink():
+        dst.unlink()
+    try:
+        os.link(src, dst)
+    except OSError:
+        os.symlink(Path(src).resolve(), dst)
+    return
+
+
+# Check a processed file is at least as new as the file it was made from
+def is_fresh(output, source):
+    output, source = Path(output), Path(source)
+    return output.is_file() and source.is_file() and output.stat().st_mtime >= source.stat().st_mtime
+
+
+# Link the raw download and any processed artifacts of the given accessions into the run directory, unpacking the genome
+def adopt(store, domain, accessions, outdir, threads = 1):
+    linked = 0
+    run_dir = Path(f"{outdir}/refseq/{domain}")
+    for accession in accessions:
+        src_dir = domain_dir(store, domain) / accession
+        if not src_dir.is_dir():
+            continue
+        dst_dir = run_dir / accession
+        dst_dir.mkdir(parents = True, exist_ok = True)
+        for src in src_dir.iterdir():
+            # Only the genome and its shared artifacts are linked, not ngd's MD5SUMS or store bookkeeping
+            if src.is_file() and src.name.endswith(".fna.bgz"):
+                unpack_genome(src, dst_dir / src.name[:-4], threads)
+            elif src.is_file() and src.name.endswith(".fna") and Path(f"{src}.bgz").is_file():
+                continue # a plain copy left by an older run, the compressed one is used
+            elif src.is_file() and (src.name.endswith(".fna.gz") or any(src.name.endswith(s) for s in SHARED_SUFFIXES)):
+                link_file(src, dst_dir / src.name)
+        linked += 1
+    return linked
+
+
+# Unpack a store genome into a run with the store copy's time stamp
+def unpack_genome(bgz, fna, threads = 1):
+    if is_fresh(fna, bgz) and not Path(fna).is_symlink():
+        return
+    if Path(fna).exists() or Path(fna).is_symlink():
+        Path(fna).unlink()
+    bgzf_fasta.unpack(bgz, fna, threads)
+    stat = os.stat(bgz)
+    os.utime(fna, (stat.st_atime, stat.st_mtime))
+    return
+
+
+# Compress a run's genome into the store with the run copy's time stamp
+def pack_genome(fna, bgz):
+    bgzf_fasta.pack(fna, bgz)
+    shutil.copystat(fna, bgz)
+    return bgz
+
+
+# Publish processed artifacts made in the run directory back into the store so later runs can reuse them.
+# Genomes are compressed into the store, on the threads as each is its own work
+def publish(store, domain, outdir, suffix, threads = 1):
+    if suffix == ".fna":
+        to_pack = []
+        for run_file in Path(f"{outdir}/refseq/{domain}").glob(f"*/*{suffix}"):
+            store_dir = domain_dir(store, domain) / run_file.parent.name
+            bgz = store_dir / f"{run_file.name}.bgz"
+            if store_dir.is_dir() and not run_file.is_symlink() and not is_fresh(bgz, run_file):
+                to_pack.append((run_file, bgz))
+        with ThreadPool(max(1, threads)) as pool:
+            pool.starmap(pack_genome, to_pack)
+        return len(to_pack)
+    published = 0
+    for run_file in Path(f"{outdir}/refseq/{domain}").glob(f"*/*{suffix}"):
+        store_dir = domain_dir(store, domain) / run_file.parent.name
+        store_file = store_dir / run_file.name
+        if not store_dir.is_dir() or run_file.is_symlink():
+            continue # not a store genome or already from the store
+        if store_file.exists() and os.path.samefile(store_file, run_file):
+            continue
+        tmp_file = Path(f"{store_file}.tmp-{os.getpid()}")
+        try:
+            os.link(run_file, tmp_file)
+        except OSError:
+            shutil.copy2(run_file, tmp_file)
+        os.replace(tmp_file, store_file) # another run may be publishing the same artifact, last one wins and they are identical
+        published += 1
+    return published
+
+
+# Hash a user genome so identical files given under different names or directories share a store entry
+def file_key(file_path):
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as f_in:
+        for block in iter(lambda: f_in.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()[:20]
+
+
+# Store path of a user genome's normalised and compressed copy, keyed by the file it came from
+def user_genome(store, file_path, name):
+    return Path(f"{store}/user/{file_key(file_path)}/{name}.fna.bgz")
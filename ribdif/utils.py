@@ -7,8 +7,10 @@ from pathlib import Path
 import fileinput
 import os
 import logging
+import multiprocessing
+import time
 import chardet
-from ribdif import overlaps, figures, msa_run, summary_files
+from ribdif import overlaps, render, incidence, msa_run, summary_files, journal, store, barrnap_run
 
 
 # =============================================================================
@@ -27,6 +29,12 @@ from ribdif import overlaps, figures, msa_run, summary_files
 #     return
 # =============================================================================
 
+# Remove unwanted characters from a fasta header and prefix it with the GCF
+def header_fix(line, GCF):
+    line = re.sub(r"[:,/()\[\]=#\x27]", "", line)
+    line = re.sub(r"[: ]", "_", line)
+    return f"{line[0]}{GCF}_{line[1:]}"
+
 # Remove unwanted characters from anywhere is file (should only be in fasta headers)
 def modify2(file_path):
     GCF = str(Path(file_path).parent).split(r"/")[-1]
@@ -34,14 +42,38 @@ def modify2(file_path):
     with fileinput.input(file_path, inplace = True) as f_in:
         for line in f_in:
             if line.startswith(">"):
-                line = re.sub(r"[:,/()\[\]=#\x27]", "", line)
-                line = re.sub(r"[: ]", "_", line)
-                line = f"{line[0]}{GCF}_{line[1:]}" 
+                line = header_fix(line, GCF)
                 print(line, end = '')
                 current_sp = line.split("_")[5]
             else:
                 print(line, end = '')
     return current_sp
+
+# Decompress a downloaded genome and fix its headers in a single pass, only moving the result into place once complete
+def prepare_genome(file_path):
+    GCF = str(Path(file_path).parent).split(r"/")[-1]
+    current_sp = None
+    with gzip.open(file_path, "rt") as f_in, journal.atomic_write(file_path[:-3]) as f_out:
+        for line in f_in:
+            if line.startswith(">"):
+                line = header_fix(line, GCF)
+                if current_sp is None:
+                    current_sp = line.split("_")[5]
+            f_out.write(line)
+    return file_path, current_sp
+
+# Take a freshly downloaded genome through preparation and, if running on 16S, barrnap and 16S extraction
+# Steps whose output is already newer than their input (e.g. linked from the genome store) are skipped
+def process_genome(file_path, rRNA):
+    fna = file_path[:-3]
+    if not store.is_fresh(fna, file_path):
+        prepare_genome(file_path)
+    if rRNA:
+        if not store.is_fresh(f"{fna}.rRNA", fna):
+            barrnap_run.call_proc_barrnap(fna)
+        if Path(f"{fna}.rRNA").is_file() and not store.is_fresh(f"{fna}.rRNA.16S", f"{fna}.rRNA"):
+            barrnap_run.barrnap_process(f"{fna}.rRNA")
+    return file_path
 # =============================================================================
 # def modify3(file_path):
 #     # Open and read the contents of the file
@@ -67,7 +99,7 @@ def sp_check(file):
 # Un gzip the downloaded NCBI genomes
 def decompress(file_path):
     # Open the .gz file and decompress it
-    with gzip.open(file_path, "rb") as f_in, open(file_path[:-3], "wb") as f_out:
+    with gzip.open(file_path, "rb") as f_in, journal.atomic_write(file_path[:-3], "wb") as f_out:
         shutil.copyfileobj(f_in, f_out) # copy
     return
 
@@ -78,7 +110,7 @@ def amp_replace(outdir, genus, names, logger):
         df_sum = pd.read_csv(f"{outdir}/amplicons/{name}/{genus}-{name}.summary", sep = "\t", header = None, names = ["AmpId", "SequenceId", "PositionInSequence", "Length", "Misc"])
         dict_sum = dict(zip(df_sum.AmpId, df_sum.SequenceId)) # Make a dictionary of it
         # Open the temp amplicon file and the final amplicon file
-        with open (f"{outdir}/amplicons/{name}/{genus}-{name}.temp.amplicons", "r") as f_in, open(f"{outdir}/amplicons/{name}/{genus}-{name}.amplicons", "w") as f_out:
+        with open (f"{outdir}/amplicons/{name}/{genus}-{name}.temp.amplicons", "r") as f_in, journal.atomic_write(f"{outdir}/amplicons/{name}/{genus}-{name}.amplicons") as f_out:
            for line in f_in: # loop over lines in the file
                if ">amp" in line: # If it is a fasta header
                    # Replace with origin genome fasta header and then the amp count
@@ -93,9 +125,41 @@ def amp_replace(outdir, genus, names, logger):
             names.remove(name)
     return names
 
+# Recompute a primer's reports from its saved allele incidence for the genomes passing the report filters, no genome or external tool is touched
+def recompute_reports(name, outdir, genus, logger, user, unique_species, all_species, genome_count, weights = None, sp_ignore = False, exclude = None, only_species = None):
+    counts, gcfs, species = incidence.load_incidence(outdir, genus, name)
+    mask = incidence.genome_mask(gcfs, species, sp_ignore, exclude, only_species)
+    if not mask.any():
+        logger.info(f"None of the genomes amplified by {name} pass the report filters, skipping its report\n")
+        return
+    cluster_df, gcf_species = incidence.filtered_clusters(counts, gcfs, species, mask)
+    combinations = incidence.species_overlap(cluster_df, gcf_species)
+    if len(cluster_df.index) != 1:
+        pairwise_to_csv(incidence.pairwise_overlaps(cluster_df), gcf_species, outdir, genus, name)
+    species_confusion_to_csv(incidence.species_confusion(cluster_df, gcf_species, weights), outdir, genus, name)
+    # Diversity comes from the alignment of every amplicon so it is not filtered
+    aln = f"{outdir}/amplicons/{name}/{genus}-{name}.aln"
+    shannon_div = summary_files.shannon_calc(aln) if Path(aln).is_file() else "Was skipped"
+    overlaps.overlap_report(combinations, gcf_species, cluster_df, genus, name, outdir, logger, shannon_div, unique_species, all_species, genome_count, user, weights)
+    return
+
+
+# Read a file of genome accessions, one per line. Blank lines and lines starting with # are ignored
+def read_accessions(file_path):
+    with open(file_path, "r") as f_in:
+        return {line.strip() for line in f_in if line.strip() and not line.startswith("#")}
+
+
 def pairwise_to_csv(pairwise_match, gcf_species, outdir, genus, name):
     pairwise_save_df = pd.DataFrame(pairwise_match, index = gcf_species.values())
-    pairwise_save_df.to_csv(f"{outdir}/amplicons/{name}/{genus}-{name}_confusion.csv", sep = ",", index = True)
+    with journal.atomic_write(f"{outdir}/amplicons/{name}/{genus}-{name}_confusion.csv") as f_out:
+        pairwise_save_df.to_csv(f_out, sep = ",", index = True)
+    return
+
+# Species x species confusion of a primer, see incidence.species_confusion
+def species_confusion_to_csv(confusion, outdir, genus, name):
+    with journal.atomic_write(f"{outdir}/amplicons/{name}/{genus}-{name}_species_confusion.csv") as f_out:
+        confusion.to_csv(f_out, sep = ",", index = True)
     return
 
 def detect_encode(file):
@@ -114,53 +178,85 @@ def primer_check(primer_file, logger):
                 return True
     return False
 
-# Copy the user defined genomes to the output directory following ncbi-genome.download structure
-def own_genomes_copy(dir_path, outdir, domain, logger):
-    target_dir = f"{outdir}/refseq/{domain}" # Target directory
-    Path.mkdir(Path(target_dir), exist_ok = True, parents = True) # Creating directory
-    logger.info(f"Copying your genomes to {target_dir}\n\n")
-    file_count = 0 # Initiate genome count
-    # Looping over whole directory
-    for file in Path(dir_path).iterdir():
-        if file.is_file(): # if item is a file
-            final_dir = f"{target_dir}/{file.stem.replace('_', '-')}"
-            Path.mkdir(Path(final_dir))
-            shutil.copy(file, f"{final_dir}/{file.stem.replace('_', '-')}.fna") # copy it replacing the file extension with '.fna'
-            file_count += 1 # incriment file count
-    return target_dir, file_count
-
-# Decompress user defined files if they need it
-def own_genomes_gzip(new_dir_path):
-    for file in Path(new_dir_path).glob("*/*.fna"):
-        if file.suffix == ".gz":
-            decompress(file)
-    return
-    
-# Rename the fasta headers of the file inplace
-def own_genomes_rename(new_dir_path, logger):
-    NZ_count = 1 # abritrary GCF
-    logger.info("Changing the copied genomes headers to conform with NCBI format\n\n")
-    # Loop throuh all user fna files in new directory
-    for file in Path(new_dir_path).glob("*/*.fna"):
-        with fileinput.input(file, inplace = True) as f_in: # open the file for inplace editing
-            for line in f_in: # Loop through lines
-                if line.startswith(">"): # if it is a fasta header
-                    # Generate new fasta header    
-                    genus = file.stem.replace("_", "-")
-                    line = f">GCF_{genus}_NZ_CP{NZ_count}_{genus}_sp._placeholder\n" # generate random GCF
-                    print(line, end = '')
-                    NZ_count += 1
-                else:
-                    print(line, end = '') # else print the line (which would be actual sequence data)
-    return
+# Name a user genome runs under, from its file name without the fasta (and any gzip) extension
+def user_genome_name(file):
+    name = Path(file).name
+    name = name[:-3] if name.endswith(".gz") else name
+    return Path(name).stem.replace("_", "-")
+
+# Whether a file is gzip compressed, from its first bytes as user files are not always named for it
+def is_gzipped(file):
+    with open(file, "rb") as f_in:
+        return f_in.read(2) == b"\x1f\x8b"
 
+# NCBI style header of a user genome's contig
+def user_header(name, count):
+    return f">GCF_{name}_NZ_CP{count}_{name}_sp._placeholder\n"
+
+# Check if a plain user genome already has the headers ingesting it would give it, most files fail on the first header
+def user_headers_done(file, name):
+    count = 0
+    with open(file, "r") as f_in:
+        for line in f_in:
+            if line.startswith(">"):
+                count += 1
+                if line != user_header(name, count):
+                    return False
+    return count > 0
+
+# Write a user genome with NCBI style headers reading it once, compressed or not. Returns False if it was only linked as it needed no change
+def normalise_user_genome(file, target, name, link = True):
+    gzipped = is_gzipped(file)
+    if link and not gzipped and user_headers_done(file, name):
+        store.link_file(file, target)
+        return False
+    count = 0
+    with (gzip.open(file, "rt") if gzipped else open(file, "r")) as f_in, journal.atomic_write(target) as f_out:
+        for line in f_in:
+            if line.startswith(">"):
+                count += 1
+                line = user_header(name, count)
+            f_out.write(line)
+    return True
+
+# Bring one user genome into the run. With a genome store the normalised genome is kept compressed in the store, once per distinct file, and unpacked from there
+def ingest_user_genome(file, fna, genome_store = None):
+    name = Path(fna).stem
+    if not genome_store:
+        return normalise_user_genome(file, fna, name)
+    stored = store.user_genome(genome_store, file, name)
+    if stored.is_file():
+        store.unpack_genome(stored, fna)
+        return False
+    stored.parent.mkdir(parents = True, exist_ok = True)
+    rewritten = normalise_user_genome(file, fna, name)
+    store.pack_genome(fna, stored)
+    return rewritten
+
+# Bring the user defined genomes into the output directory following the ncbi-genome-download structure, in parallel
+def own_genomes_ingest(dir_path, outdir, domain, threads, logger, genome_store = None, keep = None):
+    target_dir = f"{outdir}/refseq/{domain}"
+    jobs = []
+    for file in sorted(Path(dir_path).iterdir()):
+        if file.is_file() and (keep is None or keep(file.name)): # if item is a file (of this shard, if sharded)
+            name = user_genome_name(file)
+            Path.mkdir(Path(f"{target_dir}/{name}"), parents = True) # fails rather than letting two files of the same name overwrite each other
+            jobs.append((str(file), f"{target_dir}/{name}/{name}.fna", genome_store))
+    logger.info(f"Bringing your genomes into {target_dir} and changing their headers to conform with NCBI format\n\n")
+    start = time.perf_counter()
+    with multiprocessing.Pool(max(1, min(threads, len(jobs)))) as pool:
+        rewritten = sum(pool.starmap(ingest_user_genome, jobs))
+    elapsed = max(time.perf_counter() - start, 1e-6)
+    logger.info(f"Ingested {len(jobs)} genomes ({rewritten} rewritten, {len(jobs) - rewritten} linked as they were or unpacked from the genome store) in {elapsed:.1f}s, {len(jobs) / elapsed:.1f} genomes per second\n\n")
+    return target_dir, len(jobs)
 
-def make_reports(name, msa, outdir, genus, logger, user, unique_species, all_species, genome_count):
+
+def make_reports(name, msa, outdir, genus, logger, user, unique_species, all_species, genome_count, threads = 1, species_map = None, weights = None, defer_figures = False):
 
     if msa:
         # msa on all amplicons
         infile , outAln, outTree = f"{outdir}/amplicons/{name}/{genus}-{name}.amplicons", f"{outdir}/amplicons/{name}/{genus}-{name}.aln", f"{outdir}/amplicons/{name}/{genus}-{name}.tree" # Asigning in and out files
-        msa_run.muscle_call_single(infile, outAln, outTree)
+        msa_run.muscle_call_single(infile, outAln, outTree, threads)
         msa_run.format_trees(outdir, genus, name)
         # Calculate shannon diversity across the primers
         shannon_div = summary_files.shannon_calc(outAln)
@@ -169,7 +265,7 @@ def make_reports(name, msa, outdir, genus, logger, user, unique_species, all_spe
     
     
     # Cleaning vsearch clustering data
-    all_gcfs, uc_dict_clean, gcf_species, cluster_count = overlaps.uc_cleaner(outdir, genus, name)
+    all_gcfs, uc_dict_clean, gcf_species, cluster_count = overlaps.uc_cleaner(outdir, genus, name, species_map)
     
     # Generate a dictionary (that will become a matrix) of GCF cluster membership  
     cluster_dict = overlaps.cluster_matrix(all_gcfs, uc_dict_clean, cluster_count)
@@ -177,37 +273,23 @@ def make_reports(name, msa, outdir, genus, logger, user, unique_species, all_spe
     # Find all species overlap in the cluster_dict
     combinations = overlaps.species_overlap(cluster_dict, cluster_count, gcf_species)
     
+    # Save the allele incidence so the reports can be recomputed (--report-only) and the figures drawn from it
+    cluster_df = pd.DataFrame.from_dict(cluster_dict).transpose()
+    incidence.save_incidence(cluster_df, gcf_species, outdir, genus, name)
+    
+    # Which species collide, from the incidence grouped by species
+    species_confusion_to_csv(incidence.species_confusion(cluster_df, gcf_species, weights), outdir, genus, name)
+    
     # If only one cluster is made then skip all the figure making. Could I do this with cluster count instead and avoid the two commands above?
     if len(cluster_dict) != 1:
         # Find all GCF overlaps in the cluster dictionary
         pairwise_match = overlaps.gcf_overlaps(all_gcfs, uc_dict_clean, gcf_species)
         pairwise_to_csv(pairwise_match, gcf_species, outdir, genus, name)
         
-        # Generate metadata for heatmaps
-        row_palette, species_series, species_palette = figures.heatmap_meta(gcf_species)
-        
-        # Plot the cluster matrix
-        plot_clus, cluster_df = figures.cluster_heatmap(cluster_dict, row_palette, species_series)
-        
-        # Plot the GCF overlap matrix
-        plot_dendo, pairwise_df = figures.pairwise_heatmap(pairwise_match, row_palette, species_series)
-        
-        plot_clus = figures.figure_fix(plot_clus)
-        plot_dendo = figures.figure_fix(plot_dendo)
-        
-        # Save the heatmaps
-        figures.pdf_save(plot_clus, plot_dendo, outdir, genus, name)
-    
-        # Generate graps from the pairwise dataframe
-        adjacency_df = figures.create_adjacency(pairwise_df, cluster_df)
-        graph_subs, n_subplots = figures.create_graph(adjacency_df)
-        
-        if n_subplots != 0:
-            # Draw the generated graps into on plot
-            figures.draw_graphs(graph_subs, n_subplots, species_palette, row_palette, outdir, genus, name)
-        else:
-            logger.info(f"Skipping graph making for {name} as no edges were found (even within a single species)\n")
+        # Figures can also be drawn later by ribdif-figures
+        if not defer_figures:
+            render.render_figures(cluster_df, gcf_species, outdir, genus, name, logger, threads, weights)
     else:
         logger.info(f"Only one genome amplified for the {name} primer ({list(cluster_dict)[0]}) so we will skip making figures as they would be useless\n")
         cluster_df = overlaps.single_amp_df(cluster_dict)
-    overlaps.overlap_report(combinations, gcf_species, cluster_df, genus, name, outdir, logger, shannon_div, unique_species, all_species, genome_count, user)
\ No newline at end of file
+    overlaps.overlap_report(combinations, gcf_species, cluster_df, genus, name, outdir, logger, shannon_div, unique_species, all_species, genome_count, user, weights)
\ No newline at end of file
@@ -23,3 +23,29 @@ def vsearch_call(outdir, genus, name, ident, log_dir, threads, logger):
     if os.stat(f"{log_dir}/vsearch_{name}.err").st_size != 0:
         logger.warning(f"Vsearch did something non default. Hopefully this does not ruin down stream analysis but if you get an error check {log_dir}/vsearch_{name}.err")
     return
+
+# Alleles each query is aligned against without passing the identity before the search gives up on it
+PAIR_MAX_REJECTS = 256
+
+# Search unique alleles against each other keeping every pair at or above the identity (not just the best hit) for the identity sweep.
+# Pairs whose lengths differ by more than the identity allows are never aligned and each query stops after PAIR_MAX_REJECTS failed
+# targets (vsearch tries them most k-mers shared first), so the search costs about U x (pairs per allele + PAIR_MAX_REJECTS) alignments rather than U^2
+def vsearch_pairs(uniques, pairs_out, ident, log_dir, name, threads, logger):
+    command = f"vsearch --usearch_global {uniques} --db {uniques} --id {ident} --minsl {ident} --strand both --self --maxaccepts 0 --maxrejects {PAIR_MAX_REJECTS} --userout {pairs_out} --userfields query+target+id --quiet --threads {threads}"
+    with open(f"{log_dir}/vsearch_pairs_{name}.out", "w") as out, open(f"{log_dir}/vsearch_pairs_{name}.err", "w") as err:
+        subprocess.run(shlex.split(command), stdout = out, stderr = err)
+    
+    if os.stat(f"{log_dir}/vsearch_pairs_{name}.err").st_size != 0:
+        logger.warning(f"Vsearch did something non default while searching allele pairs. If the identity sweep looks wrong check {log_dir}/vsearch_pairs_{name}.err")
+    Path(pairs_out).touch() # vsearch writes nothing when no pair is similar enough
+    return
+
+# Cluster any fasta file into a cluster file, for callers that hold their amplicons in memory rather than in the run's layout
+def vsearch_cluster(infile, uc_out, ident, threads, log_dir, logger):
+    command = f"vsearch --cluster_fast {infile} --id {ident} --strand both --uc {uc_out} --quiet --threads {threads}"
+    with open(f"{log_dir}/vsearch_cluster.out", "w") as out, open(f"{log_dir}/vsearch_cluster.err", "w") as err:
+        subprocess.run(shlex.split(command), stdout = out, stderr = err)
+    
+    if os.stat(f"{log_dir}/vsearch_cluster.err").st_size != 0:
+        logger.warning(f"Vsearch did something non default. If the alleles look wrong check {log_dir}/vsearch_cluster.err")
+    return
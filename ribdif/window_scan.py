@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from ribdif import primer_match, journal, figures
+from ribdif.dereplicate import mix64
+
+# Sliding window scan of the 16S alignment, scoring every window of the given lengths as if it were an amplicon
+
+SCAN_NAME = "window_scan.tsv"
+HASH_BASE = np.uint64(0x9E3779B97F4A7C15)
+
+
+# Read an alignment into a sequences x columns array of upper case bytes
+def read_alignment(path):
+    labels, rows = [], []
+    for label, seq in primer_match.read_fasta([path]):
+        labels.append(label)
+        rows.append(np.frombuffer(seq.upper().encode(), dtype = np.uint8))
+    width = max((len(row) for row in rows), default = 0)
+    alignment = np.full((len(rows), width), ord("-"), dtype = np.uint8)
+    for i, row in enumerate(rows):
+        alignment[i, :len(row)] = row
+    return labels, alignment
+
+
+# Columns of an alignment, from its first sequence as every aligned sequence is as long
+def alignment_width(path):
+    for _, seq in primer_match.read_fasta([path]):
+        return len(seq)
+    return 0
+
+
+# Prefix hashes of every sequence, prefix[:, j] covers the first j columns. uint64 arithmetic wraps around as intended
+def prefix_hashes(alignment):
+    rng = np.random.default_rng(0)
+    symbols = rng.integers(1, np.iinfo(np.uint64).max, size = 256, dtype = np.uint64) # random values so similar columns do not hash alike
+    prefix = np.zeros((alignment.shape[0], alignment.shape[1] + 1), dtype = np.uint64)
+    with np.errstate(over = "ignore"):
+        for j in range(alignment.shape[1]):
+            prefix[:, j + 1] = prefix[:, j] * HASH_BASE + symbols[alignment[:, j]]
+    return prefix
+
+
+# Hashes of the windows of one length starting at the given columns, one column per window
+def window_hashes(prefix, starts, length):
+    with np.errstate(over = "ignore"):
+        power = HASH_BASE ** np.uint64(length)
+        return mix64(prefix[:, starts + length] - prefix[:, starts] * power)
+
+
+# Alleles, Shannon diversity and resolved named species of every window from its hashes
+def score_windows(hashes, species_codes, named):
+    n_seqs, n_windows = hashes.shape
+    # Sort each window's sequences by allele and then species
+    order = np.lexsort((np.broadcast_to(species_codes, (n_windows, n_seqs)), hashes.T))
+    rows = np.arange(n_windows)[:, None]
+    sorted_hashes, sorted_species = hashes.T[rows, order], species_codes[order]
+    new_allele = np.ones((n_windows, n_seqs), dtype = bool)
+    new_allele[:, 1:] = sorted_hashes[:, 1:] != sorted_hashes[:, :-1]
+    alleles = new_allele.sum(axis = 1)
+
+    # Alleles are numbered across all windows so they can be counted with one bincount
+    allele_id = np.cumsum(new_allele.ravel()) - 1
+    sizes = np.bincount(allele_id)
+    window_of = np.repeat(np.arange(n_windows), alleles)
+    p = sizes / n_seqs
+    shannon = -np.bincount(window_of, weights = p * np.log(p), minlength = n_windows)
+
+    # An allele holding more than one species leaves all of them unresolved in that window
+    new_species = np.zeros((n_windows, n_seqs), dtype = bool)
+    new_species[:, 1:] = ~new_allele[:, 1:] & (sorted_species[:, 1:] != sorted_species[:, :-1])
+    mixed = np.bincount(allele_id, weights = new_species.ravel(), minlength = len(sizes)) > 0
+    n_species = len(named)
+    unresolved = np.unique((np.repeat(np.arange(n_windows), n_seqs) * n_species + sorted_species.ravel())[mixed[allele_id]])
+    unresolved_named = np.bincount(unresolved // n_species, weights = named[unresolved % n_species], minlength = n_windows)
+    present_named = int(named[np.unique(species_codes)].sum())
+    return alleles, shannon, present_named - unresolved_named.astype(int)
+
+
+# Scan every window of every length in the range, writing the resolution profile and its figure
+def window_scan(outdir, genus, min_length, max_length, stride, species_map, logger):
+    labels, alignment = read_alignment(f"{outdir}/full/{genus}.16sAln")
+    species_map = species_map or {}
+    species = [species_map.get("_".join(label.split("_")[:2]), label.split("_")[5] if len(label.split("_")) > 5 else "sp.") for label in labels]
+    species_names, species_codes = np.unique(np.array(species, dtype = str), return_inverse = True)
+    species_codes = species_codes.ravel()
+    named = species_names != "sp."
+    width = alignment.shape[1]
+    lengths = [length for length in range(min_length, max_length + 1, stride) if length <= width]
+    if not lengths:
+        logger.warning(f"Every window of {min_length}-{max_length} columns is longer than the {width} column alignment, scanning the whole alignment as one window instead\n")
+        lengths = [width]
+    logger.info(f"Scanning windows of {min_length}-{max_length} columns every {stride} columns across the {width} column alignment of {len(labels)} 16S genes\n")
+
+    prefix = prefix_hashes(alignment)
+    gaps = np.concatenate([[0], np.cumsum((alignment == ord("-")).sum(axis = 0))])
+    scans = []
+    for length in lengths:
+        starts = np.arange(0, width - length + 1, stride)
+        alleles, shannon, resolved = score_windows(window_hashes(prefix, starts, length), species_codes, named)
+        scans.append(pd.DataFrame({"Start": starts + 1, "End": starts + length, "Length": length, "Alleles": alleles,
+                                   "Shannon": np.round(shannon, 4), "ResolvedSpecies": resolved, "NamedSpecies": int(named.sum()),
+                                   "GapFraction": np.round((gaps[starts + length] - gaps[starts]) / (length * len(labels)), 4)}))
+    scan_df = pd.concat(scans, ignore_index = True)
+    Path(f"{outdir}/figures").mkdir(exist_ok = True)
+    with journal.atomic_write(f"{outdir}/{genus}_{SCAN_NAME}") as f_out:
+        scan_df.to_csv(f_out, sep = "\t", index = False)
+    figures.window_scan_figure(scan_df, outdir, genus)
+
+    best = scan_df.sort_values(["ResolvedSpecies", "Shannon", "Length"], ascending = [False, False, True]).head(10)
+    logger.info(f"Windows resolving the most species (all {len(scan_df)} are in {outdir}/{genus}_{SCAN_NAME}):\n{best.to_string(index = False)}\n\n")
+    return scan_df
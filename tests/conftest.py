@@ -0,0 +1,73 @@
+import gzip
+import hashlib
+import random
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from ncbi_genome_download import core
+
+SUMMARY_FIELDS = ["assembly_accession", "bioproject", "biosample", "wgs_master", "refseq_category", "taxid", "species_taxid",
+                  "organism_name", "infraspecific_name", "isolate", "version_status", "assembly_level", "release_type",
+                  "genome_rep", "seq_rel_date", "asm_name", "submitter", "gbrs_paired_asm", "paired_asm_comp", "ftp_path",
+                  "excluded_from_refseq", "relation_to_type_material"]
+FORWARD = "AGAGTTTGATCATGGCTCAG"
+REVERSE = "GGTTACCTTGTTACGACTT"
+PRIMERS = f"V1\t{FORWARD}\t{REVERSE}\t1000\n"
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def revcomp(seq):
+    return seq.translate(str.maketrans("ACGT", "TGCA"))[::-1]
+
+
+# A random genome of a few contigs, each holding an amplicon of the test primers whose middle differs between seeds
+def test_genome(seed, contigs = 2):
+    rng = random.Random(seed)
+    random_seq = lambda n: "".join(rng.choice("ACGT") for _ in range(n))
+    records = []
+    for contig in range(contigs):
+        seq = random_seq(500) + FORWARD + random_seq(600) + revcomp(REVERSE) + random_seq(500)
+        records.append(f">NZ_TEST{seed:03d}{contig}.1 contig {contig}\n" + "\n".join(seq[i:i + 80] for i in range(0, len(seq), 80)) + "\n")
+    return "".join(records)
+
+
+# A local stand in for the NCBI genomes site: an assembly summary of the given organisms, each with a gzipped fasta and its
+# md5checksums.txt, served over HTTP. Returns the uri to hand to ncbi-genome-download
+@pytest.fixture
+def ncbi_standin(tmp_path, monkeypatch):
+    monkeypatch.setattr(core, "CACHE_DIR", str(tmp_path / "ngd_cache")) # summaries cached by genome store runs must not outlive the test
+    servers = []
+
+    def serve(organisms, level = "Complete Genome"):
+        root = tmp_path / "ncbi"
+        (root / "refseq" / "bacteria").mkdir(parents = True)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), partial(QuietHandler, directory = str(root)))
+        uri = f"http://127.0.0.1:{server.server_address[1]}"
+        rows = []
+        for i, organism in enumerate(organisms):
+            accession, asm = f"GCF_{i + 1:09d}.1", f"ASM{i + 1}v1"
+            directory = root / "all" / f"{accession}_{asm}"
+            directory.mkdir(parents = True)
+            fasta = gzip.compress(test_genome(i).encode())
+            (directory / f"{accession}_{asm}_genomic.fna.gz").write_bytes(fasta)
+            (directory / "md5checksums.txt").write_text(f"{hashlib.md5(fasta).hexdigest()}  ./{accession}_{asm}_genomic.fna.gz\n")
+            entry = dict.fromkeys(SUMMARY_FIELDS, "")
+            entry.update(assembly_accession = accession, refseq_category = "na", taxid = str(1000 + i), species_taxid = str(1000 + i),
+                         organism_name = organism, infraspecific_name = f"strain=T{i}", version_status = "latest",
+                         assembly_level = level, seq_rel_date = "2020/01/01", asm_name = asm, ftp_path = f"{uri}/all/{accession}_{asm}")
+            rows.append("\t".join(entry[field] for field in SUMMARY_FIELDS))
+        (root / "refseq" / "bacteria" / "assembly_summary.txt").write_text("#   See ftp://ftp.ncbi.nlm.nih.gov/genomes/README_assembly_summary.txt\n"
+                                                                           "# " + "\t".join(SUMMARY_FIELDS) + "\n" + "\n".join(rows) + "\n")
+        threading.Thread(target = server.serve_forever, daemon = True).start()
+        servers.append(server)
+        return uri
+
+    yield serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,41 @@
+import logging
+from pathlib import Path
+from ribdif import ngd_download
+
+ORGANISMS = ["Testia alpha A1", "Testia alpha A2", "Testia beta B1", "Testia sp. X9"]
+
+
+# Every genome reaches on_ready already downloaded and verified, while the others may still be downloading
+def test_genomes_are_handed_on_as_they_download(tmp_path, ncbi_standin):
+    uri = ncbi_standin(ORGANISMS)
+    ready = []
+
+    def on_ready(gz):
+        assert Path(gz).is_file()
+        ready.append(Path(gz).parent.name)
+
+    status = ngd_download.genome_download("Testia", tmp_path / "run", 2, False, False, "bacteria", logging.getLogger("test"), None, on_ready, uri)
+    assert status == 0
+    assert sorted(ready) == [f"GCF_{i:09d}.1" for i in range(1, len(ORGANISMS) + 1)]
+    assert ngd_download.metadata_species(tmp_path / "run") == {f"GCF_{i:09d}.1": species for i, species in enumerate(["alpha", "alpha", "beta", "sp."], start = 1)}
+
+
+# Through a genome store the genomes land in the store and on_ready gets their links in the run directory
+def test_streaming_through_a_genome_store(tmp_path, ncbi_standin):
+    uri = ncbi_standin(ORGANISMS)
+    ready = []
+    status = ngd_download.genome_download("Testia", tmp_path / "run", 2, False, True, "bacteria", logging.getLogger("test"), tmp_path / "store", ready.append, uri)
+    assert status == 0
+    assert len(ready) == 3 # the unnamed genome is ignored
+    assert all(Path(gz).is_file() and str(gz).startswith(str(tmp_path / "run")) for gz in ready)
+    assert len(list((tmp_path / "store").glob("refseq/bacteria/*/*.fna.gz"))) == 3
+
+
+# A genome whose download does not match its checksum is never handed on
+def test_corrupt_downloads_are_not_handed_on(tmp_path, ncbi_standin):
+    uri = ncbi_standin(ORGANISMS[:2])
+    corrupt = next((tmp_path / "ncbi" / "all").glob("GCF_000000001.1_*/*.fna.gz"))
+    corrupt.write_bytes(corrupt.read_bytes()[:-10])
+    ready = []
+    ngd_download.genome_download("Testia", tmp_path / "run", 2, False, False, "bacteria", logging.getLogger("test"), None, ready.append, uri)
+    assert [Path(gz).parent.name for gz in ready] == ["GCF_000000002.1"]
@@ -0,0 +1,55 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+import pytest
+from conftest import PRIMERS
+
+ORGANISMS = ["Testia alpha A1", "Testia alpha A2", "Testia beta B1", "Testia gamma C1"] # with 3 shards these hash to shards 0, 1, 0 and 1, leaving shard 2 empty
+SHARDS = 3
+REPO = Path(__file__).resolve().parent.parent
+
+
+def ribdif(*args):
+    return [sys.executable, "-m", "ribdif", *[str(arg) for arg in args]]
+
+
+# Run every shard of a whole genome run as its own process at the same time, as an array job would on separate nodes
+def run_shards(tmp_path, uri):
+    primers = tmp_path / "test.primers"
+    primers.write_text(PRIMERS)
+    env = {**os.environ, "PYTHONPATH": str(REPO)}
+    env.pop("SLURM_ARRAY_TASK_ID", None)
+    jobs = [subprocess.Popen(ribdif("-g", "Testia", "-w", "-p", primers, "--ncbi-uri", uri, "-o", tmp_path / "results", "-t", 1,
+                                    "--shards", SHARDS, "--shard-index", index),
+                             cwd = tmp_path, env = env, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, text = True)
+            for index in range(SHARDS)]
+    outputs = [job.communicate(timeout = 600)[0] for job in jobs]
+    for job, output in zip(jobs, outputs):
+        assert job.returncode == 0, output
+    return tmp_path / "results" / "Testia", env
+
+
+# Every shard finishes, the empty one included, and between them they hold each genome once
+def test_shards_run_as_separate_processes(tmp_path, ncbi_standin):
+    rundir, _ = run_shards(tmp_path, ncbi_standin(ORGANISMS))
+    manifests = [json.loads((rundir / "shards" / f"shard_{index}" / "shard.json").read_text()) for index in range(SHARDS)]
+    assert [manifest["genomes"] for manifest in manifests] == [2, 2, 0]
+    assert manifests[2]["names"] == []
+    genomes = [line.split("\t")[0] for index in range(SHARDS) for line in (rundir / "shards" / f"shard_{index}" / "shard_genomes.tsv").read_text().splitlines()[1:]]
+    assert sorted(genomes) == [f"GCF_{i:09d}.1" for i in range(1, len(ORGANISMS) + 1)]
+
+
+# Merging the shards clusters and reports the amplicons of every genome once
+@pytest.mark.skipif(shutil.which("vsearch") is None, reason = "ribdif merge clusters with vsearch")
+def test_merge_joins_every_shard(tmp_path, ncbi_standin):
+    rundir, env = run_shards(tmp_path, ncbi_standin(ORGANISMS))
+    merge = subprocess.run(ribdif("merge", rundir, "-t", 1), cwd = tmp_path, env = env, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, text = True, timeout = 600)
+    assert merge.returncode == 0, merge.stdout
+    amplicons = (rundir / "amplicons" / "V1" / "Testia-V1.amplicons").read_text().count(">")
+    assert amplicons == 2 * len(ORGANISMS) # two contigs, each with one amplicon, per genome
+    summary = (rundir / "Testia_V1-amp_summary.tsv").read_text().splitlines()
+    assert len(summary) == len(ORGANISMS) + 1
+    assert (rundir / "Testia_V1_overlap_report.txt").is_file()